@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
 
-import json
-
 import tornado.web
 
+import serializer
+
 
 # noinspection PyAbstractClass
 class ApiHandler(tornado.web.RequestHandler):
@@ -25,8 +25,8 @@ class ApiHandler(tornado.web.RequestHandler):
         if not self.request.headers.get('Content-Type', '').startswith('application/json'):
             return
         try:
-            self.json_args = json.loads(self.request.body)
-        except json.JSONDecodeError:
+            self.json_args = serializer.loads(self.request.body)
+        except serializer.DecodeError:
             pass
 
     async def options(self, *_args, **_kwargs):
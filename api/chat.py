@@ -2,22 +2,30 @@
 
 import asyncio
 import enum
-import json
 import logging
+import os
 import random
 import time
 import uuid
 from typing import *
 
 import aiohttp
+import tornado.web
 import tornado.websocket
 
 import api.base
 import blivedm.blivedm as blivedm
 import config
+import http_client
+import metrics
 import models.avatar
+import models.command_record
 import models.translate
 import models.log
+import models.room_info
+import models.room_stats
+import serializer
+import tracing
 logger = logging.getLogger(__name__)
 
 
@@ -32,14 +40,59 @@ class Command(enum.IntEnum):
     UPDATE_TRANSLATION = 7
 
 
-_http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+# 转发时保存统计快照的间隔（秒），进程崩溃时最多丢失这么长时间的统计
+STATS_SNAPSHOT_INTERVAL = 5 * 60
 
 room_manager: Optional['RoomManager'] = None
 
+_broadcast_message_counter = metrics.Counter(
+    'blivechat_broadcast_messages_total', 'Number of messages broadcast to rooms', ('cmd',)
+)
+# 提前取出子指标，发消息时不用再查标签
+_broadcast_message_counters = {cmd: _broadcast_message_counter.labels(cmd.name) for cmd in Command}
+_fan_out_duration_histogram = metrics.Histogram(
+    'blivechat_broadcast_fan_out_duration_seconds', 'Time spent writing a broadcast message to all clients of a room'
+)
+
 
 def init():
     global room_manager
     room_manager = RoomManager()
+    asyncio.ensure_future(_save_stats_loop())
+
+
+def shutdown():
+    """事件循环停止后调用，写入还没写的命令记录，结束所有房间的日志并保存统计"""
+    if room_manager is None:
+        return
+    for room in list(room_manager.rooms.values()):
+        room.stop_recording_commands(wait=True)
+        room.end_log_session(wait=True)
+
+
+async def _save_stats_loop():
+    while True:
+        await asyncio.sleep(STATS_SNAPSHOT_INTERVAL)
+        try:
+            for room in list(room_manager.rooms.values()):
+                room.save_stats_snapshot()
+        except Exception:
+            logger.exception('_save_stats_loop error:')
+
+
+def _collect_room_count():
+    return [((), 0 if room_manager is None else len(room_manager.rooms))]
+
+
+def _collect_room_client_counts():
+    if room_manager is None:
+        return []
+    return [((room_id,), len(room.clients)) for room_id, room in room_manager.rooms.items()]
+
+
+metrics.Gauge('blivechat_rooms', 'Number of rooms', collect_func=_collect_room_count)
+metrics.Gauge('blivechat_room_clients', 'Number of clients in each room', ('room_id',),
+              collect_func=_collect_room_client_counts)
 
 
 class Room(blivedm.BLiveClient):
@@ -47,6 +100,7 @@ class Room(blivedm.BLiveClient):
 
     # 重新定义parse_XXX是为了减少对字段名的依赖，防止B站改字段名
     def __parse_danmaku(self, command):
+        trace = tracing.start_trace('danmaku')
         info = command['info']
         if info[3]:
             room_id = info[3][3]
@@ -61,7 +115,7 @@ class Room(blivedm.BLiveClient):
             info[4][0], None, None,
             None, None,
             info[7]
-        ))
+        ), trace)
 
     def __parse_gift(self, command):
         data = command['data']
@@ -74,7 +128,7 @@ class Room(blivedm.BLiveClient):
     def __parse_buy_guard(self, command):
         data = command['data']
         return self._on_buy_guard(blivedm.GuardBuyMessage(
-            data['uid'], data['username'], data['guard_level'], None, None,
+            data['uid'], data['username'], data['guard_level'], data['num'], data['price'],
             None, None, data['start_time'], None
         ))
 
@@ -99,42 +153,148 @@ class Room(blivedm.BLiveClient):
     }
 
     def __init__(self, room_id):
-        super().__init__(room_id, session=_http_session, heartbeat_interval=self.HEARTBEAT_INTERVAL)
+        super().__init__(room_id, session=http_client.session, heartbeat_interval=self.HEARTBEAT_INTERVAL)
         self.clients: List['ChatHandler'] = []
         self.auto_translate_count = 0
+        self._command_recorder: Optional[models.command_record.CommandRecorder] = None
+        self.stats = models.room_stats.RoomStats(room_id)
+
+    async def _init_room_id_and_owner(self):
+        # 覆盖了blivedm.BLiveClient的私有方法，依赖它的内部实现：init_room调用这个方法，返回False时退回使用
+        # 传入的房间ID，之后读取_room_id、_room_short_id、_room_owner_uid。升级blivedm时要检查这些有没有变
+        # 和RoomInfoHandler共用缓存
+        room_info = await models.room_info.get_room_info(self._tmp_room_id)
+        if room_info is None:
+            return False
+        self._room_id = room_info.room_id
+        self._room_short_id = room_info.short_id
+        self._room_owner_uid = room_info.owner_uid
+        self.stats.room_id = self._room_id
+        return True
 
     async def init_room(self):
         await super().init_room()
+        self._start_recording_commands()
         return True
 
+    def _start_recording_commands(self):
+        record_dir = config.get_config().record_commands_dir
+        if record_dir == '':
+            return
+        try:
+            os.makedirs(record_dir, exist_ok=True)
+            self._command_recorder = models.command_record.CommandRecorder(
+                models.command_record.make_record_path(record_dir, self.room_id), self.room_id,
+                self.room_owner_uid
+            )
+        except OSError:
+            logger.exception('room %d failed to start recording commands:', self.room_id)
+            return
+        logger.info('room %d is recording commands to %s', self.room_id, self._command_recorder.path)
+
+    def stop_recording_commands(self, wait=False):
+        """
+        :param wait: 为True时在当前线程写入剩下的命令，用于事件循环已经停止的时候
+        """
+        if self._command_recorder is not None:
+            self._command_recorder.close(wait)
+            self._command_recorder = None
+
+    async def _handle_command(self, command):
+        if self._command_recorder is not None:
+            self._command_recorder.write(command)
+        await super()._handle_command(command)
+
     def stop_and_close(self):
+        self.stop_recording_commands()
+        self.end_log_session()
         if self.is_running:
             future = self.stop()
             future.add_done_callback(lambda _future: asyncio.ensure_future(self.close()))
         else:
             asyncio.ensure_future(self.close())
 
-    def send_message(self, cmd, data):
-        body = json.dumps({'cmd': cmd, 'data': data})
-        models.log.add_danmaku(self.room_id, body)
+    def end_log_session(self, wait=False):
+        """
+        这次转发结束了，保存统计。结束的日志可以统计、归档，之后再转发时新建一个日志
+
+        :param wait: 为True时在当前线程保存统计，用于事件循环已经停止的时候
+        """
+        lid = models.log.end_log_session(self.room_id)
+        self._save_stats_snapshot(lid, wait)
+
+    def save_stats_snapshot(self):
+        """转发时定期保存统计，覆盖这次转发之前保存的"""
+        lid = models.log.get_active_log_file_id(self.room_id)
+        if lid is not None:
+            self._save_stats_snapshot(lid)
+
+    def _save_stats_snapshot(self, lid, wait=False):
+        if self.stats.is_empty():
+            return
+        if wait:
+            models.room_stats.save_snapshot(self.room_id, lid, self.stats.to_dict())
+        else:
+            asyncio.get_event_loop().run_in_executor(
+                None, models.room_stats.save_snapshot, self.room_id, lid, self.stats.to_dict()
+            )
+
+    def send_message(self, cmd, data, trace: Optional[tracing.MessageTrace] = None, uid=None):
+        """
+        :param uid: 发送者的UID，记录到日志里
+        """
+        # 直接序列化成bytes，websocket发送时不用再编码
+        body = serializer.dumps_bytes({'cmd': cmd, 'data': data})
+        if trace is not None:
+            trace.mark('serialize')
+        models.log.add_danmaku(self.room_id, body, cmd, data, uid)
+        if trace is not None:
+            trace.mark('log_write')
+        _broadcast_message_counters[cmd].inc()
+        start_time = time.perf_counter()
+        write_futures = []
         for client in self.clients:
             try:
-                client.write_message(body)
+                future = client.write_message(body)
+                if trace is not None:
+                    write_futures.append(future)
             except tornado.websocket.WebSocketClosedError:
                 room_manager.del_client(self.room_id, client)
+        _fan_out_duration_histogram.observe(time.perf_counter() - start_time)
+
+        if trace is not None:
+            trace.mark('fan_out')
+            # 等所有客户端都写完再结束
+            asyncio.ensure_future(self._finish_trace_after_write(trace, write_futures))
+
+    @staticmethod
+    async def _finish_trace_after_write(trace: tracing.MessageTrace, write_futures):
+        await asyncio.gather(*write_futures, return_exceptions=True)
+        trace.mark('flush')
+        trace.finish()
 
     def send_message_if(self, can_send_func: Callable[['ChatHandler'], bool], cmd, data):
-        body = json.dumps({'cmd': cmd, 'data': data})
+        body = serializer.dumps_bytes({'cmd': cmd, 'data': data})
+        _broadcast_message_counters[cmd].inc()
+        start_time = time.perf_counter()
         for client in filter(can_send_func, self.clients):
             try:
                 client.write_message(body)
             except tornado.websocket.WebSocketClosedError:
                 room_manager.del_client(self.room_id, client)
-
-    async def _on_receive_danmaku(self, danmaku: blivedm.DanmakuMessage):
-        asyncio.ensure_future(self.__on_receive_danmaku(danmaku))
-
-    async def __on_receive_danmaku(self, danmaku: blivedm.DanmakuMessage):
+        _fan_out_duration_histogram.observe(time.perf_counter() - start_time)
+
+    async def _on_receive_danmaku(self, danmaku: blivedm.DanmakuMessage,
+                                  trace: Optional[tracing.MessageTrace] = None):
+        if trace is not None:
+            trace.mark('parse')
+        asyncio.ensure_future(self.__on_receive_danmaku(danmaku, trace))
+
+    async def __on_receive_danmaku(self, danmaku: blivedm.DanmakuMessage,
+                                   trace: Optional[tracing.MessageTrace] = None):
+        if trace is not None:
+            trace.mark('schedule')
+        self.stats.on_danmaku(danmaku.uid)
         if danmaku.uid == self.room_owner_uid:
             author_type = 3  # 主播
         elif danmaku.admin:
@@ -154,11 +314,17 @@ class Room(blivedm.BLiveClient):
                 need_translate = False
         else:
             translation = ''
+        if trace is not None:
+            trace.mark('translation_cache')
+
+        avatar_url = await models.avatar.get_avatar_url(danmaku.uid)
+        if trace is not None:
+            trace.mark('avatar')
 
         id_ = uuid.uuid4().hex
         # 为了节省带宽用list而不是dict
         self.send_message(Command.ADD_TEXT, make_text_message(
-            await models.avatar.get_avatar_url(danmaku.uid),
+            avatar_url,
             int(danmaku.timestamp / 1000),
             danmaku.uname,
             author_type,
@@ -171,7 +337,7 @@ class Room(blivedm.BLiveClient):
             0 if danmaku.room_id != self.room_id else danmaku.medal_level,
             id_,
             translation
-        ))
+        ), trace, danmaku.uid)
 
         if need_translate:
             await self._translate_and_response(danmaku.msg, id_)
@@ -181,6 +347,7 @@ class Room(blivedm.BLiveClient):
         models.avatar.update_avatar_cache(gift.uid, avatar_url)
         if gift.coin_type != 'gold':  # 丢人
             return
+        self.stats.on_gift(gift.uid, gift.uname, gift.total_coin)
         id_ = uuid.uuid4().hex
         self.send_message(Command.ADD_GIFT, {
             'id': id_,
@@ -190,12 +357,13 @@ class Room(blivedm.BLiveClient):
             'totalCoin': gift.total_coin,
             'giftName': gift.gift_name,
             'num': gift.num
-        })
+        }, uid=gift.uid)
 
     async def _on_buy_guard(self, message: blivedm.GuardBuyMessage):
         asyncio.ensure_future(self.__on_buy_guard(message))
 
     async def __on_buy_guard(self, message: blivedm.GuardBuyMessage):
+        self.stats.on_buy_guard(message.guard_level, message.num or 1, message.price or 0)
         id_ = uuid.uuid4().hex
         self.send_message(Command.ADD_MEMBER, {
             'id': id_,
@@ -203,9 +371,10 @@ class Room(blivedm.BLiveClient):
             'timestamp': message.start_time,
             'authorName': message.username,
             'privilegeType': message.guard_level
-        })
+        }, uid=message.uid)
 
     async def _on_super_chat(self, message: blivedm.SuperChatMessage):
+        self.stats.on_super_chat(message.price)
         avatar_url = models.avatar.process_avatar_url(message.face)
         models.avatar.update_avatar_cache(message.uid, avatar_url)
 
@@ -229,7 +398,7 @@ class Room(blivedm.BLiveClient):
             'price': message.price,
             'content': message.message,
             'translation': translation
-        })
+        }, uid=message.uid)
 
         if need_translate:
             asyncio.ensure_future(self._translate_and_response(message.message, id_))
@@ -252,6 +421,8 @@ class Room(blivedm.BLiveClient):
         translation = await models.translate.translate(text)
         if translation is None:
             return
+        # 记录下来用来生成本地短语表，不写到弹幕日志里
+        asyncio.get_event_loop().run_in_executor(None, models.translate.add_translation_record, text, translation)
         self.send_message_if(
             lambda client: client.auto_translate,
             Command.UPDATE_TRANSLATION, make_translation_message(
@@ -307,6 +478,10 @@ class RoomManager:
     def __init__(self):
         self._rooms: Dict[int, Room] = {}
 
+    @property
+    def rooms(self) -> Dict[int, Room]:
+        return self._rooms
+
     async def get_room(self, room_id):
         if room_id not in self._rooms:
             if not await self._add_room(room_id):
@@ -429,7 +604,7 @@ class ChatHandler(tornado.websocket.WebSocketHandler):
             if self.has_joined_room:
                 self._refresh_receive_timeout_timer()
 
-            body = json.loads(message)
+            body = serializer.loads(message)
             cmd = body['cmd']
             if cmd == Command.HEARTBEAT:
                 pass
@@ -463,7 +638,7 @@ class ChatHandler(tornado.websocket.WebSocketHandler):
         return self.room_id is not None
 
     def send_message(self, cmd, data):
-        body = json.dumps({'cmd': cmd, 'data': data})
+        body = serializer.dumps_bytes({'cmd': cmd, 'data': data})
         try:
             self.write_message(body)
         except tornado.websocket.WebSocketClosedError:
@@ -561,7 +736,11 @@ class RoomInfoHandler(api.base.ApiHandler):
     async def get(self):
         room_id = int(self.get_query_argument('roomId'))
         logger.info('Client %s is getting room info %d', self.request.remote_ip, room_id)
-        room_id, owner_uid = await self._get_room_info(room_id)
+        room_info = await models.room_info.get_room_info(room_id)
+        if room_info is not None:
+            room_id, owner_uid = room_info.room_id, room_info.owner_uid
+        else:
+            owner_uid = 0
         host_server_list = await self._get_server_host_list(room_id)
         if owner_uid == 0:
             # 缓存3分钟
@@ -575,34 +754,13 @@ class RoomInfoHandler(api.base.ApiHandler):
             'hostServerList': host_server_list
         })
 
-    @staticmethod
-    async def _get_room_info(room_id):
-        try:
-            async with _http_session.get(blivedm.ROOM_INIT_URL, params={'room_id': room_id}
-                                         ) as res:
-                if res.status != 200:
-                    logger.warning('room %d _get_room_info failed: %d %s', room_id,
-                                   res.status, res.reason)
-                    return room_id, 0
-                data = await res.json()
-        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
-            logger.exception('room %d _get_room_info failed', room_id)
-            return room_id, 0
-
-        if data['code'] != 0:
-            logger.warning('room %d _get_room_info failed: %s', room_id, data['message'])
-            return room_id, 0
-
-        room_info = data['data']['room_info']
-        return room_info['room_id'], room_info['uid']
-
     @classmethod
     async def _get_server_host_list(cls, _room_id):
         return cls._host_server_list_cache
 
         # 连接其他host必须要key
         # try:
-        #     async with _http_session.get(blivedm.DANMAKU_SERVER_CONF_URL, params={'id': room_id, 'type': 0}
+        #     async with http_client.get(blivedm.DANMAKU_SERVER_CONF_URL, params={'id': room_id, 'type': 0}
         #                                  ) as res:
         #         if res.status != 200:
         #             logger.warning('room %d _get_server_host_list failed: %d %s', room_id,
@@ -643,6 +801,35 @@ class AvatarHandler(api.base.ApiHandler):
         })
 
 
+# noinspection PyAbstractClass
+class StatsHandler(api.base.ApiHandler):
+    async def get(self):
+        try:
+            room_id = int(self.get_query_argument('roomId'))
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'Invalid roomId')
+
+        room = room_manager.rooms.get(room_id, None)
+        if room is None:
+            # 可能是短号或者真实房间号
+            room = next((room_ for room_ in room_manager.rooms.values() if room_.room_id == room_id), None)
+        if room is not None:
+            self.write({
+                'live': True,
+                **room.stats.to_dict()
+            })
+            return
+
+        # 房间没有在转发，返回最后一次保存的统计
+        stats = await asyncio.get_event_loop().run_in_executor(None, models.room_stats.get_latest_snapshot, room_id)
+        if stats is None:
+            raise tornado.web.HTTPError(404, 'No stats of this room')
+        self.write({
+            'live': False,
+            **stats
+        })
+
+
 # noinspection PyAbstractClass
 # handle reply message
 class ReplyHandler(api.base.ApiHandler):
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+
+import tornado.web
+
+import api.base
+import monitor
+import tracing
+
+
+# noinspection PyAbstractClass
+class DebugApiHandler(api.base.ApiHandler):
+    """只在调试模式可用"""
+    def prepare(self):
+        if not self.application.settings['debug']:
+            raise tornado.web.HTTPError(404)
+        super().prepare()
+
+
+# noinspection PyAbstractClass
+class ProfileHandler(DebugApiHandler):
+    async def get(self):
+        try:
+            seconds = float(self.get_query_argument('seconds', '10'))
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'seconds should be a number')
+        if not 0 < seconds <= monitor.MAX_PROFILE_SECONDS:
+            raise tornado.web.HTTPError(400, f'seconds should be in (0, {monitor.MAX_PROFILE_SECONDS}]')
+        try:
+            collapsed_stacks = await monitor.profile(seconds)
+        except RuntimeError:
+            raise tornado.web.HTTPError(409, 'Another profile is running')
+
+        filename = time.strftime('profile-%Y-%m-%d-%H-%M-%S.folded')
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.set_header('Content-Disposition', f'attachment; filename={filename}')
+        self.write(collapsed_stacks)
+
+
+# noinspection PyAbstractClass
+class SlowCallbacksHandler(DebugApiHandler):
+    async def get(self):
+        self.write({
+            'slowCallbacks': [{
+                'time': record.time.isoformat(),
+                'duration': record.duration,
+                'callback': record.callback
+            } for record in monitor.get_slow_callback_records()]
+        })
+
+
+# noinspection PyAbstractClass
+class TraceHandler(DebugApiHandler):
+    async def get(self):
+        filename = time.strftime('trace-%Y-%m-%d-%H-%M-%S.json')
+        self.set_header('Content-Type', 'application/json; charset=utf-8')
+        self.set_header('Content-Disposition', f'attachment; filename={filename}')
+        self.write(json.dumps(tracing.make_chrome_trace()))
+
+
+# noinspection PyAbstractClass
+class TraceStatsHandler(DebugApiHandler):
+    async def get(self):
+        self.write({
+            'stages': tracing.get_stage_stats()
+        })
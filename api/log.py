@@ -5,91 +5,371 @@ import logging
 import random
 import time
 import uuid
+import zlib
 from typing import *
 
 import aiohttp
+import tornado.iostream
+import tornado.web
 import tornado.websocket
 
 import api.base
 import blivedm.blivedm as blivedm
 import config
 import models.log
+import models.log_analytics
 import models.translate
+import serializer
+
+logger = logging.getLogger(__name__)
+
+# 下载日志时每次从数据库取的弹幕数
+DOWNLOAD_BATCH_SIZE = 1000
+# 分页查看日志列表时每页的默认、最大日志数
+DEFAULT_LOGS_PAGE_SIZE = 20
+MAX_LOGS_PAGE_SIZE = 100
+# 分页查看日志内容时每页的默认、最大弹幕数
+DEFAULT_CONTENT_PAGE_SIZE = 200
+MAX_CONTENT_PAGE_SIZE = 1000
+# 搜索时每页的默认、最大结果数
+DEFAULT_SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+# 按相关度排序时只能用offset分页，限制一下防止翻太深
+MAX_SEARCH_OFFSET = 10000
+# 统计结果每页的默认、最大条数
+DEFAULT_ANALYTICS_PAGE_SIZE = 20
+MAX_ANALYTICS_PAGE_SIZE = 200
+# 用户排行可以排序的字段
+_CHATTER_ORDER_FIELDS = {
+    'textCount': 'text_count',
+    'giftCoinTotal': 'gift_coin_total',
+    'superChatRevenue': 'super_chat_revenue'
+}
+
+
+def _get_int_argument(handler: tornado.web.RequestHandler, name, default):
+    value = handler.get_query_argument(name, '')
+    if value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise tornado.web.HTTPError(400, f'Invalid {name}')
+
+
+def _decode_content(content):
+    # 日志内容是发给客户端的JSON消息，解码后返回，前端不用再解析一次
+    try:
+        return serializer.loads(content)
+    except serializer.DecodeError:
+        return content
 
 
 # noinspection PyAbstractClass
 class LogHandler(api.base.ApiHandler):
-    def get(self):
+    async def get(self):
         lid = self.get_query_argument('lid', None)
         op = self.get_query_argument('op', None)
         if not lid:
-            self.get_all_logs()
-        elif op == 'view':
-            self.get_content(lid)
+            await self.get_logs()
         elif op == 'download':
-            self.download(lid)
+            await self.download(lid)
+        else:
+            await self.get_content(lid)
 
-    def delete(self):
+    async def delete(self):
         lid = self.get_query_argument('lid', None)
         if not lid:
             self.set_status(400)
             return
-        if models.log.delete_danmaku_by_file(lid):
+        # 先停止写入这个日志，房间之后的弹幕写到新的日志里
+        models.log.end_log_session_by_lid(lid)
+        # 分批删除，大的日志比较慢，放到线程池里
+        if await asyncio.get_event_loop().run_in_executor(None, models.log.delete_danmaku_by_file, lid):
             self.write('1')
         else:
             self.set_status(500)
             self.write('failed')
 
-    def download(self, lid):
-        data = models.log.get_danmakus_by_file(lid)
-        if data is None:
+    async def download(self, lid):
+        log_file = models.log.get_log_file_by_lid(lid)
+        if log_file is None:
             self.set_status(404, 'Log not found')
             self.write({
                 'code': 404,
                 'msg': 'Log not found',
                 'data': None
             })
-        else:
-            filename = models.log.get_log_file_by_lid(lid).filename
-            self.set_header('Content-Type', 'application/octet-stream')
-            self.set_header(f'Content-Disposition', f'attachment; filename={filename}')
-            data = '\n'.join(data).encode()
-            self.write(data)
-
-    def get_content(self, lid):
-        data = models.log.get_danmakus_by_file(lid)
-        if data is None:
+            return
+
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.set_header(f'Content-Disposition', f'attachment; filename={log_file.filename}')
+        # 客户端支持的话边读边压缩
+        compressor = None
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.set_header('Content-Encoding', 'gzip')
+            self.set_header('Vary', 'Accept-Encoding')
+
+        # 分批查询再分块发送，内存占用和日志大小无关
+        loop = asyncio.get_event_loop()
+        after_did = 0
+        try:
+            while True:
+                danmakus = await loop.run_in_executor(
+                    None, models.log.get_danmaku_batch, lid, after_did, DOWNLOAD_BATCH_SIZE
+                )
+                if danmakus is None:
+                    if after_did == 0:
+                        # 还没开始发送，可以返回错误
+                        self.clear()
+                        self.set_status(500, 'Failed to read log')
+                        return
+                    # 已经开始发送了，没法再改状态码，只能断开连接
+                    logger.warning('Failed to download log %s after did %d', lid, after_did)
+                    self.request.connection.close()
+                    return
+                if not danmakus:
+                    break
+
+                # 固定用标准库json，下载的格式和以前一样，不随配置的JSON实现变化
+                lines = [
+                    json.dumps({'did': did, 'lid': lid_, 'content': content})
+                    for did, lid_, content, _uid in danmakus
+                ]
+                data = ('\n' if after_did != 0 else '') + '\n'.join(lines)
+                data = data.encode('utf-8')
+                if compressor is not None:
+                    data = compressor.compress(data)
+                if data:
+                    self.write(data)
+                    await self.flush()
+                after_did = danmakus[-1][0]
+
+            if compressor is not None:
+                self.write(compressor.flush())
+        except tornado.iostream.StreamClosedError:
+            # 客户端取消下载了
+            pass
+
+    async def get_content(self, lid):
+        """分页查看日志内容，用上一页的nextAfterDid作为after_did取下一页"""
+        after_did = _get_int_argument(self, 'after_did', 0)
+        limit = _get_int_argument(self, 'limit', DEFAULT_CONTENT_PAGE_SIZE)
+        limit = min(max(limit, 1), MAX_CONTENT_PAGE_SIZE)
+        if models.log.get_log_file_by_lid(lid) is None:
             self.set_status(404, 'Log not found')
             self.write({
                 'code': 404,
                 'msg': 'Log not found',
                 'data': None
             })
-        else:
+            return
+
+        danmakus = await asyncio.get_event_loop().run_in_executor(
+            None, models.log.get_danmaku_batch, lid, after_did, limit
+        )
+        if danmakus is None:
+            self.set_status(500, 'Failed to get log content')
             self.write({
-                'code': 0,
-                'msg': 'success',
-                'data': data
+                'code': 500,
+                'msg': 'Failed to get log content',
+                'data': None
             })
+            return
+
+        self.write({
+            'code': 0,
+            'msg': 'success',
+            'data': {
+                'danmakus': [
+                    {'did': did, 'content': _decode_content(content)} for did, _lid, content, _uid in danmakus
+                ],
+                'nextAfterDid': danmakus[-1][0] if len(danmakus) == limit else None
+            }
+        })
 
-    def get_all_logs(self):
-        logs = models.log.get_all_logs()
-        if logs is None:
+    async def get_logs(self):
+        """分页查看日志列表，从新到旧，用上一页的nextBeforeLid作为before_lid取下一页"""
+        before_lid = _get_int_argument(self, 'before_lid', None)
+        limit = _get_int_argument(self, 'limit', DEFAULT_LOGS_PAGE_SIZE)
+        limit = min(max(limit, 1), MAX_LOGS_PAGE_SIZE)
+        res = await asyncio.get_event_loop().run_in_executor(
+            None, models.log.get_logs_page, before_lid, limit
+        )
+        if res is None:
             self.set_status(500, 'Failed to get log records')
             self.write({
                 'code': '114514',
                 'msg': 'Failed to get log records',
-                'data': []
-            })
-        else:
-            self.write({
-                'code': '0',
-                'msg': 'success',
-                'data': json.dumps(logs, sort_keys=True, default=str)
+                'data': None
             })
+            return
+
+        logs, total = res
+        for log in logs:
+            log['create_time'] = str(log['create_time'])
+        self.write({
+            'code': '0',
+            'msg': 'success',
+            'data': {
+                'logs': logs,
+                'total': total,
+                'nextBeforeLid': logs[-1]['lid'] if len(logs) == limit else None
+            }
+        })
 
     def preview_log(self):
         lid = self.get_query_argument('lid', None)
         if lid is None:
             self.set_status(404, 'No such file')
             return
+
+
+# noinspection PyAbstractClass
+class LogSearchHandler(api.base.ApiHandler):
+    async def get(self):
+        """
+        搜索所有日志，参数：
+        q：搜索的作者名或内容，多个词用空格分隔
+        room_id：房间ID
+        start_time、end_time：时间范围，Unix时间戳（秒）
+        cmd：消息类型，可以有多个
+        offset、limit：分页，用上一页的nextOffset作为offset取下一页
+        """
+        query = self.get_query_argument('q', '').strip()
+        if query == '':
+            raise tornado.web.HTTPError(400, 'Missing q')
+        room_id = _get_int_argument(self, 'room_id', None)
+        start_time = _get_int_argument(self, 'start_time', None)
+        end_time = _get_int_argument(self, 'end_time', None)
+        try:
+            cmds = [int(cmd) for cmd in self.get_query_arguments('cmd') if cmd != '']
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'Invalid cmd')
+        offset = min(max(_get_int_argument(self, 'offset', 0), 0), MAX_SEARCH_OFFSET)
+        limit = _get_int_argument(self, 'limit', DEFAULT_SEARCH_PAGE_SIZE)
+        limit = min(max(limit, 1), MAX_SEARCH_PAGE_SIZE)
+
+        res = await asyncio.get_event_loop().run_in_executor(
+            None, models.log.search_danmakus, query, room_id, start_time, end_time, cmds, offset, limit
+        )
+        if res is None:
+            self.set_status(500, 'Failed to search logs')
+            self.write({
+                'code': 500,
+                'msg': 'Failed to search logs',
+                'data': None
+            })
+            return
+
+        results, has_more = res
+        next_offset = offset + len(results)
+        self.write({
+            'code': 0,
+            'msg': 'success',
+            'data': {
+                'results': [{
+                    'did': result['did'],
+                    'lid': result['lid'],
+                    'roomId': result['room_id'],
+                    'cmd': result['cmd'],
+                    'timestamp': result['timestamp'],
+                    'authorName': result['author_name'],
+                    'content': _decode_content(result['content'])
+                } for result in results],
+                'nextOffset': next_offset if has_more and next_offset <= MAX_SEARCH_OFFSET else None
+            }
+        })
+
+
+# noinspection PyAbstractClass
+class LogAnalyticsHandler(api.base.ApiHandler):
+    async def get(self):
+        """
+        查看日志的统计，只包含已经统计过的日志，参数：
+        type：sessions（每个日志的汇总）、chatters（用户排行）或words（词频）
+        room_id：房间ID
+        start_time、end_time：日志开始时间的范围，Unix时间戳（秒）
+        lid：只看一个日志的词频，只对words有效
+        order_by：用户排行的排序字段，textCount、giftCoinTotal或superChatRevenue，只对chatters有效
+        before_lid：分页，用上一页的nextBeforeLid作为before_lid取下一页，只对sessions有效
+        limit：最多返回的条数
+        """
+        type_ = self.get_query_argument('type', 'sessions')
+        room_id = _get_int_argument(self, 'room_id', None)
+        start_time = _get_int_argument(self, 'start_time', None)
+        end_time = _get_int_argument(self, 'end_time', None)
+        limit = _get_int_argument(self, 'limit', DEFAULT_ANALYTICS_PAGE_SIZE)
+        limit = min(max(limit, 1), MAX_ANALYTICS_PAGE_SIZE)
+        loop = asyncio.get_event_loop()
+
+        if type_ == 'sessions':
+            before_lid = _get_int_argument(self, 'before_lid', None)
+            res = await loop.run_in_executor(
+                None, models.log_analytics.get_session_summaries, room_id, start_time, end_time, before_lid, limit
+            )
+            if res is not None:
+                res = {
+                    'sessions': [{
+                        'lid': summary['lid'],
+                        'roomId': summary['room_id'],
+                        'startTime': summary['start_time'],
+                        'endTime': summary['end_time'],
+                        'totalCount': summary['total_count'],
+                        'textCount': summary['text_count'],
+                        'chatterCount': summary['chatter_count'],
+                        'giftCount': summary['gift_count'],
+                        'giftCoinTotal': summary['gift_coin_total'],
+                        'memberCount': summary['member_count'],
+                        'superChatCount': summary['super_chat_count'],
+                        'superChatRevenue': summary['super_chat_revenue']
+                    } for summary in res],
+                    'nextBeforeLid': res[-1]['lid'] if len(res) == limit else None
+                }
+
+        elif type_ == 'chatters':
+            order_by = _CHATTER_ORDER_FIELDS.get(self.get_query_argument('order_by', 'textCount'), None)
+            if order_by is None:
+                raise tornado.web.HTTPError(400, 'Invalid order_by')
+            res = await loop.run_in_executor(
+                None, models.log_analytics.get_top_chatters, room_id, start_time, end_time, order_by, limit
+            )
+            if res is not None:
+                res = {
+                    'chatters': [{
+                        'uid': chatter['uid'],
+                        'authorName': chatter['author_name'],
+                        'sessionCount': chatter['session_count'],
+                        'textCount': chatter['text_count'],
+                        'giftCoinTotal': chatter['gift_coin_total'],
+                        'superChatRevenue': chatter['super_chat_revenue']
+                    } for chatter in res]
+                }
+
+        elif type_ == 'words':
+            lid = _get_int_argument(self, 'lid', None)
+            res = await loop.run_in_executor(
+                None, models.log_analytics.get_top_words, lid, room_id, start_time, end_time, limit
+            )
+            if res is not None:
+                res = {
+                    'words': [{'word': word, 'count': count} for word, count in res]
+                }
+
+        else:
+            raise tornado.web.HTTPError(400, 'Invalid type')
+
+        if res is None:
+            self.set_status(500, 'Failed to get log analytics')
+            self.write({
+                'code': 500,
+                'msg': 'Failed to get log analytics',
+                'data': None
+            })
+            return
+        self.write({
+            'code': 0,
+            'msg': 'success',
+            'data': res
+        })
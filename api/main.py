@@ -1,16 +1,40 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+from typing import *
+
 import tornado.web
 
 import api.base
 import config
+import metrics
+import models.static_assets
 import update
 
+# 文件名带哈希的文件内容不会变，让浏览器一直缓存
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+_asset_table: Optional[models.static_assets.AssetTable] = None
+
+
+def init(web_root):
+    global _asset_table
+    _asset_table = models.static_assets.AssetTable(web_root)
+    # 读取、压缩比较慢，在线程池中执行，加载完之前从磁盘读
+    asyncio.get_event_loop().run_in_executor(None, _asset_table.load)
+
 
 # noinspection PyAbstractClass
 class MainHandler(tornado.web.StaticFileHandler):
     """为了使用Vue Router的history模式，把不存在的文件请求转发到index.html"""
     async def get(self, path, include_body=True):
+        if _asset_table is not None and _asset_table.is_loaded:
+            asset = _asset_table.get(path)
+            if asset is not None:
+                self._write_asset(asset, include_body)
+                return
+
+        # 还没加载完或者文件太大，从磁盘读
         try:
             await super().get(path, include_body)
         except tornado.web.HTTPError as e:
@@ -19,6 +43,23 @@ class MainHandler(tornado.web.StaticFileHandler):
             # 不存在的文件请求转发到index.html，交给前端路由
             await super().get('index.html', include_body)
 
+    def _write_asset(self, asset: models.static_assets.Asset, include_body):
+        encoding, data, etag = asset.select_encoding(self.request.headers.get('Accept-Encoding', ''))
+        self.set_header('Content-Type', asset.content_type)
+        self.set_header('Etag', etag)
+        self.set_header('Cache-Control', IMMUTABLE_CACHE_CONTROL if asset.immutable else 'no-cache')
+        if asset.has_encodings:
+            self.set_header('Vary', 'Accept-Encoding')
+        if encoding != '':
+            self.set_header('Content-Encoding', encoding)
+
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.set_header('Content-Length', len(data))
+        if include_body:
+            self.write(data)
+
 
 # noinspection PyAbstractClass
 class ServerInfoHandler(api.base.ApiHandler):
@@ -31,3 +72,10 @@ class ServerInfoHandler(api.base.ApiHandler):
                 'loaderUrl': cfg.loader_url
             }
         })
+
+
+# noinspection PyAbstractClass
+class MetricsHandler(api.base.ApiHandler):
+    async def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.render())
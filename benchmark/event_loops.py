@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""
+比较服务器使用asyncio和uvloop事件循环时的扇出性能，每种事件循环各跑一次benchmark/fanout.py的压测
+
+在项目根目录运行：python -m benchmark.event_loops [benchmark/fanout.py的参数]
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+
+import benchmark.fanout as fanout
+
+LOOP_TYPES = ('asyncio', 'uvloop')
+
+
+def main():
+    args = fanout.make_arg_parser('比较asyncio和uvloop事件循环的扇出性能').parse_args()
+    results = asyncio.get_event_loop().run_until_complete(run(args))
+    print_comparison(results)
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+async def run(args):
+    results = {}
+    for loop_type in LOOP_TYPES:
+        loop_args: argparse.Namespace = copy.copy(args)
+        loop_args.server_args = f'{args.server_args} --loop {loop_type}'
+        results[loop_type] = await fanout.run(loop_args)
+    return results
+
+
+def print_comparison(results):
+    def format_value(value, fmt):
+        return 'N/A' if value is None else format(value, fmt)
+
+    rows = [
+        ('throughput (msg/s)', lambda result: result['throughput'], '.1f'),
+        ('lost messages', lambda result: result['lostMessages'], 'd'),
+        ('latency p50 (ms)', lambda result: result['latencyMs']['p50'], '.2f'),
+        ('latency p90 (ms)', lambda result: result['latencyMs']['p90'], '.2f'),
+        ('latency p99 (ms)', lambda result: result['latencyMs']['p99'], '.2f'),
+        ('server CPU (%)', lambda result: result['serverCpuPercent'], '.1f'),
+        ('server RSS (MiB)', lambda result: None if result['serverRssBytes'] is None
+            else result['serverRssBytes'] / 1024 / 1024, '.1f')
+    ]
+    print(f"{'':<20}" + ''.join(f'{loop_type:>12}' for loop_type in results))
+    for name, get_value, fmt in rows:
+        print(f'{name:<20}' + ''.join(
+            f'{format_value(get_value(result), fmt):>12}' for result in results.values()
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+"""
+本地的假B站上游，提供房间信息、用户信息HTTP接口和弹幕服务器websocket，用于压测
+"""
+
+import asyncio
+import json
+import struct
+import time
+import zlib
+from typing import *
+
+import aiohttp.web
+
+HEADER_STRUCT = struct.Struct('>I2H2I')
+WS_BODY_PROTOCOL_VERSION_NORMAL = 0
+WS_BODY_PROTOCOL_VERSION_DEFLATE = 2
+OPERATION_SEND_MSG_REPLY = 5
+
+ROOM_OWNER_UID = 1
+FACE_URL = 'http://i0.hdslb.com/bfs/face/member/noface.jpg'
+
+
+def make_packet(body: bytes, ver, operation):
+    header = HEADER_STRUCT.pack(HEADER_STRUCT.size + len(body), HEADER_STRUCT.size, ver, operation, 1)
+    return header + body
+
+
+def make_command_packet(commands: List[dict], compress=True):
+    """和B站一样，多条命令用zlib压缩打包成一个包"""
+    packets = b''.join(
+        make_packet(json.dumps(command).encode('utf-8'), WS_BODY_PROTOCOL_VERSION_NORMAL,
+                    OPERATION_SEND_MSG_REPLY)
+        for command in commands
+    )
+    if not compress:
+        return packets
+    return make_packet(zlib.compress(packets), WS_BODY_PROTOCOL_VERSION_DEFLATE, OPERATION_SEND_MSG_REPLY)
+
+
+def make_danmaku_command(uid, text, timestamp=None):
+    if timestamp is None:
+        timestamp = int(time.time() * 1000)
+    return {
+        'cmd': 'DANMU_MSG',
+        'info': [
+            [0, 1, 25, 16777215, timestamp, 1600000000, 0, '7c5a3f0e', 0, 0, 0, '', 0, '{}', '{}'],
+            text,
+            [uid, f'user{uid}', 0, 0, 0, 10000, 1, ''],
+            [12, '粉丝牌', '主播', 1000, 6067854, '', 0, 6067854, 6067854, 6067854, 0, 1, ROOM_OWNER_UID],
+            [20, 0, 6406234, '>50000', 0],
+            ['', ''],
+            0,
+            0,
+            None,
+            {'ts': timestamp // 1000, 'ct': '9F0F7E5C'},
+            0,
+            0,
+            None,
+            None,
+            0,
+            210
+        ],
+        'dm_v2': ''
+    }
+
+
+class FakeUpstream:
+    def __init__(self, host='127.0.0.1', port=0):
+        self._host = host
+        self._port = port
+        self._runner: Optional[aiohttp.web.AppRunner] = None
+        self._websockets: List[aiohttp.web.WebSocketResponse] = []
+        self._websocket_connected_event = asyncio.Event()
+
+    @property
+    def base_url(self):
+        return f'http://{self._host}:{self._port}'
+
+    @property
+    def websocket_count(self):
+        return len(self._websockets)
+
+    async def start(self):
+        app = aiohttp.web.Application()
+        app.router.add_get('/xlive/web-room/v1/index/getInfoByRoom', self._on_room_init)
+        app.router.add_get('/xlive/web-room/v1/index/getDanmuInfo', self._on_danmaku_server_conf)
+        app.router.add_get('/x/space/acc/info', self._on_user_info)
+        app.router.add_get('/sub', self._on_websocket)
+        self._runner = aiohttp.web.AppRunner(app)
+        await self._runner.setup()
+        site = aiohttp.web.TCPSite(self._runner, self._host, self._port)
+        await site.start()
+        if self._port == 0:
+            self._port = site._server.sockets[0].getsockname()[1]  # noqa
+
+    async def stop(self):
+        for websocket in self._websockets:
+            await websocket.close()
+        await self._runner.cleanup()
+
+    async def wait_websocket_connected(self):
+        await self._websocket_connected_event.wait()
+
+    async def broadcast(self, packet: bytes):
+        for websocket in self._websockets:
+            await websocket.send_bytes(packet)
+
+    @staticmethod
+    async def _on_room_init(request: aiohttp.web.Request):
+        room_id = int(request.query['room_id'])
+        return aiohttp.web.json_response({
+            'code': 0,
+            'message': '0',
+            'data': {
+                'room_info': {
+                    'room_id': room_id,
+                    'short_id': 0,
+                    'uid': ROOM_OWNER_UID
+                }
+            }
+        })
+
+    async def _on_danmaku_server_conf(self, _request: aiohttp.web.Request):
+        return aiohttp.web.json_response({
+            'code': 0,
+            'message': '0',
+            'data': {
+                'token': '',
+                'host_list': [{'host': self._host, 'port': self._port, 'wss_port': self._port,
+                               'ws_port': self._port}]
+            }
+        })
+
+    @staticmethod
+    async def _on_user_info(request: aiohttp.web.Request):
+        return aiohttp.web.json_response({
+            'code': 0,
+            'message': '0',
+            'data': {
+                'mid': int(request.query['mid']),
+                'face': FACE_URL
+            }
+        })
+
+    async def _on_websocket(self, request: aiohttp.web.Request):
+        websocket = aiohttp.web.WebSocketResponse()
+        await websocket.prepare(request)
+        self._websockets.append(websocket)
+        self._websocket_connected_event.set()
+        try:
+            # 不关心客户端发来的认证包和心跳包
+            async for _ in websocket:
+                pass
+        finally:
+            self._websockets.remove(websocket)
+        return websocket
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+"""
+弹幕扇出压测：启动假上游和blivechat服务器，连接N个客户端，按指定速率发送弹幕，统计吞吐量、延迟、CPU和内存
+
+在项目根目录运行：python -m benchmark.fanout [--clients 50] [--rate 50] [--duration 30] [--output result.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import *
+
+import aiohttp
+
+import benchmark.fake_upstream as fake_upstream
+import update
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+ROOM_ID = 1000
+# 弹幕内容前缀，后面是序号，用来计算延迟
+TEXT_PREFIX = 'bench '
+
+
+def main():
+    args = parse_args()
+    result = asyncio.get_event_loop().run_until_complete(run(args))
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+
+
+def parse_args():
+    return make_arg_parser('弹幕扇出压测').parse_args()
+
+
+def make_arg_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--clients', help='客户端数，默认为50', type=int, default=50)
+    parser.add_argument('--rate', help='每秒弹幕数，默认为50', type=float, default=50)
+    parser.add_argument('--duration', help='发送时间（秒），默认为30', type=float, default=30)
+    parser.add_argument('--warmup', help='预热时间（秒），不计入结果，默认为5', type=float, default=5)
+    parser.add_argument('--batch-size', help='每个包的弹幕数，默认为1', type=int, default=1)
+    parser.add_argument('--uid-count', help='发弹幕的用户数，默认为100', type=int, default=100)
+    parser.add_argument('--server-args', help='传给服务器的其他参数', default='')
+    parser.add_argument('-o', '--output', help='结果JSON的输出路径，默认输出到stdout', default=None)
+    return parser
+
+
+async def run(args):
+    upstream = fake_upstream.FakeUpstream()
+    await upstream.start()
+    port = _get_free_port()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        server_process = subprocess.Popen([
+            sys.executable, '-m', 'benchmark.server',
+            '--upstream', upstream.base_url,
+            '--database-url', 'sqlite:///' + os.path.join(tmp_dir, 'database.db'),
+            '--host', '127.0.0.1', '--port', str(port),
+            *args.server_args.split()
+        ])
+        try:
+            await _wait_port_open(port)
+            async with aiohttp.ClientSession() as session:
+                clients = [Client(session, port) for _ in range(args.clients)]
+                await asyncio.gather(*(client.connect() for client in clients))
+                await upstream.wait_websocket_connected()
+
+                sender = Sender(upstream, args.batch_size, args.uid_count)
+                await sender.send(args.rate, args.warmup)
+                for client in clients:
+                    client.reset()
+
+                process_stats = ProcessStats(server_process.pid)
+                await sender.send(args.rate, args.duration)
+                # 等待最后的消息送达
+                await asyncio.sleep(1)
+                cpu_percent = process_stats.get_cpu_percent()
+                rss_bytes = process_stats.get_rss_bytes()
+
+                for client in clients:
+                    await client.close()
+        finally:
+            server_process.terminate()
+            server_process.wait()
+            await upstream.stop()
+
+    return make_result(args, sender, clients, cpu_percent, rss_bytes)
+
+
+def _get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _wait_port_open(port, timeout=30):
+    end_time = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            if time.monotonic() > end_time:
+                raise
+            await asyncio.sleep(0.1)
+        else:
+            writer.close()
+            return
+
+
+class Sender:
+    def __init__(self, upstream: fake_upstream.FakeUpstream, batch_size, uid_count):
+        self._upstream = upstream
+        self._batch_size = batch_size
+        self._uid_count = uid_count
+        self._seq = 0
+        # 序号 -> 发送时间
+        self.send_times: Dict[int, float] = {}
+
+    async def send(self, rate, duration):
+        self.send_times.clear()
+        interval = self._batch_size / rate
+        start_time = next_time = time.monotonic()
+        while next_time - start_time < duration:
+            commands = []
+            for _ in range(self._batch_size):
+                self._seq += 1
+                commands.append(fake_upstream.make_danmaku_command(
+                    self._seq % self._uid_count + 1, f'{TEXT_PREFIX}{self._seq}'
+                ))
+                self.send_times[self._seq] = time.monotonic()
+            await self._upstream.broadcast(fake_upstream.make_command_packet(commands))
+
+            next_time += interval
+            await asyncio.sleep(max(next_time - time.monotonic(), 0))
+
+
+class Client:
+    def __init__(self, session: aiohttp.ClientSession, port):
+        self._session = session
+        self._port = port
+        self._websocket: Optional[aiohttp.ClientWebSocketResponse] = None
+        self._receive_future: Optional[asyncio.Future] = None
+        # 序号 -> 收到时间
+        self.receive_times: Dict[int, float] = {}
+
+    async def connect(self):
+        self._websocket = await self._session.ws_connect(f'ws://127.0.0.1:{self._port}/api/chat')
+        await self._websocket.send_str(json.dumps({
+            'cmd': 1,
+            'data': {'roomId': ROOM_ID, 'config': {'autoTranslate': False}}
+        }))
+        self._receive_future = asyncio.ensure_future(self._receive_coroutine())
+
+    def reset(self):
+        self.receive_times.clear()
+
+    async def close(self):
+        self._receive_future.cancel()
+        await self._websocket.close()
+
+    async def _receive_coroutine(self):
+        async for message in self._websocket:
+            if message.type != aiohttp.WSMsgType.TEXT:
+                continue
+            receive_time = time.monotonic()
+            body = json.loads(message.data)
+            if body['cmd'] != 2:  # ADD_TEXT
+                continue
+            content: str = body['data'][4]
+            if content.startswith(TEXT_PREFIX):
+                self.receive_times[int(content[len(TEXT_PREFIX):])] = receive_time
+
+
+class ProcessStats:
+    """统计服务器进程从创建这个对象开始的CPU使用率，以及当前RSS"""
+
+    def __init__(self, pid):
+        self._pid = pid
+        self._start_time = time.monotonic()
+        self._start_cpu_time = self._get_cpu_time()
+
+    def get_cpu_percent(self):
+        cpu_time = self._get_cpu_time()
+        if cpu_time is None or self._start_cpu_time is None:
+            return None
+        return (cpu_time - self._start_cpu_time) / (time.monotonic() - self._start_time) * 100
+
+    def _get_cpu_time(self):
+        if psutil is not None:
+            cpu_times = psutil.Process(self._pid).cpu_times()
+            return cpu_times.user + cpu_times.system
+        try:
+            with open(f'/proc/{self._pid}/stat') as f:
+                # 进程名可能有空格，从右括号后面开始分割
+                fields = f.read().rpartition(')')[2].split()
+        except OSError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def get_rss_bytes(self):
+        if psutil is not None:
+            return psutil.Process(self._pid).memory_info().rss
+        try:
+            with open(f'/proc/{self._pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+
+def make_result(args, sender: Sender, clients: List[Client], cpu_percent, rss_bytes):
+    latencies = []
+    for client in clients:
+        for seq, receive_time in client.receive_times.items():
+            send_time = sender.send_times.get(seq, None)
+            if send_time is not None:
+                latencies.append(receive_time - send_time)
+    latencies.sort()
+    expected_count = len(sender.send_times) * len(clients)
+
+    def percentile(ratio):
+        if not latencies:
+            return None
+        return latencies[min(int(len(latencies) * ratio), len(latencies) - 1)] * 1000
+
+    return {
+        'version': update.VERSION,
+        'python': platform.python_version(),
+        'params': {
+            'clients': args.clients,
+            'rate': args.rate,
+            'duration': args.duration,
+            'batchSize': args.batch_size,
+            'uidCount': args.uid_count,
+            'serverArgs': args.server_args
+        },
+        'sentMessages': len(sender.send_times),
+        'deliveredMessages': len(latencies),
+        'lostMessages': expected_count - len(latencies),
+        'throughput': len(latencies) / args.duration,
+        'latencyMs': {
+            'p50': percentile(0.5),
+            'p90': percentile(0.9),
+            'p99': percentile(0.99),
+            'max': latencies[-1] * 1000 if latencies else None
+        },
+        'serverCpuPercent': cpu_percent,
+        'serverRssBytes': rss_bytes
+    }
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""
+比较各JSON实现序列化、反序列化我们的消息的速度
+
+在项目根目录运行：python -m benchmark.json_backends [--payloads benchmark/payloads.json]
+"""
+
+import argparse
+import timeit
+
+import api.chat
+import benchmark.microbench as microbench
+import config
+import serializer
+
+
+def main():
+    args = parse_args()
+    config.init()
+    bodies = make_message_bodies(microbench.load_payloads(args.payloads))
+    print(f'{len(bodies)} messages, available backends: {", ".join(serializer.get_available_backends())}')
+
+    for backend in serializer.get_available_backends():
+        serializer.select_backend(backend)
+        encoded_bodies = [serializer.dumps(body) for body in bodies]
+        size = sum(len(serializer.dumps_bytes(body)) for body in bodies)
+
+        dumps = serializer.dumps
+        dumps_bytes = serializer.dumps_bytes
+        loads = serializer.loads
+        dumps_time = measure(lambda: [dumps(body) for body in bodies], args.repeat)
+        dumps_bytes_time = measure(lambda: [dumps_bytes(body) for body in bodies], args.repeat)
+        loads_time = measure(lambda: [loads(body) for body in encoded_bodies], args.repeat)
+        print(f'{backend:<8} dumps {dumps_time / len(bodies):>8.0f} ns/msg, '
+              f'dumps_bytes {dumps_bytes_time / len(bodies):>8.0f} ns/msg, '
+              f'loads {loads_time / len(bodies):>8.0f} ns/msg, {size / len(bodies):.0f} bytes/msg')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='比较各JSON实现的速度')
+    parser.add_argument('--payloads', help='消息样本文件', default=microbench.DEFAULT_PAYLOADS_PATH)
+    parser.add_argument('--repeat', help='重复次数，取最快的一次，默认为5', type=int, default=5)
+    return parser.parse_args()
+
+
+def make_message_bodies(payloads):
+    """把B站的原始命令转成发给客户端的消息"""
+    bodies = []
+    for command in payloads:
+        cmd = command.get('cmd', '')
+        if cmd == 'DANMU_MSG':
+            data = api.chat.make_text_message(*microbench.make_text_message_args(command))
+            bodies.append({'cmd': api.chat.Command.ADD_TEXT, 'data': data})
+        elif cmd == 'SEND_GIFT':
+            data = command['data']
+            bodies.append({'cmd': api.chat.Command.ADD_GIFT, 'data': {
+                'id': 'f955303491524be88f4a6b85a7ad0cc2',
+                'avatarUrl': data['face'],
+                'timestamp': data['timestamp'],
+                'authorName': data['uname'],
+                'totalCoin': data['total_coin'],
+                'giftName': data['giftName'],
+                'num': data['num']
+            }})
+        elif cmd == 'SUPER_CHAT_MESSAGE':
+            data = command['data']
+            bodies.append({'cmd': api.chat.Command.ADD_SUPER_CHAT, 'data': {
+                'id': str(data['id']),
+                'avatarUrl': data['user_info']['face'],
+                'timestamp': data['start_time'],
+                'authorName': data['user_info']['uname'],
+                'price': data['price'],
+                'content': data['message'],
+                'translation': ''
+            }})
+    return bodies
+
+
+def measure(func, repeat):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e9
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+"""
+每条消息都会执行的热路径函数的微基准测试，可以保存基准线，和基准线比较时性能下降超过阈值则返回非0
+
+在项目根目录运行：
+python -m benchmark.microbench --save-baseline  # 保存基准线
+python -m benchmark.microbench                  # 和基准线比较
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+from typing import *
+
+import api.chat
+import config
+import models.avatar
+import models.command_record
+import models.translate
+
+DEFAULT_PAYLOADS_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'payloads.json')
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'microbench_baseline.json')
+
+# name -> 创建被测函数的函数，被测函数每次调用会处理所有payload
+_benchmarks: Dict[str, Callable[[List[dict]], Callable[[], Any]]] = {}
+
+
+def benchmark(name):
+    def decorator(setup_func):
+        _benchmarks[name] = setup_func
+        return setup_func
+    return decorator
+
+
+def _commands_of(payloads, cmd):
+    return [command for command in payloads if command.get('cmd', '').partition(':')[0] == cmd]
+
+
+def _make_room():
+    room = api.chat.Room(1)
+    # 只测解析，不继续处理
+    room._on_receive_danmaku = room._on_receive_gift = lambda *_args, **_kwargs: None
+    return room
+
+
+@benchmark('Room.__parse_danmaku')
+def _setup_parse_danmaku(payloads):
+    room = _make_room()
+    commands = _commands_of(payloads, 'DANMU_MSG')
+    # noinspection PyProtectedMember
+    parse = api.chat.Room._Room__parse_danmaku
+
+    def run():
+        for command in commands:
+            parse(room, command)
+    return run
+
+
+@benchmark('Room.__parse_gift')
+def _setup_parse_gift(payloads):
+    room = _make_room()
+    commands = _commands_of(payloads, 'SEND_GIFT')
+    # noinspection PyProtectedMember
+    parse = api.chat.Room._Room__parse_gift
+
+    def run():
+        for command in commands:
+            parse(room, command)
+    return run
+
+
+def make_text_message_args(command):
+    info = command['info']
+    return (
+        models.avatar.DEFAULT_AVATAR_URL, info[0][4] // 1000, info[2][1], 0, info[1], info[7], info[0][9],
+        info[4][0], info[2][5] < 10000, info[2][6], info[3][0] if info[3] else 0, 'f955303491524be88f4a6b85a7ad0cc2',
+        ''
+    )
+
+
+@benchmark('make_text_message')
+def _setup_make_text_message(payloads):
+    args_list = [make_text_message_args(command) for command in _commands_of(payloads, 'DANMU_MSG')]
+
+    def run():
+        for args in args_list:
+            api.chat.make_text_message(*args)
+    return run
+
+
+@benchmark('models.translate.need_translate')
+def _setup_need_translate(payloads):
+    texts = [command['info'][1] for command in _commands_of(payloads, 'DANMU_MSG')]
+    texts += [command['data']['message'] for command in _commands_of(payloads, 'SUPER_CHAT_MESSAGE')]
+
+    def run():
+        for text in texts:
+            models.translate.need_translate(text)
+    return run
+
+
+@benchmark('models.avatar.process_avatar_url')
+def _setup_process_avatar_url(payloads):
+    urls = [command['data']['face'] for command in _commands_of(payloads, 'SEND_GIFT')]
+    urls += [command['data']['user_info']['face'] for command in _commands_of(payloads, 'SUPER_CHAT_MESSAGE')]
+
+    def run():
+        for url in urls:
+            models.avatar.process_avatar_url(url)
+    return run
+
+
+@benchmark('Room.send_message serialize')
+def _setup_serialize(payloads):
+    bodies = [
+        {'cmd': api.chat.Command.ADD_TEXT, 'data': api.chat.make_text_message(*make_text_message_args(command))}
+        for command in _commands_of(payloads, 'DANMU_MSG')
+    ]
+
+    def run():
+        for body in bodies:
+            json.dumps(body)
+    return run
+
+
+def main():
+    args = parse_args()
+    config.init()
+    payloads = load_payloads(args.payloads)
+
+    results = {}
+    for name, setup_func in _benchmarks.items():
+        if args.filter is not None and args.filter not in name:
+            continue
+        results[name] = measure(setup_func(payloads), args.repeat)
+        print(f'{name:<40} {results[name]:>12.1f} ns/call')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --save-baseline first')
+        return 0
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    return 1 if compare(results, baseline, args.threshold) else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='热路径函数的微基准测试')
+    parser.add_argument('--payloads', help='消息样本文件，JSON数组，每项是B站的原始命令；也可以是记录的命令文件(.gz)',
+                        default=DEFAULT_PAYLOADS_PATH)
+    parser.add_argument('--baseline', help='基准线文件路径', default=DEFAULT_BASELINE_PATH)
+    parser.add_argument('--save-baseline', help='把这次的结果保存为基准线', action='store_true')
+    parser.add_argument('--threshold', help='允许的性能下降比例，默认为0.2', type=float, default=0.2)
+    parser.add_argument('--repeat', help='重复次数，取最快的一次，默认为5', type=int, default=5)
+    parser.add_argument('-k', '--filter', help='只运行名字包含这个字符串的测试', default=None)
+    return parser.parse_args()
+
+
+def load_payloads(path):
+    if path.endswith('.gz'):
+        return [command for _, command in models.command_record.iter_records(path) if isinstance(command, dict)]
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def measure(func, repeat):
+    """
+    :return: 每次调用的耗时（纳秒），取多次重复中最快的
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e9
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: 是否有性能下降超过阈值的
+    """
+    has_regression = False
+    for name, duration in results.items():
+        baseline_duration = baseline.get(name, None)
+        if baseline_duration is None:
+            continue
+        ratio = duration / baseline_duration - 1
+        if ratio > threshold:
+            has_regression = True
+            print(f'REGRESSION {name}: {baseline_duration:.1f} -> {duration:.1f} ns/call ({ratio:+.1%})')
+        else:
+            print(f'ok         {name}: {baseline_duration:.1f} -> {duration:.1f} ns/call ({ratio:+.1%})')
+    return has_regression
+
+
+if __name__ == '__main__':
+    sys.exit(main())
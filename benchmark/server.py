@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""
+连接假上游运行blivechat服务器，由benchmark/fanout.py启动
+
+在项目根目录运行：python -m benchmark.server --upstream http://127.0.0.1:PORT [main.py的参数]
+"""
+
+import argparse
+import sys
+import webbrowser
+
+import aiohttp
+
+import api.chat
+import blivedm.blivedm as blivedm
+import config
+import main
+import models.avatar
+import update
+
+
+def run():
+    parser = argparse.ArgumentParser(description='连接假上游运行blivechat服务器')
+    parser.add_argument('--upstream', help='假上游的URL', required=True)
+    parser.add_argument('--database-url', help='数据库URL，默认使用配置中的', default=None)
+    args, main_args = parser.parse_known_args()
+    patch(args.upstream, args.database_url)
+
+    sys.argv = [sys.argv[0], *main_args]
+    main.main()
+
+
+def patch(upstream_url, database_url):
+    blivedm.ROOM_INIT_URL = upstream_url + '/xlive/web-room/v1/index/getInfoByRoom'
+    blivedm.DANMAKU_SERVER_CONF_URL = upstream_url + '/xlive/web-room/v1/index/getDanmuInfo'
+    models.avatar.USER_INFO_URL = upstream_url + '/x/space/acc/info'
+
+    # B站弹幕服务器只能用wss连接，这里连接假上游的ws，收到的包还是交给blivedm解析
+    websocket_url = upstream_url.replace('http', 'ws', 1) + '/sub'
+
+    async def network_coroutine(self: api.chat.Room):
+        async with self._session.ws_connect(websocket_url, params={'room_id': self.room_id}) as websocket:
+            async for message in websocket:
+                if message.type == aiohttp.WSMsgType.BINARY:
+                    await self._handle_message(message.data)
+
+    api.chat.Room._network_coroutine = network_coroutine
+
+    original_config_init = config.init
+
+    def config_init():
+        original_config_init()
+        cfg = config.get_config()
+        if database_url is not None:
+            cfg.database_url = database_url
+        # 不压测在线翻译
+        cfg.enable_translate = False
+
+    config.init = config_init
+    update.check_update = lambda: None
+    webbrowser.open = lambda *_args, **_kwargs: True
+
+
+if __name__ == '__main__':
+    run()
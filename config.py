@@ -49,6 +49,27 @@ class AppConfig:
         self.database_url = 'sqlite:///data/database.db'
         self.tornado_xheaders = False
         self.loader_url = ''
+        self.slow_callback_duration = 0
+        self.trace_sample_rate = 0.01
+        self.record_commands_dir = ''
+        self.json_backend = 'auto'
+        self.http_max_concurrency_per_host = 8
+        self.http_dns_cache_ttl = 300
+        self.http_keepalive_timeout = 30.0
+
+        self.room_info_cache_ttl = 86400
+        self.room_info_failure_cache_ttl = 60
+
+        self.log_storage = 'sql'
+        self.log_file_dir = os.path.join('data', 'log_files')
+        self.log_file_fsync_interval = 5.0
+        self.log_retention_days = 0
+        self.log_max_rows_per_room = 0
+        self.log_max_bytes_per_room = 0
+        self.log_retention_interval = 3600
+        self.log_archive_after_days = 0
+        self.log_archive_dir = os.path.join('data', 'log_archive')
+        self.log_analytics_interval = 3600
 
         self.fetch_avatar_interval = 3.5
         self.fetch_avatar_max_queue_size = 2
@@ -57,6 +78,8 @@ class AppConfig:
         self.enable_translate = True
         self.allow_translate_rooms = set()
         self.translation_cache_size = 50000
+        self.translation_cache_key_normalizers = ['fold_width', 'strip_decoration', 'collapse_repeat']
+        self.translation_record_max_rows = 100000
         self.translator_configs = []
 
     def load(self, path):
@@ -76,6 +99,31 @@ class AppConfig:
         self.database_url = app_section['database_url']
         self.tornado_xheaders = app_section.getboolean('tornado_xheaders')
         self.loader_url = app_section['loader_url']
+        self.slow_callback_duration = app_section.getfloat('slow_callback_duration', self.slow_callback_duration)
+        self.trace_sample_rate = app_section.getfloat('trace_sample_rate', self.trace_sample_rate)
+        self.record_commands_dir = app_section.get('record_commands_dir', self.record_commands_dir)
+        self.json_backend = app_section.get('json_backend', self.json_backend)
+        self.http_max_concurrency_per_host = app_section.getint('http_max_concurrency_per_host',
+                                                                self.http_max_concurrency_per_host)
+        self.http_dns_cache_ttl = app_section.getint('http_dns_cache_ttl', self.http_dns_cache_ttl)
+        self.http_keepalive_timeout = app_section.getfloat('http_keepalive_timeout', self.http_keepalive_timeout)
+
+        self.room_info_cache_ttl = app_section.getfloat('room_info_cache_ttl', self.room_info_cache_ttl)
+        self.room_info_failure_cache_ttl = app_section.getfloat('room_info_failure_cache_ttl',
+                                                                self.room_info_failure_cache_ttl)
+
+        self.log_storage = app_section.get('log_storage', self.log_storage)
+        if self.log_storage not in ('sql', 'file'):
+            raise ValueError(f'Invalid log storage: {self.log_storage}')
+        self.log_file_dir = app_section.get('log_file_dir', self.log_file_dir)
+        self.log_file_fsync_interval = app_section.getfloat('log_file_fsync_interval', self.log_file_fsync_interval)
+        self.log_retention_days = app_section.getfloat('log_retention_days', self.log_retention_days)
+        self.log_max_rows_per_room = app_section.getint('log_max_rows_per_room', self.log_max_rows_per_room)
+        self.log_max_bytes_per_room = app_section.getint('log_max_bytes_per_room', self.log_max_bytes_per_room)
+        self.log_retention_interval = app_section.getfloat('log_retention_interval', self.log_retention_interval)
+        self.log_archive_after_days = app_section.getfloat('log_archive_after_days', self.log_archive_after_days)
+        self.log_archive_dir = app_section.get('log_archive_dir', self.log_archive_dir)
+        self.log_analytics_interval = app_section.getfloat('log_analytics_interval', self.log_analytics_interval)
 
         self.fetch_avatar_interval = app_section.getfloat('fetch_avatar_interval')
         self.fetch_avatar_max_queue_size = app_section.getint('fetch_avatar_max_queue_size')
@@ -84,6 +132,15 @@ class AppConfig:
         self.enable_translate = app_section.getboolean('enable_translate')
         self.allow_translate_rooms = _str_to_list(app_section['allow_translate_rooms'], int, set)
         self.translation_cache_size = app_section.getint('translation_cache_size')
+        self.translation_cache_key_normalizers = _str_to_list(app_section.get(
+            'translation_cache_key_normalizers', ','.join(self.translation_cache_key_normalizers)
+        ))
+        for normalizer in self.translation_cache_key_normalizers:
+            if normalizer not in ('fold_width', 'strip_decoration', 'collapse_repeat'):
+                raise ValueError(f'Invalid translation cache key normalizer: {normalizer}')
+        self.translation_record_max_rows = app_section.getint(
+            'translation_record_max_rows', self.translation_record_max_rows
+        )
 
     def _load_translator_configs(self, config):
         app_section = config['app']
@@ -94,9 +151,12 @@ class AppConfig:
             type_ = section['type']
 
             translator_config = {
+                'name': section_name,
                 'type': type_,
                 'query_interval': section.getfloat('query_interval'),
-                'max_queue_size': section.getint('max_queue_size')
+                'max_queue_size': section.getint('max_queue_size'),
+                'burst': section.getint('burst', 1),
+                'max_in_flight': section.getint('max_in_flight', 0)
             }
             if type_ == 'TencentTranslateFree':
                 translator_config['source_language'] = section['source_language']
@@ -114,6 +174,8 @@ class AppConfig:
                 translator_config['target_language'] = section['target_language']
                 translator_config['app_id'] = section['app_id']
                 translator_config['secret'] = section['secret']
+            elif type_ == 'LocalPhraseTable':
+                translator_config['path'] = section['path']
             else:
                 raise ValueError(f'Invalid translator type: {type_}')
 
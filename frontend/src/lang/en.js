@@ -89,6 +89,8 @@ export default {
     createTime: "Created Time",
     actions: "Actions",
     nothing: "Nothing here hahahaha",
+    messageCount: "Messages",
+    loadMore: "Load more",
   },
   stylegen: {
     legacy: "Classic",
@@ -90,6 +90,8 @@ export default {
     createTime: "作成時間",
     actions: "操作",
     nothing: "えええ？何もない_:(´ཀ`」 ∠):",
+    messageCount: "メッセージ数",
+    loadMore: "もっと見る",
   },
   stylegen: {
     legacy: "古典",
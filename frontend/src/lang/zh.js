@@ -89,6 +89,8 @@ export default {
     createTime: "创建时间",
     actions: "操作",
     nothing: "什么也没有捏呜呜呜",
+    messageCount: "消息数",
+    loadMore: "加载更多",
   },
   stylegen: {
     legacy: "经典",
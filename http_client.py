@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+所有对外HTTP请求共用的客户端
+
+共用一个连接池和DNS缓存，限制每个host同时进行的请求数，统计请求延迟和错误
+"""
+
+import asyncio
+import collections
+import contextlib
+import time
+import types
+import urllib.parse
+from typing import *
+
+import aiohttp
+
+import config
+import metrics
+
+DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+# 所有模块共用的session，websocket等长连接也直接用它
+session: Optional[aiohttp.ClientSession] = None
+# host -> 限制并发的信号量
+_host_semaphores: Dict[str, asyncio.Semaphore] = {}
+# host -> 正在进行的请求数
+_host_in_flight_counts: Counter[str] = collections.Counter()
+
+_request_duration_histogram = metrics.Histogram(
+    'blivechat_http_client_request_duration_seconds', 'Time spent on outbound HTTP requests until response headers',
+    ('host',)
+)
+_response_counter = metrics.Counter(
+    'blivechat_http_client_responses_total', 'Number of outbound HTTP responses', ('host', 'status')
+)
+_error_counter = metrics.Counter(
+    'blivechat_http_client_errors_total', 'Number of outbound HTTP requests failed without response', ('host', 'error')
+)
+metrics.Gauge('blivechat_http_client_in_flight_requests', 'Number of outbound HTTP requests in progress', ('host',),
+              collect_func=lambda: [((host,), count) for host, count in _host_in_flight_counts.items()])
+
+
+def init(session_: Optional[aiohttp.ClientSession] = None):
+    """
+    :param session_: 如果不为None则使用这个session，比如测试时换成连接本地假服务器的session
+    """
+    global session
+    session = session_ if session_ is not None else create_session()
+    _host_semaphores.clear()
+    _host_in_flight_counts.clear()
+
+
+def create_session():
+    cfg = config.get_config()
+    connector = aiohttp.TCPConnector(
+        # 房间的websocket是长连接，总连接数不限制，普通请求的并发由每个host的信号量限制
+        limit=0,
+        ttl_dns_cache=cfg.http_dns_cache_ttl,
+        keepalive_timeout=cfg.http_keepalive_timeout
+    )
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_request_end.append(_on_request_end)
+    trace_config.on_request_exception.append(_on_request_exception)
+    return aiohttp.ClientSession(connector=connector, timeout=DEFAULT_TIMEOUT, trace_configs=[trace_config])
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+@contextlib.asynccontextmanager
+async def request(method, url, **kwargs):
+    """和session.request用法一样，但是会先等待这个host的并发名额"""
+    host = urllib.parse.urlsplit(url).hostname or ''
+    async with _get_host_semaphore(host):
+        _host_in_flight_counts[host] += 1
+        try:
+            async with session.request(method, url, **kwargs) as r:
+                yield r
+        finally:
+            _host_in_flight_counts[host] -= 1
+
+
+def _get_host_semaphore(host):
+    semaphore = _host_semaphores.get(host, None)
+    if semaphore is None:
+        cfg = config.get_config()
+        _host_semaphores[host] = semaphore = asyncio.Semaphore(cfg.http_max_concurrency_per_host)
+    return semaphore
+
+
+async def _on_request_start(_session, trace_config_ctx: types.SimpleNamespace, _params):
+    trace_config_ctx.start_time = time.perf_counter()
+
+
+async def _on_request_end(_session, trace_config_ctx: types.SimpleNamespace, params: aiohttp.TraceRequestEndParams):
+    host = params.url.host or ''
+    _request_duration_histogram.labels(host).observe(time.perf_counter() - trace_config_ctx.start_time)
+    _response_counter.labels(host, str(params.response.status)).inc()
+
+
+async def _on_request_exception(_session, _trace_config_ctx,
+                                params: aiohttp.TraceRequestExceptionParams):
+    _error_counter.labels(params.url.host or '', type(params.exception).__name__).inc()
@@ -1,21 +1,24 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import asyncio
+import importlib
 import logging
 import logging.handlers
 import os
+import signal
+import time
 import webbrowser
+from typing import *
 
+_START_TIME = time.perf_counter()
+
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.web
 
-import api.chat
-import api.main
-import api.log
 import config
-import models.avatar
-import models.database
-import models.translate
 import update
 
 logger = logging.getLogger(__name__)
@@ -24,30 +27,98 @@ BASE_PATH = os.path.dirname(os.path.realpath(__file__))
 WEB_ROOT = os.path.join(BASE_PATH, 'frontend', 'dist')
 LOG_FILE_NAME = os.path.join(BASE_PATH, 'log', 'blivechat.log')
 
+# 监听端口之后才导入的模块，按顺序导入，方便统计耗时
+LAZY_IMPORT_MODULES = (
+    'aiohttp',
+    'sqlalchemy',
+    'http_client',
+    'serializer',
+    'monitor',
+    'models.database',
+    'models.avatar',
+    'models.translate',
+    'models.log_storage',
+    'models.log_archive',
+    'models.log',
+    'models.log_retention',
+    'models.log_analytics',
+    'models.room_stats',
+    'api.chat',
+    'api.log',
+    'api.debug',
+    'api.main'
+)
+# 启动后多久检查更新（秒）
+UPDATE_CHECK_DELAY = 10
+
+# handler用字符串指定，创建Application时才导入
 routes = [
-    (r'/api/server_info', api.main.ServerInfoHandler),
-    (r'/api/chat', api.chat.ChatHandler),
-    (r'/api/room_info', api.chat.RoomInfoHandler),
-    (r'/api/avatar_url', api.chat.AvatarHandler),
-    (r'/api/reply', api.chat.ReplyHandler),
-    (r'/api/log', api.log.LogHandler),
-
-    (r'/(.*)', api.main.MainHandler, {'path': WEB_ROOT, 'default_filename': 'index.html'})
+    (r'/api/server_info', 'api.main.ServerInfoHandler'),
+    (r'/api/metrics', 'api.main.MetricsHandler'),
+    (r'/api/chat', 'api.chat.ChatHandler'),
+    (r'/api/room_info', 'api.chat.RoomInfoHandler'),
+    (r'/api/avatar_url', 'api.chat.AvatarHandler'),
+    (r'/api/reply', 'api.chat.ReplyHandler'),
+    (r'/api/stats', 'api.chat.StatsHandler'),
+    (r'/api/log', 'api.log.LogHandler'),
+    (r'/api/log/search', 'api.log.LogSearchHandler'),
+    (r'/api/log/analytics', 'api.log.LogAnalyticsHandler'),
+    (r'/api/debug/profile', 'api.debug.ProfileHandler'),
+    (r'/api/debug/slow_callbacks', 'api.debug.SlowCallbacksHandler'),
+    (r'/api/debug/trace', 'api.debug.TraceHandler'),
+    (r'/api/debug/trace_stats', 'api.debug.TraceStatsHandler'),
+
+    (r'/(.*)', 'api.main.MainHandler', {'path': WEB_ROOT, 'default_filename': 'index.html'})
 ]
 
 
 def main():
     args = parse_args()
+    startup_timer = StartupTimer(args.startup_profile)
+    startup_timer.mark('import main')
 
     init_logging(args.debug)
+    init_event_loop(args.loop)
     config.init()
-    models.database.init(args.debug)
+    startup_timer.mark('init config')
+
+    # 先监听端口，连接可以先进入backlog，端口被占用时也不用等初始化完
+    sockets = bind_sockets(args.host, args.port)
+    if sockets is None:
+        return
+    startup_timer.mark('bind')
+
+    for module_name in LAZY_IMPORT_MODULES:
+        importlib.import_module(module_name)
+        startup_timer.mark('import ' + module_name)
+
+    import api.chat
+    import api.main
+    import http_client
+    import models.avatar
+    import models.database
+    import models.log
+    import models.translate
+    import monitor
+    import serializer
+    serializer.init()
+    monitor.init()
+    http_client.init()
+    # 建表放到事件循环启动后在线程池里做
+    models.database.init(args.debug, defer_create_tables=True)
+    if models.database.get_schema_version() < models.database.get_latest_version():
+        # 迁移完成之前写弹幕日志会失败，所以有未执行的迁移时要在处理请求之前执行
+        logger.info('Database needs migration, migrating before serving requests')
+        models.database.create_tables()
+        startup_timer.mark('migrate database')
+    models.log.init()
     models.avatar.init()
     models.translate.init()
     api.chat.init()
-    update.check_update()
+    api.main.init(WEB_ROOT)
+    startup_timer.mark('init modules')
 
-    run_server(args.host, args.port, args.debug)
+    run_server(sockets, args.host, args.port, args.debug, startup_timer)
 
 
 def parse_args():
@@ -55,9 +126,42 @@ def parse_args():
     parser.add_argument('--host', help='服务器host，默认为127.0.0.1', default='127.0.0.1')
     parser.add_argument('--port', help='服务器端口，默认为12450', type=int, default=12450)
     parser.add_argument('--debug', help='调试模式', action='store_true')
+    parser.add_argument('--loop', help='事件循环实现，默认为asyncio', choices=('asyncio', 'uvloop'),
+                        default='asyncio')
+    parser.add_argument('--startup-profile', help='打印启动各阶段的耗时', action='store_true')
     return parser.parse_args()
 
 
+class StartupTimer:
+    """记录启动各阶段的耗时"""
+
+    def __init__(self, enabled):
+        self._enabled = enabled
+        self._last_time = _START_TIME
+        # (阶段名, 耗时)
+        self._records: List[Tuple[str, float]] = []
+
+    def mark(self, stage_name):
+        """记录从上一次mark到现在的耗时"""
+        now = time.perf_counter()
+        self._records.append((stage_name, now - self._last_time))
+        self._last_time = now
+
+    def add(self, stage_name, duration):
+        """记录不在主流程里的阶段，比如放到后台的初始化"""
+        self._records.append((stage_name, duration))
+
+    def print(self):
+        if not self._enabled:
+            return
+        print('---------------------------------------------')
+        print('Startup profile:')
+        for stage_name, duration in self._records:
+            print(f'{duration * 1000:10.1f} ms  {stage_name}')
+        print(f'{(self._last_time - _START_TIME) * 1000:10.1f} ms  total until serving')
+        print('---------------------------------------------')
+
+
 def init_logging(debug):
     stream_handler = logging.StreamHandler()
     file_handler = logging.handlers.TimedRotatingFileHandler(
@@ -76,30 +180,85 @@ def init_logging(debug):
     logging.getLogger('tornado.access').setLevel(logging.WARNING)
 
 
-def run_server(host, port, debug):
-    app = tornado.web.Application(
-        routes,
-        websocket_ping_interval=10,
-        debug=debug,
-        autoreload=False
-    )
-    cfg = config.get_config()
+def init_event_loop(loop_type):
+    """创建主线程的事件循环，必须在第一次调用asyncio.get_event_loop()之前调用"""
+    loop = None
+    if loop_type == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            logger.warning('uvloop is not installed, fall back to asyncio')
+        else:
+            loop = uvloop.new_event_loop()
+    if loop is None:
+        loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    logger.info('Using event loop %s', type(loop).__name__)
+
+
+def bind_sockets(host, port):
     try:
-        app.listen(
-            port,
-            host,
-            xheaders=cfg.tornado_xheaders
-        )
+        return tornado.netutil.bind_sockets(port, host)
     except OSError:
         logger.warning('Address is used %s:%d', host, port)
-        return
+        return None
     finally:
         url = f'http://{host}/' if port == 80 else f'http://{host}:{port}/'
         # 防止更新版本后浏览器加载缓存
         url += '?_v=' + update.DOODLEBEAR_VERSION
         webbrowser.open(url)
+
+
+def run_server(sockets, host, port, debug, startup_timer: 'StartupTimer'):
+    app = tornado.web.Application(
+        routes,
+        websocket_ping_interval=10,
+        debug=debug,
+        autoreload=False
+    )
+    cfg = config.get_config()
+    server = tornado.httpserver.HTTPServer(app, xheaders=cfg.tornado_xheaders)
+    server.add_sockets(sockets)
+    startup_timer.mark('create application')
+
+    io_loop = tornado.ioloop.IOLoop.current()
+    io_loop.add_callback(_on_server_started, host, port, startup_timer)
+    # docker等用SIGTERM停止时也要保存数据
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: io_loop.add_callback_from_signal(io_loop.stop))
+    try:
+        io_loop.start()
+    except KeyboardInterrupt:
+        pass
+    _on_server_stopped()
+
+
+async def _on_server_started(host, port, startup_timer: 'StartupTimer'):
+    startup_timer.mark('start event loop')
     logger.info('Server started: %s:%d', host, port)
-    tornado.ioloop.IOLoop.current().start()
+    tornado.ioloop.IOLoop.current().call_later(UPDATE_CHECK_DELAY, update.check_update)
+
+    import models.database
+    start_time = time.perf_counter()
+    await asyncio.get_event_loop().run_in_executor(None, models.database.create_tables)
+    startup_timer.add('create tables (deferred)', time.perf_counter() - start_time)
+    startup_timer.print()
+
+    import models.log_retention
+    models.log_retention.init()
+    import models.log_analytics
+    models.log_analytics.init()
+
+    # 给旧的弹幕填充新加的列、建立全文索引，数据多时比较慢，不影响服务
+    import models.log
+    await asyncio.get_event_loop().run_in_executor(None, models.log.backfill_typed_columns)
+    await asyncio.get_event_loop().run_in_executor(None, models.log.backfill_search_index)
+
+
+def _on_server_stopped():
+    """事件循环停止后保存还在内存里的数据"""
+    logger.info('Server stopped')
+    import api.chat
+    api.chat.shutdown()
 
 
 if __name__ == '__main__':
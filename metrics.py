@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""
+Prometheus文本格式的监控指标
+
+指标在模块导入时创建，热路径上只有加法和bisect，没有锁。带标签的指标应该提前用labels()取出子指标保存起来，
+不要每次记录都查一遍
+"""
+
+import bisect
+import logging
+import math
+from typing import *
+
+logger = logging.getLogger(__name__)
+
+# 默认的耗时直方图分桶（秒）
+DEFAULT_DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_metrics: List['_Metric'] = []
+
+
+def render():
+    """
+    :return: Prometheus文本格式的所有指标
+    """
+    lines = []
+    for metric in _metrics:
+        try:
+            metric.render(lines)
+        except Exception:  # noqa
+            logger.exception('Failed to render metric %s:', metric.name)
+    lines.append('')
+    return '\n'.join(lines)
+
+
+class _Metric:
+    type_ = ''
+
+    def __init__(self, name, help_, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help_
+        self.label_names = tuple(label_names)
+        # label values -> 子指标
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        _metrics.append(self)
+
+    def labels(self, *label_values):
+        label_values = tuple(str(value) for value in label_values)
+        child = self._children.get(label_values, None)
+        if child is None:
+            if len(label_values) != len(self.label_names):
+                raise ValueError(f'{self.name} expects labels {self.label_names}, got {label_values}')
+            self._children[label_values] = child = self._create_child()
+        return child
+
+    def _create_child(self):
+        raise NotImplementedError
+
+    def render(self, lines: List[str]):
+        lines.append(f'# HELP {self.name} {self.help}')
+        lines.append(f'# TYPE {self.name} {self.type_}')
+        for label_values, child in self._iter_children():
+            self._render_child(lines, label_values, child)
+
+    def _iter_children(self):
+        return self._children.items()
+
+    def _render_child(self, lines: List[str], label_values: Tuple[str, ...], child):
+        raise NotImplementedError
+
+    def _format_labels(self, label_values, extra_labels: Sequence[Tuple[str, str]] = ()):
+        pairs = list(zip(self.label_names, label_values))
+        pairs.extend(extra_labels)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + '}'
+
+
+def _escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    type_ = 'counter'
+
+    def __init__(self, name, help_, label_names: Sequence[str] = ()):
+        super().__init__(name, help_, label_names)
+        if not self.label_names:
+            self._default_child = self.labels()
+
+    def inc(self, amount=1):
+        self._default_child.value += amount
+
+    def _create_child(self):
+        return _CounterChild()
+
+    def _render_child(self, lines, label_values, child: _CounterChild):
+        lines.append(f'{self.name}{self._format_labels(label_values)} {_format_value(child.value)}')
+
+
+class _GaugeChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Gauge(_Metric):
+    """
+    可以直接设置值，也可以传入collect_func，在导出时才取值
+
+    :param collect_func: 返回[(label values, value)]，没有标签时label values为()
+    """
+    type_ = 'gauge'
+
+    def __init__(self, name, help_, label_names: Sequence[str] = (),
+                 collect_func: Callable[[], Iterable[Tuple[Sequence, float]]] = None):
+        super().__init__(name, help_, label_names)
+        self._collect_func = collect_func
+        if not self.label_names and collect_func is None:
+            self._default_child = self.labels()
+
+    def set(self, value):
+        self._default_child.value = value
+
+    def _create_child(self):
+        return _GaugeChild()
+
+    def _iter_children(self):
+        if self._collect_func is None:
+            return self._children.items()
+        children = []
+        for label_values, value in self._collect_func():
+            child = _GaugeChild()
+            child.value = value
+            children.append((tuple(str(v) for v in label_values), child))
+        return children
+
+    def _render_child(self, lines, label_values, child: _GaugeChild):
+        lines.append(f'{self.name}{self._format_labels(label_values)} {_format_value(child.value)}')
+
+
+class _HistogramChild:
+    __slots__ = ('_upper_bounds', 'bucket_counts', 'sum', 'count')
+
+    def __init__(self, upper_bounds):
+        self._upper_bounds = upper_bounds
+        # 每个桶单独计数，导出时再累加
+        self.bucket_counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self._upper_bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    type_ = 'histogram'
+
+    def __init__(self, name, help_, label_names: Sequence[str] = (), buckets=DEFAULT_DURATION_BUCKETS):
+        self._upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, help_, label_names)
+        if not self.label_names:
+            self._default_child = self.labels()
+
+    def observe(self, value):
+        self._default_child.observe(value)
+
+    def _create_child(self):
+        return _HistogramChild(self._upper_bounds)
+
+    def _render_child(self, lines, label_values, child: _HistogramChild):
+        cumulative_count = 0
+        for upper_bound, bucket_count in zip(self._upper_bounds + (math.inf,), child.bucket_counts):
+            cumulative_count += bucket_count
+            bucket_labels = self._format_labels(label_values, [('le', _format_value(upper_bound))])
+            lines.append(f'{self.name}_bucket{bucket_labels} {cumulative_count}')
+        labels = self._format_labels(label_values)
+        lines.append(f'{self.name}_sum{labels} {_format_value(child.sum)}')
+        lines.append(f'{self.name}_count{labels} {child.count}')
@@ -11,15 +11,18 @@ import sqlalchemy
 import sqlalchemy.exc
 
 import config
+import http_client
+import metrics
 import models.database
 
 logger = logging.getLogger(__name__)
 
 
 DEFAULT_AVATAR_URL = '//static.hdslb.com/images/member/noface.gif'
+USER_INFO_URL = 'https://api.bilibili.com/x/space/acc/info'
 
-_main_event_loop = asyncio.get_event_loop()
-_http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+# 事件循环在init里获取，因为main.py可能先要切换事件循环实现
+_main_event_loop: Optional[asyncio.AbstractEventLoop] = None
 # user_id -> avatar_url
 _avatar_url_cache: Dict[int, str] = {}
 # 正在获取头像的Future，user_id -> Future
@@ -29,10 +32,24 @@ _uid_queue_to_fetch: Optional[asyncio.Queue] = None
 # 上次被B站ban时间
 _last_fetch_banned_time: Optional[datetime.datetime] = None
 
+_avatar_request_counter = metrics.Counter(
+    'blivechat_avatar_requests_total', 'Number of avatar lookups by where the result came from', ('source',)
+)
+_avatar_memory_hit_counter = _avatar_request_counter.labels('memory')
+_avatar_database_hit_counter = _avatar_request_counter.labels('database')
+_avatar_web_hit_counter = _avatar_request_counter.labels('web')
+_avatar_miss_counter = _avatar_request_counter.labels('none')
+metrics.Gauge('blivechat_avatar_fetch_queue_size', 'Number of user IDs waiting to fetch avatar from web',
+              collect_func=lambda: [((), 0 if _uid_queue_to_fetch is None else _uid_queue_to_fetch.qsize())])
+metrics.Gauge('blivechat_avatar_cache_size', 'Number of avatar URLs cached in memory',
+              collect_func=lambda: [((), len(_avatar_url_cache))])
+
 
 def init():
+    global _main_event_loop, _uid_queue_to_fetch
+    _main_event_loop = asyncio.get_event_loop()
+
     cfg = config.get_config()
-    global _uid_queue_to_fetch
     _uid_queue_to_fetch = asyncio.Queue(cfg.fetch_avatar_max_queue_size)
     asyncio.ensure_future(_get_avatar_url_from_web_consumer())
 
@@ -47,11 +64,18 @@ async def get_avatar_url(user_id):
 async def get_avatar_url_or_none(user_id):
     avatar_url = get_avatar_url_from_memory(user_id)
     if avatar_url is not None:
+        _avatar_memory_hit_counter.inc()
         return avatar_url
     avatar_url = await get_avatar_url_from_database(user_id)
     if avatar_url is not None:
+        _avatar_database_hit_counter.inc()
         return avatar_url
-    return await get_avatar_url_from_web(user_id)
+    avatar_url = await get_avatar_url_from_web(user_id)
+    if avatar_url is not None:
+        _avatar_web_hit_counter.inc()
+    else:
+        _avatar_miss_counter.inc()
+    return avatar_url
 
 
 def get_avatar_url_from_memory(user_id):
@@ -145,8 +169,7 @@ async def _get_avatar_url_from_web_coroutine(user_id, future):
 
 async def _do_get_avatar_url_from_web(user_id):
     try:
-        async with _http_session.get('https://api.bilibili.com/x/space/acc/info',
-                                     params={'mid': user_id}) as r:
+        async with http_client.get(USER_INFO_URL, params={'mid': user_id}) as r:
             if r.status != 200:
                 logger.warning('Failed to fetch avatar: status=%d %s uid=%d', r.status, r.reason, user_id)
                 if r.status == 412:
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""
+记录和回放B站弹幕服务器发来的原始命令
+
+文件是gzip压缩的NDJSON，第一行是文件头，之后每行是一条命令：
+{"version": 1, "roomId": 房间ID, "roomOwnerUid": 主播UID, "startTime": 开始时间}
+{"t": 收到时间, "command": 原始命令}
+"""
+
+import asyncio
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from typing import *
+
+logger = logging.getLogger(__name__)
+
+FILE_VERSION = 1
+# 至少隔多久flush一次（秒），flush后进程崩溃也能读出之前的记录
+FLUSH_INTERVAL = 5
+# gzip压缩级别，记录的命令很多，用较低的级别减少CPU占用
+COMPRESS_LEVEL = 3
+
+
+def make_record_path(record_dir, room_id):
+    return os.path.join(record_dir, f"{room_id}-{time.strftime('%Y-%m-%d-%H-%M-%S')}.ndjson.gz")
+
+
+class CommandRecorder:
+    """命令先缓存在内存里，每隔FLUSH_INTERVAL在线程池中压缩、写入文件，不在事件循环里做压缩和磁盘IO"""
+
+    def __init__(self, path, room_id, room_owner_uid):
+        self._path = path
+        # 追加模式打开，已有内容时会追加一个新的gzip member，仍然可以连续读出
+        self._file = gzip.open(path, 'at', encoding='utf-8', compresslevel=COMPRESS_LEVEL)
+        # 还没写入文件的行
+        self._lines: List[str] = []
+        # 保护_lines，在事件循环线程添加，在线程池取出
+        self._lines_lock = threading.Lock()
+        # 保护_file，同时只有一个线程写入，取出_lines时也要持有，保证按顺序写入
+        self._file_lock = threading.Lock()
+        self._last_flush_time = time.monotonic()
+        self._write_line({
+            'version': FILE_VERSION,
+            'roomId': room_id,
+            'roomOwnerUid': room_owner_uid,
+            'startTime': time.time()
+        })
+
+    @property
+    def path(self):
+        return self._path
+
+    def write(self, command):
+        self._write_line({'t': time.time(), 'command': command})
+
+    def _write_line(self, obj):
+        line = json.dumps(obj, ensure_ascii=False) + '\n'
+        with self._lines_lock:
+            self._lines.append(line)
+        cur_time = time.monotonic()
+        if cur_time - self._last_flush_time >= FLUSH_INTERVAL:
+            self._last_flush_time = cur_time
+            asyncio.get_event_loop().run_in_executor(None, self._flush)
+
+    def close(self, wait=False):
+        """
+        :param wait: 为True时在当前线程写入剩下的命令，用于事件循环已经停止的时候
+        """
+        if wait:
+            self._flush(True)
+        else:
+            asyncio.get_event_loop().run_in_executor(None, self._flush, True)
+
+    def _flush(self, close=False):
+        with self._file_lock:
+            with self._lines_lock:
+                lines, self._lines = self._lines, []
+            if self._file.closed:
+                return
+            try:
+                self._file.writelines(lines)
+                self._file.flush()
+                if close:
+                    self._file.close()
+            except (OSError, ValueError):
+                logger.exception('Failed to write command record %s:', self._path)
+
+
+def read_header(path) -> dict:
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.loads(f.readline())
+
+
+def iter_records(path) -> Iterator[Tuple[float, dict]]:
+    """
+    :return: (收到时间, 原始命令)的迭代器
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                obj = json.loads(line)
+                if 'command' in obj:
+                    yield obj['t'], obj['command']
+        except EOFError:
+            # 没有正常关闭的文件，最后一段不完整
+            logger.warning('%s is truncated', path)
+
+
+async def replay(handle_command: Callable[[dict], Awaitable], path, speed: Optional[float] = 1.0):
+    """
+    按记录的时间间隔回放命令
+
+    :param handle_command: 处理命令的函数，一般是Room._handle_command
+    :param path: 记录文件路径
+    :param speed: 回放倍速，None表示不等待，尽快回放
+    :return: 回放的命令数
+    """
+    count = 0
+    first_record_time = None
+    start_time = time.monotonic()
+    for record_time, command in iter_records(path):
+        if speed is not None:
+            if first_record_time is None:
+                first_record_time = record_time
+            delay = (record_time - first_record_time) / speed - (time.monotonic() - start_time)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        try:
+            await handle_command(command)
+        except Exception:  # noqa
+            logger.exception('Failed to replay command: %s', command)
+        count += 1
+    return count
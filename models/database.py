@@ -1,26 +1,138 @@
 # -*- coding: utf-8 -*-
 
+import collections
 import contextlib
+import logging
 from typing import *
 
+import sqlalchemy.exc
 import sqlalchemy.ext.declarative
 import sqlalchemy.orm
 
 import config
 
+logger = logging.getLogger(__name__)
+
 OrmBase = sqlalchemy.ext.declarative.declarative_base()
 engine = None
 DbSession: Optional[Type[sqlalchemy.orm.Session]] = None
 
+# upgrade(connection)在一个事务中执行，要能重复执行，因为有的数据库不支持事务中的DDL
+Migration = collections.namedtuple('Migration', ('version', 'description', 'upgrade'))
+
+# 版本 -> Migration
+_migrations: Dict[int, Migration] = {}
+
 
-def init(_debug):
+class SchemaInfo(OrmBase):
+    """数据库元信息，包括表结构版本和迁移进度"""
+    __tablename__ = 'schema_info'
+    key = sqlalchemy.Column(sqlalchemy.String(64), primary_key=True)
+    value = sqlalchemy.Column(sqlalchemy.Text)
+
+
+def init(_debug, defer_create_tables=False):
+    """
+    :param defer_create_tables: 为True时不马上建表，调用者要自己在之后调用create_tables
+    """
     cfg = config.get_config()
     global engine, DbSession
     # engine = sqlalchemy.create_engine(cfg.database_url, echo=debug)
     engine = sqlalchemy.create_engine(cfg.database_url)
     DbSession = sqlalchemy.orm.sessionmaker(bind=engine)
 
+    if not defer_create_tables:
+        create_tables()
+
+
+def create_tables():
+    """创建不存在的表，再执行未执行的迁移"""
     OrmBase.metadata.create_all(engine)
+    with engine.begin() as connection:
+        if get_schema_info(connection, 'version') is None:
+            # 新建的数据库或者加入迁移之前创建的数据库。新建的ORM表已经是最新的结构，但是迁移里还可能创建
+            # 不是ORM的表（比如全文索引），所以都从头执行一遍，迁移是可以重复执行的
+            set_schema_info(connection, 'version', 0)
+    migrate()
+
+
+def migration(version, description):
+    """注册一个迁移的装饰器，版本号从1开始"""
+    def decorator(upgrade):
+        if version in _migrations:
+            raise ValueError(f'Duplicate migration version {version}')
+        _migrations[version] = Migration(version, description, upgrade)
+        return upgrade
+    return decorator
+
+
+def get_latest_version():
+    return max(_migrations, default=0)
+
+
+def get_schema_version():
+    try:
+        with engine.connect() as connection:
+            return int(get_schema_info(connection, 'version', 0))
+    except sqlalchemy.exc.OperationalError:
+        # 还没有schema_info表
+        return 0
+
+
+def migrate():
+    """按版本顺序执行未执行的迁移，每个迁移一个事务，中断后再次执行会从中断的迁移继续"""
+    with engine.connect() as connection:
+        version = int(get_schema_info(connection, 'version', 0))
+        for migration_ in sorted(_migrations.values()):
+            if migration_.version <= version:
+                continue
+            logger.info('Migrating database to version %d: %s', migration_.version, migration_.description)
+            with connection.begin():
+                migration_.upgrade(connection)
+                set_schema_info(connection, 'version', migration_.version)
+
+
+def get_schema_info(connection, key, default=None):
+    """
+    :param connection: Connection或Session
+    """
+    table = SchemaInfo.__table__
+    value = connection.execute(
+        sqlalchemy.select([table.c.value]).where(table.c.key == key)
+    ).scalar()
+    return default if value is None else value
+
+
+def set_schema_info(connection, key, value):
+    """
+    :param connection: Connection或Session
+    """
+    table = SchemaInfo.__table__
+    res = connection.execute(table.update().where(table.c.key == key).values(value=str(value)))
+    if res.rowcount == 0:
+        connection.execute(table.insert().values(key=key, value=str(value)))
+
+
+def add_columns(connection, table: sqlalchemy.Table, column_names: Iterable[str]):
+    """给已有的表添加模型中定义的列，已经存在的列会跳过"""
+    existing_column_names = {column['name'] for column in sqlalchemy.inspect(connection).get_columns(table.name)}
+    preparer = connection.dialect.identifier_preparer
+    for column_name in column_names:
+        if column_name in existing_column_names:
+            continue
+        column = table.c[column_name]
+        connection.execute(
+            f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} '
+            f'{column.type.compile(dialect=connection.dialect)}'
+        )
+
+
+def create_indexes(connection, table: sqlalchemy.Table):
+    """给已有的表创建模型中定义的索引，已经存在的索引会跳过"""
+    existing_index_names = {index['name'] for index in sqlalchemy.inspect(connection).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in existing_index_names:
+            index.create(connection)
 
 
 @contextlib.contextmanager
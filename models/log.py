@@ -1,6 +1,5 @@
 import asyncio
 import datetime
-import json
 import logging
 import re
 import time
@@ -12,11 +11,50 @@ import sqlalchemy
 import sqlalchemy.exc
 from sqlalchemy.sql import func
 import config
+import metrics
 import models.database
+import models.log_archive
+import models.log_storage
+import models.room_stats
+import serializer
 
 logger = logging.getLogger(__name__)
 
+# 回填类型化的列时每批处理的弹幕数
+BACKFILL_BATCH_SIZE = 500
+# 回填进度保存在schema_info表中的key
+_BACKFILL_PROGRESS_KEY = 'danmaku_backfill_did'
+# 回填时数据库被锁，连续重试的最大次数
+BACKFILL_MAX_LOCK_RETRIES = 60
+# 删除弹幕时每个事务删除的弹幕数，每批之间释放锁，不长时间阻塞写入
+DELETE_BATCH_SIZE = 1000
+# 删除每批之间的间隔（秒）
+DELETE_BATCH_INTERVAL = 0.01
+# 每次最多统计多少个加入计数之前创建的日志的弹幕数和字节数
+USAGE_BACKFILL_BATCH_SIZE = 100
+# 全文索引回填进度、回填结束的did、使用的分词器保存在schema_info表中的key
+_SEARCH_INDEX_PROGRESS_KEY = 'danmaku_fts_did'
+_SEARCH_INDEX_END_KEY = 'danmaku_fts_end_did'
+_SEARCH_TOKENIZER_KEY = 'danmaku_fts_tokenizer'
+# 以下cmd和api.chat.Command一致
+_CMD_ADD_TEXT = 2
+_CMD_ADD_GIFT = 3
+_CMD_ADD_MEMBER = 4
+_CMD_ADD_SUPER_CHAT = 5
+# 无法解析的内容
+_CMD_UNKNOWN = 0
+
 _room_log_mapper = {}
+# 新建的日志使用的存储后端
+_storage_name = 'sql'
+# lid -> 日志的存储后端名，日志的存储后端不会变
+_lid_storage_name_cache: Dict[str, str] = {}
+# 全文索引使用的分词器，''表示没有全文索引，None表示还没从数据库读取
+_search_tokenizer: Optional[str] = None
+
+_db_write_duration_histogram = metrics.Histogram(
+    'blivechat_log_db_write_duration_seconds', 'Time spent writing a danmaku log to the database'
+)
 
 
 class LogItem(models.database.OrmBase):
@@ -24,8 +62,21 @@ class LogItem(models.database.OrmBase):
     did = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
     lid = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('log_records.lid'))
     content = sqlalchemy.Column(sqlalchemy.Text)
+    # 以下是写入时从content中提取的列，方便筛选
+    cmd = sqlalchemy.Column(sqlalchemy.Integer)
+    timestamp = sqlalchemy.Column(sqlalchemy.Integer)
+    uid = sqlalchemy.Column(sqlalchemy.Integer)
+    author_name = sqlalchemy.Column(sqlalchemy.String(64))
+    # 人民币，礼物是金瓜子数 / 1000
+    price = sqlalchemy.Column(sqlalchemy.Float)
     logfile = sqlalchemy.orm.relationship("LogFile", back_populates="danmakus")
 
+    __table_args__ = (
+        sqlalchemy.Index('ix_danmaku_lid', 'lid'),
+        sqlalchemy.Index('ix_danmaku_lid_cmd', 'lid', 'cmd'),
+        sqlalchemy.Index('ix_danmaku_uid_timestamp', 'uid', 'timestamp'),
+    )
+
 
 class LogFile(models.database.OrmBase):
     __tablename__ = 'log_records'
@@ -33,9 +84,259 @@ class LogFile(models.database.OrmBase):
     filename = sqlalchemy.Column(sqlalchemy.String(64))
     room_id = sqlalchemy.Column(sqlalchemy.Integer)
     create_time = sqlalchemy.Column(sqlalchemy.DateTime, server_default=func.now())
+    # 弹幕的存储后端，None表示数据库，是加入存储后端之前创建的日志
+    storage = sqlalchemy.Column(sqlalchemy.String(16))
+    # danmaku表中这个日志的弹幕数和内容字节数，不包括归档的，写入、删除弹幕时增量更新，保留策略不用扫描整个表。
+    # None表示是加入计数之前创建的日志，还没统计，见backfill_log_usages
+    danmaku_count = sqlalchemy.Column(sqlalchemy.Integer)
+    danmaku_bytes = sqlalchemy.Column(sqlalchemy.BigInteger)
     danmakus = sqlalchemy.orm.relationship('LogItem', back_populates="logfile", cascade="all, delete, delete-orphan")
 
 
+@models.database.migration(1, 'Add typed columns and indexes to danmaku')
+def _add_danmaku_typed_columns(connection):
+    models.database.add_columns(connection, LogItem.__table__, ('cmd', 'timestamp', 'uid', 'author_name', 'price'))
+    models.database.create_indexes(connection, LogItem.__table__)
+
+
+# SQLite的FTS5全文索引，rowid是弹幕的did。不是ORM表，在迁移里创建
+_search_index_table = sqlalchemy.table(
+    'danmaku_fts',
+    sqlalchemy.column('rowid'),
+    sqlalchemy.column('author_name'),
+    sqlalchemy.column('text')
+)
+
+
+@models.database.migration(2, 'Add full-text search index to danmaku')
+def _add_danmaku_search_index(connection):
+    global _search_tokenizer
+    tokenizer = ''
+    if connection.dialect.name == 'sqlite':
+        # trigram分词器支持中文子串搜索，需要SQLite 3.34以上，否则只能按空格和标点分词
+        for tokenizer_ in ('trigram', 'unicode61'):
+            try:
+                connection.execute(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS danmaku_fts USING fts5(author_name, text, "
+                    f"tokenize='{tokenizer_}')"
+                )
+            except sqlalchemy.exc.OperationalError:
+                continue
+            tokenizer = tokenizer_
+            break
+    if tokenizer == '':
+        logger.warning('Full-text search is not supported by the database, fall back to LIKE')
+    else:
+        # 已有的弹幕由backfill_search_index建立索引，之后的弹幕在add_danmaku时建立索引
+        end_did = connection.execute(sqlalchemy.select([func.max(LogItem.did)])).scalar() or 0
+        models.database.set_schema_info(connection, _SEARCH_INDEX_END_KEY, end_did)
+    models.database.set_schema_info(connection, _SEARCH_TOKENIZER_KEY, tokenizer)
+    _search_tokenizer = tokenizer
+
+
+@models.database.migration(3, 'Add storage backend to log_records')
+def _add_log_file_storage(connection):
+    models.database.add_columns(connection, LogFile.__table__, ('storage',))
+
+
+@models.database.migration(4, 'Add danmaku count and size to log_records')
+def _add_log_file_usage(connection):
+    # 已有的日志是NULL，由backfill_log_usages统计
+    models.database.add_columns(connection, LogFile.__table__, ('danmaku_count', 'danmaku_bytes'))
+
+
+def get_search_tokenizer():
+    """
+    :return: 全文索引使用的分词器，''表示没有全文索引
+    """
+    global _search_tokenizer
+    if _search_tokenizer is None:
+        try:
+            with models.database.get_session() as session:
+                tokenizer = models.database.get_schema_info(session, _SEARCH_TOKENIZER_KEY)
+        except sqlalchemy.exc.OperationalError:
+            return ''
+        # 还没迁移时也缓存''，不用每次写入弹幕都查询，迁移时会设置_search_tokenizer
+        _search_tokenizer = tokenizer if tokenizer is not None else ''
+    return _search_tokenizer
+
+
+def extract_columns(cmd, data):
+    """从发给客户端的消息中提取类型化的列，uid不在消息中，要调用者提供"""
+    columns = {'cmd': int(cmd), 'timestamp': None, 'author_name': None, 'price': None}
+    try:
+        if cmd == _CMD_ADD_TEXT:
+            columns['timestamp'] = data[1]
+            columns['author_name'] = data[2]
+        elif cmd in (_CMD_ADD_GIFT, _CMD_ADD_MEMBER, _CMD_ADD_SUPER_CHAT):
+            columns['timestamp'] = data.get('timestamp', None)
+            columns['author_name'] = data.get('authorName', None)
+            if cmd == _CMD_ADD_GIFT:
+                columns['price'] = data['totalCoin'] / 1000
+            elif cmd == _CMD_ADD_SUPER_CHAT and 'price' in data:
+                columns['price'] = data['price']
+    except (LookupError, TypeError, AttributeError):
+        pass
+    return columns
+
+
+def parse_content(content):
+    """
+    :return: (cmd, data)，解析失败时返回(None, None)
+    """
+    try:
+        body = serializer.loads(content)
+        return body['cmd'], body['data']
+    except (serializer.DecodeError, LookupError, TypeError):
+        return None, None
+
+
+def _extract_columns_from_content(content):
+    return extract_columns_safe(*parse_content(content))
+
+
+def extract_columns_safe(cmd, data):
+    if cmd is None:
+        return {'cmd': _CMD_UNKNOWN, 'timestamp': None, 'author_name': None, 'price': None}
+    try:
+        return extract_columns(cmd, data)
+    except (TypeError, ValueError):
+        return {'cmd': _CMD_UNKNOWN, 'timestamp': None, 'author_name': None, 'price': None}
+
+
+def extract_search_text(cmd, data):
+    """
+    从发给客户端的消息中提取要索引的文本
+
+    :return: (作者名, 文本)
+    """
+    try:
+        if cmd == _CMD_ADD_TEXT:
+            return data[2], data[4]
+        elif cmd == _CMD_ADD_GIFT:
+            return data.get('authorName', None), data.get('giftName', None)
+        elif cmd == _CMD_ADD_MEMBER:
+            return data.get('authorName', None), None
+        elif cmd == _CMD_ADD_SUPER_CHAT:
+            return data.get('authorName', None), data.get('content', None)
+    except (LookupError, TypeError, AttributeError):
+        pass
+    return None, None
+
+
+def _run_backfill(name, progress_key, process_batch, batch_size, max_batches):
+    """
+    分批回填，每批一个事务，进度保存在数据库里，中断后再次调用会继续
+
+    :param process_batch: process_batch(session, after_did, batch_size)，返回这批最后的did，没有要处理的了返回None
+    :param max_batches: 最多处理的批数，为None时处理到结束
+    :return: 是否全部完成，出错时返回None
+    """
+    batch_count = 0
+    last_did = None
+    lock_retry_count = 0
+    while max_batches is None or batch_count < max_batches:
+        try:
+            with models.database.get_session() as session:
+                after_did = int(models.database.get_schema_info(session, progress_key, 0))
+                last_did = process_batch(session, after_did, batch_size)
+                if last_did is None:
+                    if batch_count != 0:
+                        logger.info('Backfilled %s, finished', name)
+                    return True
+                models.database.set_schema_info(session, progress_key, last_did)
+                session.commit()
+        except sqlalchemy.exc.OperationalError as e:
+            # 只有SQLite被锁了才等一下再继续，其他错误（缺少表、磁盘错误、只读等）重试也没用
+            if not _is_locked_error(e) or lock_retry_count >= BACKFILL_MAX_LOCK_RETRIES:
+                logger.exception(f'backfill {name} failed: {e}')
+                return None
+            lock_retry_count += 1
+            time.sleep(1)
+            continue
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logger.exception(f'backfill {name} failed: {e}')
+            return None
+
+        lock_retry_count = 0
+        batch_count += 1
+        if batch_count % 100 == 0:
+            logger.info('Backfilling %s, did=%d', name, last_did)
+    return False
+
+
+def _is_locked_error(e: sqlalchemy.exc.OperationalError):
+    message = str(e.orig).lower()
+    return 'database is locked' in message or 'database table is locked' in message or 'busy' in message
+
+
+def backfill_typed_columns(batch_size=BACKFILL_BATCH_SIZE, max_batches=None):
+    """给迁移之前写入的弹幕填充类型化的列，参数和返回值见_run_backfill"""
+    return _run_backfill('typed columns', _BACKFILL_PROGRESS_KEY, _backfill_typed_columns_batch,
+                         batch_size, max_batches)
+
+
+def _backfill_typed_columns_batch(session, after_did, batch_size):
+    rows = session.query(LogItem.did, LogItem.content).filter(
+        LogItem.did > after_did, LogItem.cmd.is_(None)
+    ).order_by(LogItem.did).limit(batch_size).all()
+    if not rows:
+        return None
+    session.bulk_update_mappings(LogItem, [
+        {'did': did, **_extract_columns_from_content(content)} for did, content in rows
+    ])
+    return rows[-1].did
+
+
+def backfill_search_index(batch_size=BACKFILL_BATCH_SIZE, max_batches=None):
+    """给建立全文索引之前写入的弹幕建立索引，参数和返回值见_run_backfill"""
+    if get_search_tokenizer() == '':
+        return True
+    return _run_backfill('search index', _SEARCH_INDEX_PROGRESS_KEY, _backfill_search_index_batch,
+                         batch_size, max_batches)
+
+
+def _backfill_search_index_batch(session, after_did, batch_size):
+    # 建索引之后写入的弹幕已经在add_danmaku里索引过了
+    end_did = int(models.database.get_schema_info(session, _SEARCH_INDEX_END_KEY, 0))
+    rows = session.query(LogItem.did, LogItem.content).filter(
+        LogItem.did > after_did, LogItem.did <= end_did
+    ).order_by(LogItem.did).limit(batch_size).all()
+    if not rows:
+        return None
+    index_rows = []
+    for did, content in rows:
+        author_name, text = extract_search_text(*parse_content(content))
+        if author_name is not None or text is not None:
+            index_rows.append({'rowid': did, 'author_name': author_name, 'text': text})
+    if index_rows:
+        session.execute(_search_index_table.insert(), index_rows)
+    return rows[-1].did
+
+
+def get_backfill_remaining_counts():
+    """
+    :return: {回填名: 还没有回填的弹幕数}，还没迁移或出错时返回None
+    """
+    try:
+        with models.database.get_session() as session:
+            res = {
+                'typed columns': session.query(func.count(LogItem.did)).filter(LogItem.cmd.is_(None)).scalar()
+            }
+            if get_search_tokenizer() != '':
+                after_did = int(models.database.get_schema_info(session, _SEARCH_INDEX_PROGRESS_KEY, 0))
+                end_did = int(models.database.get_schema_info(session, _SEARCH_INDEX_END_KEY, 0))
+                res['search index'] = session.query(func.count(LogItem.did)).filter(
+                    LogItem.did > after_did, LogItem.did <= end_did
+                ).scalar()
+            return res
+    except sqlalchemy.exc.OperationalError:
+        return None
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'get_backfill_remaining_counts failed: {e}')
+        return None
+
+
 # https://stackoverflow.com/a/37350445
 def object_as_dict(obj):
     return {c.key: getattr(obj, c.key) for c in sqlalchemy.inspect(obj).mapper.column_attrs}
@@ -45,30 +346,546 @@ def log_file_name():
     return time.strftime('%Y-%m-%d-%H-%M-%S.log')
 
 
+class SqlLogStorage(models.log_storage.LogStorage):
+    """弹幕存在数据库里，旧的日志可能被移到了归档里，见models.log_archive"""
+
+    name = 'sql'
+
+    def add_danmaku(self, lid, content: str, columns: dict, uid, cmd, data):
+        start_time = time.perf_counter()
+        try:
+            with models.database.get_session() as session:
+                danmaku = LogItem(lid=lid, content=content, uid=uid, **columns)
+                session.add(danmaku)
+                _add_log_usage(session, lid, 1, len(content.encode('utf-8')))
+                if get_search_tokenizer() != '':
+                    author_name, text = extract_search_text(cmd, data)
+                    if author_name is not None or text is not None:
+                        # 和弹幕在同一个事务里写入索引
+                        session.flush()
+                        session.execute(_search_index_table.insert().values(
+                            rowid=danmaku.did, author_name=author_name, text=text
+                        ))
+                session.commit()
+        except sqlalchemy.exc.OperationalError:
+            return False
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logger.exception(f'add_danmaku failed: {e}')
+            return False
+        finally:
+            _db_write_duration_histogram.observe(time.perf_counter() - start_time)
+        return True
+
+    def get_danmaku_batch(self, lid, after_did, limit):
+        try:
+            with models.database.get_session() as session:
+                # 每块至少有一条弹幕，最多需要limit块
+                blocks = models.log_archive.get_blocks(session, lid, after_did, limit)
+                if not blocks:
+                    return session.query(LogItem.did, LogItem.lid, LogItem.content, LogItem.uid).filter(
+                        LogItem.lid == lid, LogItem.did > after_did
+                    ).order_by(LogItem.did).limit(limit).all()
+        except sqlalchemy.exc.OperationalError:
+            return
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logger.exception(f'get_danmaku_batch failed: {e}')
+            return
+
+        # 没有块不代表日志没有归档，可能是after_did已经到了结尾，这时上面从数据库查到的也是空的
+        try:
+            res = []
+            for block in blocks:
+                for line in models.log_archive.read_block(block):
+                    danmaku = serializer.loads(line)
+                    if danmaku['did'] <= after_did:
+                        continue
+                    res.append((danmaku['did'], danmaku['lid'], danmaku['content'], danmaku.get('uid', None)))
+                    if len(res) >= limit:
+                        return res
+            return res
+        except (OSError, ValueError, LookupError):
+            logger.exception('get_danmaku_batch failed to read archive:')
+            return
+
+    def get_danmakus_by_file(self, lid):
+        try:
+            with models.database.get_session() as session:
+                blocks = models.log_archive.get_blocks(session, lid)
+                if blocks:
+                    return [line for block in blocks for line in models.log_archive.read_block(block)]
+                logfile = session.query(LogFile).filter(LogFile.lid == lid).first()
+                return [serializer.dumps(object_as_dict(dm)) for dm in logfile.danmakus]
+        except (OSError, ValueError):
+            logger.exception('get_danmakus_by_file failed to read archive:')
+            return
+        except sqlalchemy.exc.OperationalError:
+            return
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logger.exception(f'get_danmakus_by_file failed: {e}')
+            return
+
+    def get_danmaku_counts(self, lids):
+        if not lids:
+            return {}
+        try:
+            with models.database.get_session() as session:
+                counts = dict(session.query(LogItem.lid, func.count(LogItem.did)).filter(
+                    LogItem.lid.in_(lids)
+                ).group_by(LogItem.lid).all())
+                for lid, count in models.log_archive.get_danmaku_counts(session, lids).items():
+                    counts[lid] = counts.get(lid, 0) + count
+                return counts
+        except sqlalchemy.exc.OperationalError:
+            return {}
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logger.exception(f'get_danmaku_counts failed: {e}')
+            return {}
+
+    def delete_danmakus(self, lid):
+        try:
+            _delete_danmakus_of_log(lid)
+            with models.database.get_session() as session:
+                segments = models.log_archive.delete_blocks(session, lid)
+                session.commit()
+            models.log_archive.remove_unused_segments(segments)
+        except sqlalchemy.exc.OperationalError:
+            return False
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logger.exception(f'delete_danmakus failed: {e}')
+            return False
+        return True
+
+
+_storages: Dict[str, models.log_storage.LogStorage] = {
+    storage.name: storage for storage in (SqlLogStorage(), models.log_storage.FileLogStorage())
+}
+
+
+def init():
+    global _storage_name
+    cfg = config.get_config()
+    _storage_name = cfg.log_storage
+    if _storage_name not in _storages:
+        logger.warning('Unknown log storage %s, using sql', _storage_name)
+        _storage_name = 'sql'
+    for storage in _storages.values():
+        storage.init()
+
+
+def _get_storage(storage_name) -> models.log_storage.LogStorage:
+    return _storages.get(storage_name or 'sql', _storages['sql'])
+
+
+def _get_storage_of_log(lid) -> models.log_storage.LogStorage:
+    storage_name = _lid_storage_name_cache.get(str(lid), None)
+    if storage_name is None:
+        try:
+            with models.database.get_session() as session:
+                row = session.query(LogFile.storage).filter(LogFile.lid == lid).first()
+        except sqlalchemy.exc.SQLAlchemyError:
+            # 查不到时当作数据库后端，让调用者自己处理错误
+            return _storages['sql']
+        if row is None:
+            return _storages['sql']
+        storage_name = row.storage or 'sql'
+        _lid_storage_name_cache[str(lid)] = storage_name
+    return _get_storage(storage_name)
+
+
 def get_danmakus_by_file(lid):
+    """
+    :return: 日志的所有弹幕，每条是一个JSON
+    """
+    return _get_storage_of_log(lid).get_danmakus_by_file(lid)
+
+
+def get_danmaku_batch(lid, after_did, limit):
+    """
+    按did顺序取一批弹幕，用上一批最后的did作为after_did取下一批
+
+    :return: [(did, lid, content, uid)]，uid是发送者的UID，没有记录时为None，失败时返回None
+    """
+    return _get_storage_of_log(lid).get_danmaku_batch(lid, after_did, limit)
+
+
+def delete_danmaku_by_file(lid):
+    """
+    分批删除一个日志的所有弹幕，再删除日志，比较慢，应该在线程池中执行。
+    正在写入的日志要先在事件循环线程调用end_log_session结束，否则删除过程中写入的弹幕会留下来，
+    而lid可能被新的日志复用
+    """
+    if str(lid) in {str(active_lid) for active_lid in get_active_lids()}:
+        logger.warning('Log %s is being written, end its session before deleting', lid)
+        return False
+    if not _get_storage_of_log(lid).delete_danmakus(lid):
+        return False
     try:
         with models.database.get_session() as session:
-            logfile = session.query(LogFile).filter(LogFile.lid == lid).first()
-            return [json.dumps(object_as_dict(dm)) for dm in logfile.danmakus]
+            session.query(LogFile).filter(LogFile.lid == lid).delete(synchronize_session=False)
+            _delete_log_stats(session, [lid])
+            session.commit()
+    except sqlalchemy.exc.OperationalError:
+        return False
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'delete_danmaku_by_file failed: {e}')
+        return False
+    _lid_storage_name_cache.pop(str(lid), None)
+    return True
+
+
+def archive_old_log_files(before_time: datetime.datetime, max_count):
+    """
+    把创建时间早于before_time的日志移到归档里，比较慢，应该在线程池中执行
+
+    :param max_count: 最多归档的日志数，剩下的下次再归档
+    :return: 归档的日志数，失败时返回None
+    """
+    active_lids = get_active_lids()
+    try:
+        with models.database.get_session() as session:
+            query = session.query(LogFile.lid).filter(
+                LogFile.create_time < before_time, sqlalchemy.exists().where(LogItem.lid == LogFile.lid)
+            )
+            if active_lids:
+                query = query.filter(LogFile.lid.notin_(active_lids))
+            lids = [row.lid for row in query.order_by(LogFile.lid).limit(max_count)]
     except sqlalchemy.exc.OperationalError:
         return
     except sqlalchemy.exc.SQLAlchemyError as e:
-        logger.exception(f'get_danmakus_by_file failed: {e}')
+        logger.exception(f'archive_old_log_files failed: {e}')
         return
 
+    count = 0
+    for lid in lids:
+        if not archive_log_file(lid):
+            break
+        count += 1
+    return count
 
-def delete_danmaku_by_file(lid):
+
+def archive_log_file(lid):
+    """
+    把一个日志的弹幕写到段文件，在数据库中记录块的位置，再分批删除数据库中的弹幕。
+    中途失败的话，记录块之前数据库没有变化，记录块之后再次调用会继续删除
+
+    :return: 是否成功
+    """
     try:
         with models.database.get_session() as session:
-            logfile = session.query(LogFile).filter(LogFile.lid == lid).first()
-            session.delete(logfile)
-            session.commit()
-        return True
+            last_archived_did = models.log_archive.get_last_archived_did(session, lid)
+        if last_archived_did is None:
+            last_archived_did = _write_archive_blocks(lid)
+            if last_archived_did is None:
+                return True
+        _delete_danmakus_of_log(lid, last_archived_did)
+    except OSError:
+        logger.exception('archive_log_file %s failed to write archive:', lid)
+        return False
     except sqlalchemy.exc.OperationalError:
         return False
     except sqlalchemy.exc.SQLAlchemyError as e:
-        logger.exception(f'delete_danmaku_by_file failed: {e}')
+        logger.exception(f'archive_log_file failed: {e}')
         return False
+    return True
+
+
+def _write_archive_blocks(lid):
+    """
+    :return: 归档的最大did，没有弹幕时返回None
+    """
+    blocks = []
+    after_did = 0
+    with models.log_archive.SegmentWriter() as writer:
+        while True:
+            with models.database.get_session() as session:
+                danmakus = session.query(LogItem).filter(
+                    LogItem.lid == lid, LogItem.did > after_did
+                ).order_by(LogItem.did).limit(models.log_archive.BLOCK_SIZE).all()
+                rows = [object_as_dict(danmaku) for danmaku in danmakus]
+            if not rows:
+                break
+            location = writer.append_block([serializer.dumps(row) for row in rows])
+            blocks.append({
+                'lid': lid,
+                'first_did': rows[0]['did'],
+                'last_did': rows[-1]['did'],
+                'count': len(rows),
+                'max_timestamp': max((row['timestamp'] for row in rows if row['timestamp'] is not None), default=None),
+                **location
+            })
+            after_did = rows[-1]['did']
+        if not blocks:
+            return None
+        writer.sync()
+
+        with models.database.get_session() as session:
+            session.bulk_insert_mappings(models.log_archive.ArchiveBlock, blocks)
+            session.commit()
+    logger.info('Archived log %s, %d danmakus in %d blocks', lid, sum(block['count'] for block in blocks),
+                len(blocks))
+    return after_did
+
+
+def _delete_danmakus_of_log(lid, max_did=None):
+    """分批删除数据库中一个日志的弹幕"""
+    while True:
+        with models.database.get_session() as session:
+            query = session.query(LogItem.did).filter(LogItem.lid == lid)
+            if max_did is not None:
+                query = query.filter(LogItem.did <= max_did)
+            dids = [row.did for row in query.order_by(LogItem.did).limit(DELETE_BATCH_SIZE)]
+            if not dids:
+                break
+            _delete_danmakus(session, dids)
+            session.commit()
+        time.sleep(DELETE_BATCH_INTERVAL)
+
+
+def _delete_danmakus(session, dids):
+    """用集合操作删除弹幕和它们的全文索引，不加载ORM对象，同时更新日志的弹幕数和字节数"""
+    usages = session.query(LogItem.lid, func.count(LogItem.did), func.sum(_content_size_expression())).filter(
+        LogItem.did.in_(dids)
+    ).group_by(LogItem.lid).all()
+    if get_search_tokenizer() != '':
+        session.execute(_search_index_table.delete().where(_search_index_table.c.rowid.in_(dids)))
+    session.query(LogItem).filter(LogItem.did.in_(dids)).delete(synchronize_session=False)
+    for lid, count, byte_count in usages:
+        _add_log_usage(session, lid, -count, -(byte_count or 0))
+
+
+def _add_log_usage(connection, lid, count, byte_count):
+    """
+    在写入、删除弹幕的事务中更新日志的弹幕数和字节数，还没统计的日志是NULL，加减之后还是NULL
+
+    :param connection: Connection或Session
+    """
+    table = LogFile.__table__
+    connection.execute(table.update().where(table.c.lid == lid).values(
+        danmaku_count=table.c.danmaku_count + count,
+        danmaku_bytes=table.c.danmaku_bytes + byte_count
+    ))
+
+
+def delete_danmakus_before(timestamp, batch_size=DELETE_BATCH_SIZE):
+    """
+    删除一批时间戳早于timestamp的最旧的弹幕。did是按时间递增的，所以从最小的did开始删，遇到不早于timestamp的就停止
+
+    :return: 删除的弹幕数，0表示没有要删除的了，失败时返回None
+    """
+    try:
+        with models.database.get_session() as session:
+            rows = session.query(LogItem.did, LogItem.timestamp).order_by(LogItem.did).limit(batch_size).all()
+            # 没有时间戳的弹幕（无法解析的、还没回填的）夹在过期的弹幕之间时才删除
+            end = 0
+            for index, row in enumerate(rows):
+                if row.timestamp is None:
+                    continue
+                if row.timestamp >= timestamp:
+                    break
+                end = index + 1
+            if end == 0:
+                return 0
+            _delete_danmakus(session, [row.did for row in rows[:end]])
+            session.commit()
+            return end
+    except sqlalchemy.exc.OperationalError:
+        return
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'delete_danmakus_before failed: {e}')
+        return
+
+
+def get_archived_lids_before(timestamp):
+    """
+    :return: 所有弹幕的时间戳都早于timestamp的归档日志的lid，弹幕都没有时间戳的按日志的创建时间，失败时返回None
+    """
+    try:
+        with models.database.get_session() as session:
+            lids = models.log_archive.get_lids_before(session, timestamp)
+            no_timestamp_lids = models.log_archive.get_lids_without_timestamp(session)
+            if no_timestamp_lids:
+                # SQLite的CURRENT_TIMESTAMP是UTC时间
+                before_time = datetime.datetime.utcfromtimestamp(timestamp)
+                lids += [row.lid for row in session.query(LogFile.lid).filter(
+                    LogFile.lid.in_(no_timestamp_lids), LogFile.create_time < before_time
+                )]
+            return lids
+    except sqlalchemy.exc.OperationalError:
+        return
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'get_archived_lids_before failed: {e}')
+        return
+
+
+def compact_archive(max_count):
+    """
+    整理归档的段文件，回收删除的日志占用的空间，比较慢，应该在线程池中执行
+
+    :return: 整理的段数，失败时返回None
+    """
+    try:
+        return models.log_archive.compact_segments(max_count)
+    except (OSError, ValueError):
+        logger.exception('compact_archive failed:')
+        return
+    except sqlalchemy.exc.OperationalError:
+        return
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'compact_archive failed: {e}')
+        return
+
+
+def get_expired_file_log_lids(timestamp):
+    """
+    :return: 文件后端中最后一条弹幕的时间戳早于timestamp的日志的lid，正在写入的除外，失败时返回None
+    """
+    active_lids = get_active_lids()
+    try:
+        with models.database.get_session() as session:
+            query = session.query(LogFile.lid).filter(LogFile.storage == models.log_storage.FileLogStorage.name)
+            if active_lids:
+                query = query.filter(LogFile.lid.notin_(active_lids))
+            lids = [row.lid for row in query]
+    except sqlalchemy.exc.OperationalError:
+        return
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'get_expired_file_log_lids failed: {e}')
+        return
+
+    storage: models.log_storage.FileLogStorage = _storages[models.log_storage.FileLogStorage.name]
+    res = []
+    for lid in lids:
+        last_timestamp = storage.get_last_timestamp(lid)
+        if last_timestamp is not None and last_timestamp < timestamp:
+            res.append(lid)
+    return res
+
+
+def get_room_usages():
+    """
+    统计每个房间在数据库中的弹幕数和内容大小，只读取log_records表中每个日志的计数。
+    还没统计的日志不算在内，见backfill_log_usages
+
+    :return: {房间ID: (弹幕数, 字节数)}，失败时返回None
+    """
+    try:
+        with models.database.get_session() as session:
+            rows = session.query(
+                LogFile.room_id, func.sum(LogFile.danmaku_count), func.sum(LogFile.danmaku_bytes)
+            ).group_by(LogFile.room_id).all()
+    except sqlalchemy.exc.OperationalError:
+        return
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'get_room_usages failed: {e}')
+        return
+    return {room_id: (count or 0, size or 0) for room_id, count, size in rows}
+
+
+def backfill_log_usages(max_count=USAGE_BACKFILL_BATCH_SIZE):
+    """
+    统计加入计数之前创建的日志的弹幕数和字节数，每个日志一条语句，统计和写入之间不会漏掉新写入的弹幕。
+    比较慢，应该在线程池中执行
+
+    :return: 统计的日志数，失败时返回None
+    """
+    table = LogFile.__table__
+    try:
+        with models.database.get_session() as session:
+            lids = [row.lid for row in session.query(LogFile.lid).filter(
+                LogFile.danmaku_count.is_(None)
+            ).order_by(LogFile.lid).limit(max_count)]
+        for lid in lids:
+            with models.database.get_session() as session:
+                session.execute(table.update().where(
+                    sqlalchemy.and_(table.c.lid == lid, table.c.danmaku_count.is_(None))
+                ).values(
+                    danmaku_count=sqlalchemy.select([func.count(LogItem.did)]).where(LogItem.lid == lid).as_scalar(),
+                    danmaku_bytes=sqlalchemy.select([func.coalesce(func.sum(_content_size_expression()), 0)]).where(
+                        LogItem.lid == lid
+                    ).as_scalar()
+                ))
+                session.commit()
+            time.sleep(DELETE_BATCH_INTERVAL)
+    except sqlalchemy.exc.OperationalError:
+        return
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'backfill_log_usages failed: {e}')
+        return
+    return len(lids)
+
+
+def _content_size_expression():
+    # 转成二进制再取长度，得到的是字节数而不是字符数
+    return func.length(sqlalchemy.cast(LogItem.content, sqlalchemy.LargeBinary))
+
+
+def delete_oldest_danmakus_of_room(room_id, min_count, min_bytes, batch_size=DELETE_BATCH_SIZE):
+    """
+    删除一批一个房间最旧的弹幕，删除数达到min_count并且删除的字节数达到min_bytes时停止，最多删除batch_size条
+
+    :return: (删除的弹幕数, 删除的字节数)，失败时返回None
+    """
+    try:
+        with models.database.get_session() as session:
+            rows = session.query(LogItem.did, _content_size_expression()).join(
+                LogFile, LogFile.lid == LogItem.lid
+            ).filter(LogFile.room_id == room_id).order_by(LogItem.did).limit(batch_size).all()
+            dids = []
+            deleted_bytes = 0
+            for did, size in rows:
+                if len(dids) >= min_count and deleted_bytes >= min_bytes:
+                    break
+                dids.append(did)
+                deleted_bytes += size or 0
+            if not dids:
+                return 0, 0
+            _delete_danmakus(session, dids)
+            session.commit()
+            return len(dids), deleted_bytes
+    except sqlalchemy.exc.OperationalError:
+        return
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'delete_oldest_danmakus_of_room failed: {e}')
+        return
+
+
+def _delete_log_stats(session, lids):
+    """lid不是AUTOINCREMENT的，删除日志后新的日志可能复用这个lid，所以统计也要一起删除"""
+    # models.log_analytics导入了这个模块
+    import models.log_analytics
+    models.log_analytics.delete_summaries(session, lids)
+    models.room_stats.delete_snapshots(session, lids)
+
+
+def delete_empty_log_files():
+    """
+    删除没有弹幕的日志，正在写入的除外
+
+    :return: 删除的日志数，失败时返回None
+    """
+    active_lids = get_active_lids()
+    try:
+        with models.database.get_session() as session:
+            query = session.query(LogFile).filter(
+                ~sqlalchemy.exists().where(LogItem.lid == LogFile.lid),
+                ~sqlalchemy.exists().where(models.log_archive.ArchiveBlock.lid == LogFile.lid),
+                # 其他存储后端的弹幕不在数据库里
+                sqlalchemy.or_(LogFile.storage.is_(None), LogFile.storage == SqlLogStorage.name)
+            )
+            if active_lids:
+                query = query.filter(LogFile.lid.notin_(active_lids))
+            lids = [row.lid for row in query.with_entities(LogFile.lid)]
+            if not lids:
+                return 0
+            count = session.query(LogFile).filter(LogFile.lid.in_(lids)).delete(synchronize_session=False)
+            _delete_log_stats(session, lids)
+            session.commit()
+            return count
+    except sqlalchemy.exc.OperationalError:
+        return
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'delete_empty_log_files failed: {e}')
+        return
 
 
 def get_log_file(room_id):
@@ -77,10 +894,11 @@ def get_log_file(room_id):
         return _room_log_mapper[room_id]
     try:
         with models.database.get_session() as session:
-            logfile = LogFile(filename=log_file_name(), room_id=room_id)
+            logfile = LogFile(filename=log_file_name(), room_id=room_id, storage=_storage_name, danmaku_count=0,
+                              danmaku_bytes=0)
             session.add(logfile)
             session.commit()
-            _room_log_mapper[room_id] = LogFile(lid=logfile.lid, filename=logfile.filename)
+            _room_log_mapper[room_id] = LogFile(lid=logfile.lid, filename=logfile.filename, storage=logfile.storage)
     except sqlalchemy.exc.OperationalError:
         return
     except sqlalchemy.exc.SQLAlchemyError as e:
@@ -89,10 +907,45 @@ def get_log_file(room_id):
     return _room_log_mapper[room_id]
 
 
+def end_log_session(room_id):
+    """
+    结束房间正在写入的日志，房间之后再写入时新建一个日志。和add_danmaku一样要在事件循环线程调用
+
+    :return: 结束的日志ID，没有时返回None
+    """
+    log_file = _room_log_mapper.pop(room_id, None)
+    if log_file is None:
+        return None
+    _get_storage(log_file.storage).close_log(log_file.lid)
+    return log_file.lid
+
+
+def end_log_session_by_lid(lid):
+    """结束正在写入这个日志的房间的日志，要在事件循环线程调用"""
+    for room_id, log_file in list(_room_log_mapper.items()):
+        if str(log_file.lid) == str(lid):
+            end_log_session(room_id)
+
+
 def get_log_file_id(room_id):
     return get_log_file(room_id).lid
 
 
+def get_active_log_file_id(room_id):
+    """
+    :return: 房间正在写入的日志ID，没有时返回None，不会新建日志
+    """
+    log_file = _room_log_mapper.get(room_id, None)
+    return None if log_file is None else log_file.lid
+
+
+def get_active_lids():
+    """
+    :return: 这个进程正在写入的日志ID
+    """
+    return [log_file.lid for log_file in list(_room_log_mapper.values())]
+
+
 def get_log_file_by_lid(lid):
     if _room_log_mapper.get(lid):
         return _room_log_mapper[lid]
@@ -107,33 +960,162 @@ def get_log_file_by_lid(lid):
         return
 
 
-def add_danmaku(room_id, body):
-    lid = get_log_file_id(room_id)
-    try:
-        with models.database.get_session() as session:
-            danmaku = LogItem(lid=lid, content=str(body))
-            session.add(danmaku)
-            session.commit()
-    except sqlalchemy.exc.OperationalError:
+def add_danmaku(room_id, body, cmd=None, data=None, uid=None):
+    """
+    :param body: 发给客户端的消息
+    :param cmd: 消息的cmd，和data一起用来提取类型化的列，为None时从body解析
+    :param data: 消息的data
+    :param uid: 发送者的UID
+    """
+    log_file = get_log_file(room_id)
+    if log_file is None:
         return False
-    except sqlalchemy.exc.SQLAlchemyError as e:
-        logger.exception(f'add_danmaku failed: {e}')
-        return False
-    return True
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    if cmd is None:
+        cmd, data = parse_content(body)
+    columns = extract_columns_safe(cmd, data)
+    return _get_storage(log_file.storage).add_danmaku(log_file.lid, str(body), columns, uid, cmd, data)
 
 
-def get_all_logs():
+def insert_danmakus(connection, lid, first_did, contents: List[str]):
+    """
+    批量写入弹幕到数据库，给导入工具用。did从first_did开始连续分配，调用者要管理事务，并保证这些did没有被使用
+
+    :param connection: Connection或Session
+    :param contents: 每条弹幕的内容，是发给客户端的消息的JSON
+    """
+    need_index = get_search_tokenizer() != ''
+    rows = []
+    index_rows = []
+    for did, content in enumerate(contents, first_did):
+        cmd, data = parse_content(content)
+        rows.append({'did': did, 'lid': lid, 'content': content, 'uid': None, **extract_columns_safe(cmd, data)})
+        if need_index:
+            author_name, text = extract_search_text(cmd, data)
+            if author_name is not None or text is not None:
+                index_rows.append({'rowid': did, 'author_name': author_name, 'text': text})
+    if rows:
+        connection.execute(LogItem.__table__.insert(), rows)
+        _add_log_usage(connection, lid, len(rows), sum(len(content.encode('utf-8')) for content in contents))
+    if index_rows:
+        connection.execute(_search_index_table.insert(), index_rows)
+
+
+def get_logs_page(before_lid, limit):
+    """
+    按lid从新到旧取一页日志，用上一页最后的lid作为before_lid取下一页
+
+    :param before_lid: 为None时从最新的开始
+    :return: (日志列表, 日志总数)，失败时返回None
+    """
     try:
         with models.database.get_session() as session:
-            logs = session.query(LogFile.lid, LogFile.filename, LogFile.room_id, LogFile.create_time).all()
+            query = session.query(LogFile.lid, LogFile.filename, LogFile.room_id, LogFile.create_time,
+                                  LogFile.storage)
+            if before_lid is not None:
+                query = query.filter(LogFile.lid < before_lid)
+            logs = query.order_by(LogFile.lid.desc()).limit(limit).all()
+            total = session.query(func.count(LogFile.lid)).scalar()
     except sqlalchemy.exc.OperationalError:
         return
     except sqlalchemy.exc.SQLAlchemyError as e:
-        logger.exception(f'get_all_logs failed: {e}')
+        logger.exception(f'get_logs_page failed: {e}')
         return
+
+    storage_lids: Dict[str, List[int]] = {}
+    for log in logs:
+        storage_lids.setdefault(log.storage or 'sql', []).append(log.lid)
+    message_counts = {}
+    for storage_name, lids in storage_lids.items():
+        message_counts.update(_get_storage(storage_name).get_danmaku_counts(lids))
     return [{
         'lid': i[0],
         'filename': i[1],
         'room_id': i[2],
         'create_time': i[3],
-    } for i in logs]
+        'message_count': message_counts.get(i[0], 0)
+    } for i in logs], total
+
+
+def search_danmakus(query: str, room_id=None, start_time=None, end_time=None, cmds=None, offset=0, limit=20):
+    """
+    搜索作者名和弹幕内容，多个词用空格分隔，要全部匹配。有全文索引时按相关度排序，否则从新到旧
+
+    :param start_time: 开始时间戳（秒），包含
+    :param end_time: 结束时间戳（秒），不包含
+    :param cmds: 只搜索这些cmd的消息
+    :return: (结果列表, 是否还有下一页)，失败时返回None
+    """
+    terms = query.split()
+    if not terms:
+        return [], False
+    tokenizer = get_search_tokenizer()
+    try:
+        with models.database.get_session() as session:
+            q = session.query(
+                LogItem.did, LogItem.lid, LogFile.room_id, LogItem.cmd, LogItem.timestamp, LogItem.author_name,
+                LogItem.content
+            ).join(LogFile, LogFile.lid == LogItem.lid)
+
+            if tokenizer == '':
+                for term in terms:
+                    pattern = _make_like_pattern(term)
+                    q = q.filter(sqlalchemy.or_(
+                        LogItem.author_name.like(pattern, escape='\\'),
+                        LogItem.content.like(pattern, escape='\\')
+                    ))
+                order_by = (LogItem.did.desc(),)
+            else:
+                q = q.join(_search_index_table, _search_index_table.c.rowid == LogItem.did)
+                if tokenizer == 'trigram' and any(len(term) < 3 for term in terms):
+                    # trigram分词器不能MATCH少于3个字符的词，在索引的文本上用LIKE
+                    for term in terms:
+                        pattern = _make_like_pattern(term)
+                        q = q.filter(sqlalchemy.or_(
+                            _search_index_table.c.author_name.like(pattern, escape='\\'),
+                            _search_index_table.c.text.like(pattern, escape='\\')
+                        ))
+                    order_by = (LogItem.did.desc(),)
+                else:
+                    q = q.filter(sqlalchemy.literal_column('danmaku_fts').op('MATCH')(
+                        _make_match_expression(terms, tokenizer)
+                    ))
+                    order_by = (sqlalchemy.literal_column('danmaku_fts.rank'), LogItem.did.desc())
+
+            if room_id is not None:
+                q = q.filter(LogFile.room_id == room_id)
+            if start_time is not None:
+                q = q.filter(LogItem.timestamp >= start_time)
+            if end_time is not None:
+                q = q.filter(LogItem.timestamp < end_time)
+            if cmds:
+                q = q.filter(LogItem.cmd.in_(cmds))
+            rows = q.order_by(*order_by).offset(offset).limit(limit + 1).all()
+    except sqlalchemy.exc.OperationalError:
+        return
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'search_danmakus failed: {e}')
+        return
+    return [{
+        'did': row.did,
+        'lid': row.lid,
+        'room_id': row.room_id,
+        'cmd': row.cmd,
+        'timestamp': row.timestamp,
+        'author_name': row.author_name,
+        'content': row.content
+    } for row in rows[:limit]], len(rows) > limit
+
+
+def _make_like_pattern(term):
+    return '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def _make_match_expression(terms, tokenizer):
+    # 每个词作为一个短语，防止用户输入被当成FTS5的查询语法
+    phrases = ['"' + term.replace('"', '""') + '"' for term in terms]
+    if tokenizer != 'trigram':
+        # 按词分词时只能匹配词的开头
+        phrases = [phrase + '*' for phrase in phrases]
+    return ' '.join(phrases)
@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+
+"""
+历史日志的离线统计
+
+按批流式读取每个日志（包括归档和文件后端的日志），计算每个日志（一场直播）的汇总，保存到统计表里。
+已经统计过的日志不会再统计，每次只处理新的日志。按月的排行之类的在统计表上聚合，不用再读原始弹幕。
+删除日志时统计也会被删除，因为lid可能被新的日志复用
+"""
+
+import asyncio
+import datetime
+import heapq
+import logging
+import re
+import time
+from typing import *
+
+import sqlalchemy
+import sqlalchemy.exc
+from sqlalchemy.sql import func
+
+import config
+import models.database
+import models.log
+
+logger = logging.getLogger(__name__)
+
+# 每次从存储读取的弹幕数
+READ_BATCH_SIZE = 1000
+# 最后一条弹幕在这么久之内的日志可能还在写入（比如另一个进程），先不统计（秒）
+SESSION_IDLE_TIME = 3600
+# 每个日志保存的词数
+WORDS_PER_SESSION = 200
+# 统计词频时内存中最多保留的词数，超过两倍时只保留计数最大的这么多个，所以词频是近似的
+WORD_COUNTER_CAPACITY = 10000
+# 每次执行最多统计的日志数
+MAX_LOGS_PER_RUN = 100
+
+# 以下cmd和api.chat.Command一致
+_CMD_ADD_TEXT = 2
+_CMD_ADD_GIFT = 3
+_CMD_ADD_MEMBER = 4
+_CMD_ADD_SUPER_CHAT = 5
+
+# 英文、数字的单词，或者连续的汉字、假名
+_WORD_PATTERN = re.compile(r'[a-zA-Z0-9]+|[\u3040-\u30ff\u4e00-\u9fff]+')
+
+
+class LogSessionSummary(models.database.OrmBase):
+    __tablename__ = 'log_session_summaries'
+    lid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=False)
+    room_id = sqlalchemy.Column(sqlalchemy.Integer)
+    # 第一条和最后一条弹幕的时间戳（秒），没有时间戳时为None
+    start_time = sqlalchemy.Column(sqlalchemy.Integer)
+    end_time = sqlalchemy.Column(sqlalchemy.Integer)
+    total_count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    text_count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    chatter_count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    gift_count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    gift_coin_total = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False)
+    member_count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    super_chat_count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    super_chat_revenue = sqlalchemy.Column(sqlalchemy.Float, nullable=False)
+    analyze_time = sqlalchemy.Column(sqlalchemy.DateTime, server_default=func.now())
+
+    __table_args__ = (
+        sqlalchemy.Index('ix_log_session_summaries_room_id_start_time', 'room_id', 'start_time'),
+        sqlalchemy.Index('ix_log_session_summaries_start_time', 'start_time'),
+    )
+
+
+class LogSessionChatter(models.database.OrmBase):
+    """
+    每个日志中每个用户的统计，按UID统计，author_name是这个日志中最后使用的用户名。
+    没有记录UID的弹幕（旧的日志、导入的日志）uid为0，按用户名统计
+    """
+    __tablename__ = 'log_session_chatters'
+    lid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=False)
+    uid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=False)
+    author_name = sqlalchemy.Column(sqlalchemy.String(64), primary_key=True)
+    text_count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    gift_coin_total = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False)
+    super_chat_revenue = sqlalchemy.Column(sqlalchemy.Float, nullable=False)
+
+
+class LogSessionWord(models.database.OrmBase):
+    """每个日志中出现次数最多的WORDS_PER_SESSION个词"""
+    __tablename__ = 'log_session_words'
+    lid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=False)
+    word = sqlalchemy.Column(sqlalchemy.String(64), primary_key=True)
+    count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+
+
+def init():
+    cfg = config.get_config()
+    if cfg.log_analytics_interval <= 0:
+        return
+    asyncio.ensure_future(_analytics_loop())
+
+
+async def _analytics_loop():
+    while True:
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, analyze_new_logs, MAX_LOGS_PER_RUN)
+        except Exception:
+            logger.exception('_analytics_loop error:')
+        cfg = config.get_config()
+        await asyncio.sleep(cfg.log_analytics_interval)
+
+
+def extract_words(text):
+    """
+    分词，英文、数字按单词，汉字、假名按相邻两个字（只有一个字时就是这个字），不依赖分词库
+
+    :return: 词的列表
+    """
+    words = []
+    for m in _WORD_PATTERN.finditer(text):
+        word = m[0]
+        if word.isascii():
+            if len(word) >= 2:
+                words.append(word.lower()[:64])
+        elif len(word) == 1:
+            words.append(word)
+        else:
+            words.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return words
+
+
+class _SessionAnalyzer:
+    """统计一个日志，内存占用和用户数、WORD_COUNTER_CAPACITY有关，和弹幕数无关"""
+
+    def __init__(self):
+        self.total_count = 0
+        self.text_count = 0
+        self.gift_count = 0
+        self.gift_coin_total = 0
+        self.member_count = 0
+        self.super_chat_count = 0
+        self.super_chat_revenue = 0
+        self.start_time = None
+        self.end_time = None
+        # UID（没有UID时是用户名） -> [UID, 用户名, 弹幕数, 礼物金瓜子, 醒目留言金额]
+        self.chatters: Dict[Union[int, str], List] = {}
+        self.word_counts: Dict[str, int] = {}
+
+    def add(self, content, uid=None):
+        self.total_count += 1
+        cmd, data = models.log.parse_content(content)
+        if cmd is None:
+            return
+        columns = models.log.extract_columns_safe(cmd, data)
+        timestamp = columns['timestamp']
+        if isinstance(timestamp, (int, float)) and timestamp > 0:
+            timestamp = int(timestamp)
+            self.start_time = timestamp if self.start_time is None else min(self.start_time, timestamp)
+            self.end_time = timestamp if self.end_time is None else max(self.end_time, timestamp)
+
+        author_name = columns['author_name']
+        if not isinstance(author_name, str):
+            author_name = ''
+        author_name = author_name[:64]
+        chatter = None
+        if isinstance(uid, int) and uid > 0:
+            chatter = self.chatters.get(uid, None)
+            if chatter is None:
+                self.chatters[uid] = chatter = [uid, author_name, 0, 0, 0]
+            elif author_name != '':
+                # 用户改名了，用最新的名字
+                chatter[1] = author_name
+        elif author_name != '':
+            chatter = self.chatters.get(author_name, None)
+            if chatter is None:
+                self.chatters[author_name] = chatter = [0, author_name, 0, 0, 0]
+
+        if cmd == _CMD_ADD_TEXT:
+            self.text_count += 1
+            if chatter is not None:
+                chatter[2] += 1
+            _, text = models.log.extract_search_text(cmd, data)
+            if isinstance(text, str):
+                self._add_words(extract_words(text))
+        elif cmd == _CMD_ADD_GIFT:
+            # 只有金瓜子礼物会记录到日志
+            coin = _get_number(data, 'totalCoin')
+            self.gift_count += 1
+            self.gift_coin_total += coin
+            if chatter is not None:
+                chatter[3] += coin
+        elif cmd == _CMD_ADD_MEMBER:
+            self.member_count += 1
+        elif cmd == _CMD_ADD_SUPER_CHAT:
+            # 删除醒目留言的消息也是这个cmd，但是没有price
+            if isinstance(data, dict) and 'price' in data:
+                price = _get_number(data, 'price')
+                self.super_chat_count += 1
+                self.super_chat_revenue += price
+                if chatter is not None:
+                    chatter[4] += price
+
+    def _add_words(self, words):
+        word_counts = self.word_counts
+        for word in words:
+            word_counts[word] = word_counts.get(word, 0) + 1
+        if len(word_counts) > WORD_COUNTER_CAPACITY * 2:
+            self.word_counts = dict(heapq.nlargest(
+                WORD_COUNTER_CAPACITY, word_counts.items(), key=lambda item: item[1]
+            ))
+
+    def get_top_words(self):
+        return heapq.nlargest(WORDS_PER_SESSION, self.word_counts.items(), key=lambda item: item[1])
+
+
+def _get_number(data, key):
+    try:
+        value = data[key]
+    except (LookupError, TypeError):
+        return 0
+    return value if isinstance(value, (int, float)) else 0
+
+
+def analyze_log(lid) -> Optional[_SessionAnalyzer]:
+    """
+    按批流式读取一个日志并统计
+
+    :return: 统计结果，读取失败时返回None
+    """
+    analyzer = _SessionAnalyzer()
+    after_did = 0
+    while True:
+        danmakus = models.log.get_danmaku_batch(lid, after_did, READ_BATCH_SIZE)
+        if danmakus is None:
+            return None
+        if not danmakus:
+            break
+        for _did, _lid, content, uid in danmakus:
+            analyzer.add(content, uid)
+        after_did = danmakus[-1][0]
+    return analyzer
+
+
+def _get_new_logs(max_count):
+    """
+    :return: [(lid, room_id)]，还没统计的日志，正在写入的除外，失败时返回None
+    """
+    active_lids = models.log.get_active_lids()
+    # SQLite的CURRENT_TIMESTAMP是UTC时间
+    before_time = datetime.datetime.utcnow() - datetime.timedelta(seconds=SESSION_IDLE_TIME)
+    try:
+        with models.database.get_session() as session:
+            query = session.query(models.log.LogFile.lid, models.log.LogFile.room_id).filter(
+                models.log.LogFile.create_time < before_time,
+                ~sqlalchemy.exists().where(LogSessionSummary.lid == models.log.LogFile.lid)
+            )
+            if active_lids:
+                query = query.filter(models.log.LogFile.lid.notin_(active_lids))
+            query = query.order_by(models.log.LogFile.lid)
+            if max_count is not None:
+                query = query.limit(max_count)
+            return query.all()
+    except sqlalchemy.exc.OperationalError:
+        return None
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'_get_new_logs failed: {e}')
+        return None
+
+
+def analyze_new_logs(max_count=None):
+    """
+    统计还没统计过的日志，比较慢，应该在线程池中执行
+
+    :param max_count: 最多统计的日志数，为None时统计所有
+    :return: 统计的日志数，失败时返回None
+    """
+    logs = _get_new_logs(max_count)
+    if logs is None:
+        return None
+    start_time = time.perf_counter()
+    count = 0
+    idle_before_timestamp = time.time() - SESSION_IDLE_TIME
+    for lid, room_id in logs:
+        analyzer = analyze_log(lid)
+        if analyzer is None:
+            logger.warning('Failed to read log %d for analytics', lid)
+            continue
+        if analyzer.end_time is not None and analyzer.end_time > idle_before_timestamp:
+            # 可能还在写入
+            continue
+        if not _save_summary(lid, room_id, analyzer):
+            return None
+        count += 1
+    if count != 0:
+        logger.info('Analyzed %d logs in %.3fs', count, time.perf_counter() - start_time)
+    return count
+
+
+def _save_summary(lid, room_id, analyzer: _SessionAnalyzer):
+    """在一个事务里保存一个日志的统计"""
+    try:
+        with models.database.get_session() as session:
+            session.add(LogSessionSummary(
+                lid=lid,
+                room_id=room_id,
+                start_time=analyzer.start_time,
+                end_time=analyzer.end_time,
+                total_count=analyzer.total_count,
+                text_count=analyzer.text_count,
+                chatter_count=len(analyzer.chatters),
+                gift_count=analyzer.gift_count,
+                gift_coin_total=analyzer.gift_coin_total,
+                member_count=analyzer.member_count,
+                super_chat_count=analyzer.super_chat_count,
+                super_chat_revenue=analyzer.super_chat_revenue
+            ))
+            if analyzer.chatters:
+                session.execute(LogSessionChatter.__table__.insert(), [{
+                    'lid': lid,
+                    'uid': uid,
+                    'author_name': author_name,
+                    'text_count': text_count,
+                    'gift_coin_total': gift_coin_total,
+                    'super_chat_revenue': super_chat_revenue
+                } for uid, author_name, text_count, gift_coin_total, super_chat_revenue in analyzer.chatters.values()])
+            top_words = analyzer.get_top_words()
+            if top_words:
+                session.execute(LogSessionWord.__table__.insert(), [
+                    {'lid': lid, 'word': word, 'count': count} for word, count in top_words
+                ])
+            session.commit()
+    except sqlalchemy.exc.OperationalError:
+        return False
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'_save_summary failed: {e}')
+        return False
+    return True
+
+
+def delete_summaries(session, lids):
+    """删除日志的统计，调用者负责提交"""
+    for table in (LogSessionSummary, LogSessionChatter, LogSessionWord):
+        session.query(table).filter(table.lid.in_(lids)).delete(synchronize_session=False)
+
+
+def _filter_sessions(query, room_id, start_time, end_time):
+    """按房间和时间范围筛选日志，时间范围按日志开始时间"""
+    if room_id is not None:
+        query = query.filter(LogSessionSummary.room_id == room_id)
+    if start_time is not None:
+        query = query.filter(LogSessionSummary.start_time >= start_time)
+    if end_time is not None:
+        query = query.filter(LogSessionSummary.start_time < end_time)
+    return query
+
+
+def get_session_summaries(room_id=None, start_time=None, end_time=None, before_lid=None, limit=20):
+    """
+    按lid从新到旧取日志的统计，用上一页最后的lid作为before_lid取下一页
+
+    :return: 统计列表，失败时返回None
+    """
+    try:
+        with models.database.get_session() as session:
+            query = _filter_sessions(session.query(LogSessionSummary), room_id, start_time, end_time)
+            if before_lid is not None:
+                query = query.filter(LogSessionSummary.lid < before_lid)
+            summaries = query.order_by(LogSessionSummary.lid.desc()).limit(limit).all()
+            return [{
+                'lid': summary.lid,
+                'room_id': summary.room_id,
+                'start_time': summary.start_time,
+                'end_time': summary.end_time,
+                'total_count': summary.total_count,
+                'text_count': summary.text_count,
+                'chatter_count': summary.chatter_count,
+                'gift_count': summary.gift_count,
+                'gift_coin_total': summary.gift_coin_total,
+                'member_count': summary.member_count,
+                'super_chat_count': summary.super_chat_count,
+                'super_chat_revenue': summary.super_chat_revenue
+            } for summary in summaries]
+    except sqlalchemy.exc.OperationalError:
+        return None
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'get_session_summaries failed: {e}')
+        return None
+
+
+def get_top_chatters(room_id=None, start_time=None, end_time=None, order_by='text_count', limit=20):
+    """
+    :param order_by: 排序的字段，text_count、gift_coin_total或super_chat_revenue
+    :return: [{'uid', 'author_name', 'session_count', 'text_count', 'gift_coin_total', 'super_chat_revenue'}]，
+             author_name是最近使用的用户名，没有UID的用户uid为0，失败时返回None
+    """
+    # 有UID的按UID聚合，没有UID的按用户名聚合
+    name_key = sqlalchemy.case([(LogSessionChatter.uid == 0, LogSessionChatter.author_name)], else_='')
+    columns = {
+        'text_count': func.sum(LogSessionChatter.text_count),
+        'gift_coin_total': func.sum(LogSessionChatter.gift_coin_total),
+        'super_chat_revenue': func.sum(LogSessionChatter.super_chat_revenue)
+    }
+    try:
+        with models.database.get_session() as session:
+            query = session.query(
+                LogSessionChatter.uid, name_key, func.count(LogSessionChatter.lid), *columns.values()
+            ).join(LogSessionSummary, LogSessionSummary.lid == LogSessionChatter.lid)
+            query = _filter_sessions(query, room_id, start_time, end_time)
+            rows = query.group_by(LogSessionChatter.uid, name_key).having(columns[order_by] > 0).order_by(
+                columns[order_by].desc()
+            ).limit(limit).all()
+
+            # 有UID的用户取最近的日志中的用户名
+            uid_to_name = {}
+            uids = [row[0] for row in rows if row[0] != 0]
+            if uids:
+                name_rows = session.query(LogSessionChatter.uid, LogSessionChatter.author_name).filter(
+                    LogSessionChatter.uid.in_(uids)
+                ).order_by(LogSessionChatter.lid).all()
+                for uid, author_name in name_rows:
+                    uid_to_name[uid] = author_name
+
+            return [{
+                'uid': uid,
+                'author_name': uid_to_name.get(uid, '') if uid != 0 else author_name,
+                'session_count': session_count,
+                'text_count': text_count,
+                'gift_coin_total': gift_coin_total,
+                'super_chat_revenue': super_chat_revenue
+            } for uid, author_name, session_count, text_count, gift_coin_total, super_chat_revenue in rows]
+    except sqlalchemy.exc.OperationalError:
+        return None
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'get_top_chatters failed: {e}')
+        return None
+
+
+def get_top_words(lid=None, room_id=None, start_time=None, end_time=None, limit=50):
+    """
+    :param lid: 只统计一个日志，这时忽略其他筛选条件
+    :return: [(词, 次数)]，失败时返回None
+    """
+    try:
+        with models.database.get_session() as session:
+            count = func.sum(LogSessionWord.count)
+            query = session.query(LogSessionWord.word, count)
+            if lid is not None:
+                query = query.filter(LogSessionWord.lid == lid)
+            else:
+                query = query.join(LogSessionSummary, LogSessionSummary.lid == LogSessionWord.lid)
+                query = _filter_sessions(query, room_id, start_time, end_time)
+            rows = query.group_by(LogSessionWord.word).order_by(count.desc()).limit(limit).all()
+            return [(word, count_) for word, count_ in rows]
+    except sqlalchemy.exc.OperationalError:
+        return None
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'get_top_words failed: {e}')
+        return None
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+
+"""
+冷日志的压缩归档
+
+旧的日志从数据库移到只追加的段文件里。段文件由多个独立压缩的块组成，每块是最多BLOCK_SIZE条弹幕的NDJSON，
+安装了zstandard时用zstd压缩，否则用gzip。数据库里只保存每块的位置和did范围（稀疏索引），
+读取时用mmap随机访问需要的块，不用读整个文件
+
+删除日志、崩溃时写了但没记录的块会在段文件里留下没人引用的字节，compact_segments把还在用的块复制到新的段文件，
+再删除旧的段文件
+
+这个模块只负责存储，把日志移进来、读出来的流程在models.log里
+"""
+
+import collections
+import gzip
+import logging
+import mmap
+import os
+import re
+import threading
+from typing import *
+
+import sqlalchemy
+
+import config
+import models.database
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# 每块最多的弹幕数
+BLOCK_SIZE = 1000
+# 段文件超过这个大小后新建一个
+MAX_SEGMENT_SIZE = 256 * 1024 * 1024
+# 最多同时mmap的段文件数
+MAX_MAPPED_SEGMENTS = 8
+# 最多缓存的解压后的块数，分页查看时连续几页一般在同一块里
+MAX_CACHED_BLOCKS = 16
+# 段文件中没有块引用的字节达到这个比例时整理
+COMPACT_MIN_GARBAGE_RATIO = 0.5
+
+_SEGMENT_FILE_NAME_PATTERN = re.compile(r'^segment-(\d+)\.seg$')
+
+# 同时只能有一个写入者
+_writer_lock = threading.Lock()
+# 段号 -> mmap，按最近使用排序
+_mapped_segments: 'collections.OrderedDict[int, mmap.mmap]' = collections.OrderedDict()
+# (段号, 偏移) -> 弹幕行列表，按最近使用排序
+_block_cache: 'collections.OrderedDict[Tuple[int, int], List[str]]' = collections.OrderedDict()
+_reader_lock = threading.Lock()
+
+
+class ArchiveBlock(models.database.OrmBase):
+    __tablename__ = 'log_archive_blocks'
+    bid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
+    lid = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    segment = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    offset = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False)
+    length = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    # zstd或gzip
+    codec = sqlalchemy.Column(sqlalchemy.String(16), nullable=False)
+    first_did = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    last_did = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    count = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    # 块中弹幕的最大时间戳，保留策略用
+    max_timestamp = sqlalchemy.Column(sqlalchemy.Integer)
+
+    __table_args__ = (
+        sqlalchemy.Index('ix_log_archive_blocks_lid_last_did', 'lid', 'last_did'),
+        sqlalchemy.Index('ix_log_archive_blocks_segment', 'segment'),
+    )
+
+
+def get_archive_dir():
+    return config.get_config().log_archive_dir
+
+
+def _get_segment_path(segment):
+    return os.path.join(get_archive_dir(), f'segment-{segment:06d}.seg')
+
+
+class SegmentWriter:
+    """
+    往最新的段文件追加块，用with语句保证同时只有一个写入者
+
+    写入的块要在数据库中记录之后才算归档了，中途崩溃的话已经写入的字节只是没人引用的垃圾，由compact_segments回收
+    """
+
+    def __init__(self, new_segment=False):
+        """
+        :param new_segment: 为True时写到新的段文件，不接着最新的段文件写
+        """
+        self._new_segment = new_segment
+        self._segment = None
+        self._file = None
+
+    def __enter__(self):
+        _writer_lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self.close()
+        finally:
+            _writer_lock.release()
+
+    def append_block(self, lines: List[str]):
+        """
+        :return: 块的位置，{'segment', 'offset', 'length', 'codec'}
+        """
+        codec, data = _compress('\n'.join(lines).encode('utf-8'))
+        return self.append_raw(codec, data)
+
+    def append_raw(self, codec, data: bytes):
+        """
+        追加已经压缩的块，整理时用
+
+        :return: 块的位置，见append_block
+        """
+        if self._file is None or self._file.tell() + len(data) > MAX_SEGMENT_SIZE:
+            self._open_next_segment()
+        offset = self._file.tell()
+        self._file.write(data)
+        return {'segment': self._segment, 'offset': offset, 'length': len(data), 'codec': codec}
+
+    def _open_next_segment(self):
+        if self._file is None:
+            # 接着最新的段文件写
+            os.makedirs(get_archive_dir(), exist_ok=True)
+            segments = _list_segments()
+            segment = max(segments, default=1)
+            path = _get_segment_path(segment)
+            if os.path.exists(path) and (self._new_segment or os.path.getsize(path) >= MAX_SEGMENT_SIZE):
+                segment += 1
+        else:
+            self.close()
+            segment = self._segment + 1
+        self._segment = segment
+        self._file = open(_get_segment_path(segment), 'ab')
+
+    def sync(self):
+        """在数据库中记录块之前调用，保证块已经写到磁盘上"""
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+
+def _list_segments():
+    try:
+        file_names = os.listdir(get_archive_dir())
+    except OSError:
+        return []
+    segments = []
+    for file_name in file_names:
+        m = _SEGMENT_FILE_NAME_PATTERN.match(file_name)
+        if m is not None:
+            segments.append(int(m[1]))
+    return segments
+
+
+def _compress(data: bytes):
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=9).compress(data)
+    return 'gzip', gzip.compress(data, 6)
+
+
+def _decompress(codec, data: bytes):
+    """
+    :raise ValueError: 数据损坏，或者没安装zstandard
+    """
+    if codec == 'zstd' and zstandard is None:
+        raise ValueError('zstandard is required to read this archive block')
+    try:
+        if codec == 'zstd':
+            return zstandard.ZstdDecompressor().decompress(data)
+        return gzip.decompress(data)
+    except Exception as e:
+        raise ValueError(f'Failed to decompress archive block: {e}') from e
+
+
+def read_block(block: ArchiveBlock) -> List[str]:
+    """
+    :return: 块中的弹幕行，每行是一条弹幕的JSON
+    """
+    key = (block.segment, block.offset)
+    with _reader_lock:
+        lines = _block_cache.get(key, None)
+        if lines is not None:
+            _block_cache.move_to_end(key)
+            return lines
+        data = _read_bytes(block.segment, block.offset, block.length)
+
+    lines = _decompress(block.codec, data).decode('utf-8').split('\n')
+    with _reader_lock:
+        _block_cache[key] = lines
+        while len(_block_cache) > MAX_CACHED_BLOCKS:
+            _block_cache.popitem(last=False)
+    return lines
+
+
+def _read_bytes(segment, offset, length):
+    """调用者要持有_reader_lock"""
+    mapped = _mapped_segments.get(segment, None)
+    # 段文件是只追加的，mmap之后又写入的部分要重新mmap才能读到
+    if mapped is None or offset + length > len(mapped):
+        if mapped is not None:
+            mapped.close()
+        with open(_get_segment_path(segment), 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _mapped_segments[segment] = mapped
+        while len(_mapped_segments) > MAX_MAPPED_SEGMENTS:
+            _mapped_segments.popitem(last=False)[1].close()
+    _mapped_segments.move_to_end(segment)
+    return mapped[offset:offset + length]
+
+
+def get_blocks(session, lid, after_did=0, limit=None) -> List[ArchiveBlock]:
+    """按did顺序取一个日志包含did大于after_did的弹幕的块"""
+    query = session.query(ArchiveBlock).filter(
+        ArchiveBlock.lid == lid, ArchiveBlock.last_did > after_did
+    ).order_by(ArchiveBlock.first_did)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+def get_last_archived_did(session, lid):
+    """
+    :return: 日志中归档的最大did，没有归档时返回None
+    """
+    return session.query(sqlalchemy.func.max(ArchiveBlock.last_did)).filter(ArchiveBlock.lid == lid).scalar()
+
+
+def get_danmaku_counts(session, lids):
+    """
+    :return: {lid: 归档的弹幕数}
+    """
+    if not lids:
+        return {}
+    return dict(session.query(ArchiveBlock.lid, sqlalchemy.func.sum(ArchiveBlock.count)).filter(
+        ArchiveBlock.lid.in_(lids)
+    ).group_by(ArchiveBlock.lid).all())
+
+
+def get_lids_before(session, timestamp):
+    """
+    :return: 所有弹幕的时间戳都早于timestamp的归档日志
+    """
+    return [row.lid for row in session.query(ArchiveBlock.lid).group_by(ArchiveBlock.lid).having(
+        sqlalchemy.func.max(ArchiveBlock.max_timestamp) < timestamp
+    )]
+
+
+def get_lids_without_timestamp(session):
+    """
+    :return: 所有弹幕都没有时间戳的归档日志，调用者按日志的创建时间判断是否过期
+    """
+    return [row.lid for row in session.query(ArchiveBlock.lid).group_by(ArchiveBlock.lid).having(
+        sqlalchemy.func.max(ArchiveBlock.max_timestamp).is_(None)
+    )]
+
+
+def delete_blocks(session, lid):
+    """
+    删除一个日志的块的索引，段文件要在提交后调用remove_unused_segments删除
+
+    :return: 受影响的段号
+    """
+    segments = {row.segment for row in session.query(ArchiveBlock.segment).filter(ArchiveBlock.lid == lid).distinct()}
+    session.query(ArchiveBlock).filter(ArchiveBlock.lid == lid).delete(synchronize_session=False)
+    return segments
+
+
+def remove_unused_segments(segments):
+    """删除没有块引用的段文件，正在写入的最新段除外"""
+    if not segments:
+        return
+    with _writer_lock:
+        latest_segment = max(_list_segments(), default=None)
+        with models.database.get_session() as session:
+            used_segments = {row.segment for row in session.query(ArchiveBlock.segment).filter(
+                ArchiveBlock.segment.in_(segments)
+            ).distinct()}
+        for segment in set(segments) - used_segments:
+            if segment == latest_segment:
+                continue
+            _remove_segment(segment)
+
+
+def _remove_segment(segment):
+    """调用者要持有_writer_lock"""
+    with _reader_lock:
+        mapped = _mapped_segments.pop(segment, None)
+        if mapped is not None:
+            # Windows上不能删除还在映射的文件
+            mapped.close()
+        for key in [key for key in _block_cache if key[0] == segment]:
+            del _block_cache[key]
+    try:
+        os.remove(_get_segment_path(segment))
+    except OSError:
+        logger.exception('Failed to remove archive segment %d:', segment)
+
+
+def compact_segments(max_count=1):
+    """
+    整理没有块引用的字节多的段文件，把还在用的块原样复制到新的段文件，更新数据库中块的位置，再删除旧的段文件。
+    中途崩溃的话，更新数据库之前旧的块还在用，复制的字节是垃圾，之后再整理。比较慢，应该在线程池中执行
+
+    :return: 整理的段数
+    """
+    count = 0
+    with SegmentWriter(new_segment=True) as writer:
+        for segment in _get_segments_to_compact(max_count):
+            _compact_segment(writer, segment)
+            count += 1
+    return count
+
+
+def _get_segments_to_compact(max_count):
+    """调用者要持有_writer_lock，这时所有写入的块都已经记录到数据库了"""
+    with models.database.get_session() as session:
+        used_sizes = dict(session.query(ArchiveBlock.segment, sqlalchemy.func.sum(ArchiveBlock.length)).group_by(
+            ArchiveBlock.segment
+        ).all())
+    res = []
+    for segment in sorted(_list_segments()):
+        try:
+            size = os.path.getsize(_get_segment_path(segment))
+        except OSError:
+            continue
+        used_size = used_sizes.get(segment, 0)
+        if used_size == 0 or size - used_size >= size * COMPACT_MIN_GARBAGE_RATIO:
+            res.append(segment)
+            if len(res) >= max_count:
+                break
+    return res
+
+
+def _compact_segment(writer: SegmentWriter, segment):
+    with models.database.get_session() as session:
+        blocks = session.query(ArchiveBlock.bid, ArchiveBlock.offset, ArchiveBlock.length, ArchiveBlock.codec).filter(
+            ArchiveBlock.segment == segment
+        ).order_by(ArchiveBlock.offset).all()
+
+    # (bid, 旧的偏移, 新的位置)
+    moves = []
+    for block in blocks:
+        with _reader_lock:
+            data = _read_bytes(segment, block.offset, block.length)
+        moves.append((block.bid, block.offset, writer.append_raw(block.codec, data)))
+    writer.sync()
+
+    with models.database.get_session() as session:
+        for bid, old_offset, location in moves:
+            # 整理时日志可能被删除了，这时什么都不更新，复制的块成为新的垃圾
+            session.query(ArchiveBlock).filter(
+                ArchiveBlock.bid == bid, ArchiveBlock.segment == segment, ArchiveBlock.offset == old_offset
+            ).update({'segment': location['segment'], 'offset': location['offset']}, synchronize_session=False)
+        session.commit()
+        is_used = session.query(ArchiveBlock.bid).filter(ArchiveBlock.segment == segment).first() is not None
+    if not is_used:
+        _remove_segment(segment)
+    logger.info('Compacted archive segment %d, moved %d blocks', segment, len(moves))
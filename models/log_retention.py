@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+日志的保留策略
+
+定期删除超过保留天数的弹幕，以及每个房间超过行数、大小限制的最旧的弹幕。每批删除一个短事务，
+批之间释放锁，不会长时间阻塞写入弹幕。每个房间的行数、大小来自每个日志增量更新的计数，不用扫描弹幕表。然后把超过一定天数的日志移到压缩归档里，见models.log_archive。
+翻译记录也在这里限制条数
+"""
+
+import asyncio
+import datetime
+import logging
+import time
+
+import sqlalchemy.exc
+
+import config
+import metrics
+import models.database
+import models.log
+import models.translate
+
+logger = logging.getLogger(__name__)
+
+# 每批之间的间隔（秒），让写入弹幕的线程有机会拿到锁
+BATCH_INTERVAL = 0.05
+# 每次执行最多删除的批数，剩下的下次再删，防止一次占用数据库太久
+MAX_BATCHES_PER_RUN = 1000
+# 每次执行最多归档的日志数
+MAX_ARCHIVE_LOGS_PER_RUN = 10
+# 每次执行最多整理的归档段文件数
+MAX_COMPACT_SEGMENTS_PER_RUN = 1
+# 每次执行后SQLite增量回收的最大页数，只有auto_vacuum=INCREMENTAL时有效
+INCREMENTAL_VACUUM_PAGES = 10000
+
+_deleted_counter = metrics.Counter(
+    'blivechat_log_retention_deleted_danmakus_total', 'Number of danmakus deleted by the log retention policy',
+    ('reason',)
+)
+
+
+def init():
+    if not is_enabled():
+        return
+    asyncio.ensure_future(_retention_loop())
+
+
+def is_enabled():
+    cfg = config.get_config()
+    return (
+        cfg.log_retention_days > 0 or cfg.log_max_rows_per_room > 0 or cfg.log_max_bytes_per_room > 0
+        or cfg.log_archive_after_days > 0 or cfg.translation_record_max_rows > 0
+    )
+
+
+async def _retention_loop():
+    while True:
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, run_retention)
+        except Exception:
+            logger.exception('_retention_loop error:')
+        cfg = config.get_config()
+        await asyncio.sleep(cfg.log_retention_interval)
+
+
+def run_retention():
+    """执行一次保留策略，比较慢，应该在线程池中执行"""
+    start_time = time.perf_counter()
+    remaining_batches = MAX_BATCHES_PER_RUN
+    cfg = config.get_config()
+
+    age_count = 0
+    if cfg.log_retention_days > 0:
+        before_timestamp = int(time.time() - cfg.log_retention_days * 24 * 3600)
+        while remaining_batches > 0:
+            count = models.log.delete_danmakus_before(before_timestamp)
+            if not count:
+                break
+            remaining_batches -= 1
+            age_count += count
+            _deleted_counter.labels('age').inc(count)
+            time.sleep(BATCH_INTERVAL)
+        # 归档的日志和文件后端的日志整个删除
+        for lid in (models.log.get_archived_lids_before(before_timestamp) or []) \
+                + (models.log.get_expired_file_log_lids(before_timestamp) or []):
+            if models.log.delete_danmaku_by_file(lid):
+                logger.info('Log retention deleted log %d', lid)
+
+    room_count = 0
+    if (cfg.log_max_rows_per_room > 0 or cfg.log_max_bytes_per_room > 0) and remaining_batches > 0:
+        models.log.backfill_log_usages()
+        room_usages = models.log.get_room_usages()
+        for room_id, (row_count, byte_count) in (room_usages or {}).items():
+            excess_rows = row_count - cfg.log_max_rows_per_room if cfg.log_max_rows_per_room > 0 else 0
+            excess_bytes = byte_count - cfg.log_max_bytes_per_room if cfg.log_max_bytes_per_room > 0 else 0
+            if excess_rows <= 0 and excess_bytes <= 0:
+                continue
+            count, remaining_batches = _delete_room_excess(room_id, excess_rows, excess_bytes, remaining_batches)
+            room_count += count
+            if remaining_batches <= 0:
+                break
+
+    archive_count = 0
+    if cfg.log_archive_after_days > 0:
+        # SQLite的CURRENT_TIMESTAMP是UTC时间
+        before_time = datetime.datetime.utcnow() - datetime.timedelta(days=cfg.log_archive_after_days)
+        archive_count = models.log.archive_old_log_files(before_time, MAX_ARCHIVE_LOGS_PER_RUN) or 0
+    # 回收删除的归档日志、崩溃时没记录的块占用的空间
+    models.log.compact_archive(MAX_COMPACT_SEGMENTS_PER_RUN)
+
+    translation_count = 0
+    if cfg.translation_record_max_rows > 0:
+        while remaining_batches > 0:
+            count = models.translate.delete_old_translation_records(cfg.translation_record_max_rows)
+            if not count:
+                break
+            remaining_batches -= 1
+            translation_count += count
+            time.sleep(BATCH_INTERVAL)
+
+    log_file_count = 0
+    if age_count != 0 or room_count != 0 or archive_count != 0 or translation_count != 0:
+        log_file_count = models.log.delete_empty_log_files() or 0
+        _incremental_vacuum()
+        logger.info('Log retention deleted %d expired danmakus, %d danmakus over room limits, %d empty logs, '
+                    '%d old translation records, archived %d logs in %.3fs', age_count, room_count, log_file_count,
+                    translation_count, archive_count, time.perf_counter() - start_time)
+    return age_count, room_count, log_file_count, archive_count
+
+
+def _delete_room_excess(room_id, excess_rows, excess_bytes, remaining_batches):
+    """
+    :return: (删除的弹幕数, 剩余批数)
+    """
+    deleted_count = 0
+    # 行数和大小限制都要满足
+    while (excess_rows > 0 or excess_bytes > 0) and remaining_batches > 0:
+        res = models.log.delete_oldest_danmakus_of_room(room_id, max(excess_rows, 0), max(excess_bytes, 0))
+        if not res or res[0] == 0:
+            break
+        count, byte_count = res
+        remaining_batches -= 1
+        deleted_count += count
+        excess_rows -= count
+        excess_bytes -= byte_count
+        _deleted_counter.labels('room_limit').inc(count)
+        time.sleep(BATCH_INTERVAL)
+    return deleted_count, remaining_batches
+
+
+def _incremental_vacuum():
+    """
+    SQLite删除的页默认留在文件里给之后的写入复用。如果数据库设置了auto_vacuum=INCREMENTAL，
+    每次回收一部分空闲页，不像VACUUM那样锁住整个数据库
+    """
+    engine = models.database.engine
+    if engine.dialect.name != 'sqlite':
+        return
+    try:
+        with engine.connect() as connection:
+            if connection.execute('PRAGMA auto_vacuum').scalar() == 2:
+                connection.execute(f'PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES})')
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception('_incremental_vacuum failed:')
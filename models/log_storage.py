@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+
+"""
+弹幕日志的存储后端
+
+日志的元数据（log_records表）总是在数据库里，弹幕存在哪里由后端决定。数据库后端在models.log里，
+这里是文件后端：每个日志一个目录，弹幕按NDJSON追加到段文件里，每隔一段时间flush和fsync，不用每条弹幕一个INSERT。
+目录里还有一个稀疏索引文件，每INDEX_INTERVAL条弹幕记录一次位置，读取时从最近的位置开始扫描
+"""
+
+import abc
+import asyncio
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import *
+
+import config
+import serializer
+
+logger = logging.getLogger(__name__)
+
+# 段文件超过这个大小后新建一个
+MAX_SEGMENT_SIZE = 64 * 1024 * 1024
+# 每多少条弹幕在索引里记录一次位置
+INDEX_INTERVAL = 1000
+# 多久把缓冲区写到操作系统（秒）
+FLUSH_INTERVAL = 1
+# 多久没写入就关闭文件（秒）
+IDLE_CLOSE_TIME = 60
+
+_INDEX_FILE_NAME = 'index'
+
+
+class LogStorage(abc.ABC):
+    """存储后端的接口，did在一个日志内按写入顺序递增"""
+
+    # 保存在log_records.storage里的名字
+    name = ''
+
+    def init(self):
+        pass
+
+    @abc.abstractmethod
+    def add_danmaku(self, lid, content: str, columns: dict, uid, cmd, data):
+        """
+        :param columns: 从消息中提取的列，见models.log.extract_columns
+        :param cmd: 消息的cmd，解析失败时为None
+        :param data: 消息的data
+        :return: 是否成功
+        """
+
+    def close_log(self, lid):
+        """日志不再写入了，在事件循环线程调用"""
+
+    @abc.abstractmethod
+    def get_danmaku_batch(self, lid, after_did, limit) -> Optional[List[Tuple[int, int, str, Optional[int]]]]:
+        """
+        :return: [(did, lid, content, uid)]，失败时返回None
+        """
+
+    @abc.abstractmethod
+    def get_danmakus_by_file(self, lid) -> Optional[List[str]]:
+        """
+        :return: 日志的所有弹幕，每条是一个JSON，失败时返回None
+        """
+
+    @abc.abstractmethod
+    def get_danmaku_counts(self, lids) -> Dict[int, int]:
+        """
+        :return: {lid: 弹幕数}
+        """
+
+    @abc.abstractmethod
+    def delete_danmakus(self, lid):
+        """
+        删除日志的所有弹幕，比较慢，应该在线程池中执行。调用之前日志的写入已经结束了
+
+        :return: 是否成功
+        """
+
+
+class FileLogStorage(LogStorage):
+    name = 'file'
+
+    def __init__(self):
+        # lid -> 正在写入的文件
+        self._writers: Dict[int, '_LogWriter'] = {}
+        # 保护_writers和_deleting_lids，写入在事件循环线程，删除在线程池
+        self._writers_lock = threading.Lock()
+        # 正在删除的日志，不允许写入，否则会重新创建目录
+        self._deleting_lids: Set[int] = set()
+        self._fsync_interval = 5
+
+    def init(self):
+        cfg = config.get_config()
+        self._fsync_interval = cfg.log_file_fsync_interval
+        asyncio.ensure_future(self._flush_loop())
+
+    @staticmethod
+    def get_log_dir(lid):
+        return os.path.join(config.get_config().log_file_dir, str(lid))
+
+    def add_danmaku(self, lid, content: str, columns: dict, uid, cmd, data):
+        with self._writers_lock:
+            if lid in self._deleting_lids:
+                logger.warning('FileLogStorage log %d is being deleted', lid)
+                return False
+            writer = self._writers.get(lid, None)
+            try:
+                if writer is None:
+                    self._writers[lid] = writer = _LogWriter(self.get_log_dir(lid), lid)
+                writer.append(content, columns, uid)
+            except (OSError, ValueError):
+                logger.exception('FileLogStorage failed to write log %d:', lid)
+                return False
+        return True
+
+    def close_log(self, lid):
+        with self._writers_lock:
+            writer = self._writers.pop(lid, None)
+            if writer is not None:
+                writer.close()
+
+    async def _flush_loop(self):
+        last_sync_time = time.monotonic()
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                cur_time = time.monotonic()
+                with self._writers_lock:
+                    for writer in self._writers.values():
+                        writer.flush()
+                if cur_time - last_sync_time >= self._fsync_interval:
+                    last_sync_time = cur_time
+                    await self._sync_and_close_idle()
+            except Exception:
+                logger.exception('FileLogStorage._flush_loop error:')
+
+    async def _sync_and_close_idle(self):
+        with self._writers_lock:
+            writers = list(self._writers.values())
+        # fsync可能比较慢，放到线程池里
+        await asyncio.get_event_loop().run_in_executor(None, _sync_writers, writers)
+
+        cur_time = time.monotonic()
+        with self._writers_lock:
+            for writer in writers:
+                if (
+                    cur_time - writer.last_write_time >= IDLE_CLOSE_TIME
+                    and self._writers.get(writer.lid, None) is writer
+                ):
+                    del self._writers[writer.lid]
+                    writer.close()
+
+    def get_danmaku_batch(self, lid, after_did, limit):
+        try:
+            res = []
+            for line in _iter_lines(self.get_log_dir(lid), after_did + 1):
+                danmaku = serializer.loads(line)
+                res.append((danmaku['did'], danmaku['lid'], danmaku['content'], danmaku.get('uid', None)))
+                if len(res) >= limit:
+                    break
+            return res
+        except (OSError, ValueError, LookupError):
+            logger.exception('FileLogStorage failed to read log %d:', lid)
+            return None
+
+    def get_danmakus_by_file(self, lid):
+        try:
+            return list(_iter_lines(self.get_log_dir(lid), 1))
+        except OSError:
+            logger.exception('FileLogStorage failed to read log %d:', lid)
+            return None
+
+    def get_danmaku_counts(self, lids):
+        res = {}
+        for lid in lids:
+            with self._writers_lock:
+                writer = self._writers.get(lid, None)
+                if writer is not None:
+                    res[lid] = writer.next_did - 1
+                    continue
+            try:
+                res[lid] = _recover(self.get_log_dir(lid))[0] - 1
+            except OSError:
+                logger.exception('FileLogStorage failed to count log %d:', lid)
+        return res
+
+    def get_last_timestamp(self, lid):
+        """
+        :return: 日志最后一条弹幕的时间戳，没有时返回None
+        """
+        timestamp = None
+        try:
+            log_dir = self.get_log_dir(lid)
+            # 最后几条可能没有时间戳，从最后一个索引位置开始找
+            for line in _iter_lines(log_dir, _find_start(log_dir, float('inf'))[0]):
+                timestamp = serializer.loads(line).get('timestamp', None) or timestamp
+        except (OSError, ValueError):
+            logger.exception('FileLogStorage failed to read log %d:', lid)
+            return None
+        return timestamp
+
+    def delete_danmakus(self, lid):
+        lid = int(lid)
+        with self._writers_lock:
+            self._deleting_lids.add(lid)
+            # 一般在结束写入时已经关闭了
+            writer = self._writers.pop(lid, None)
+            if writer is not None:
+                writer.close()
+        try:
+            shutil.rmtree(self.get_log_dir(lid))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logger.exception('FileLogStorage failed to delete log %d:', lid)
+            return False
+        finally:
+            with self._writers_lock:
+                self._deleting_lids.discard(lid)
+        return True
+
+
+def _sync_writers(writers: List['_LogWriter']):
+    for writer in writers:
+        try:
+            writer.sync()
+        except (OSError, ValueError):
+            # 可能在其他线程被关闭了
+            pass
+
+
+def _get_segment_path(log_dir, segment):
+    return os.path.join(log_dir, f'{segment:06d}.ndjson')
+
+
+def _read_index(log_dir) -> List[Tuple[int, int, int]]:
+    """
+    :return: [(did, 段号, 偏移)]，按did排序
+    """
+    entries = []
+    try:
+        with open(os.path.join(log_dir, _INDEX_FILE_NAME), 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                # 最后一行可能没写完
+                if len(fields) == 3:
+                    entries.append((int(fields[0]), int(fields[1]), int(fields[2])))
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def _find_start(log_dir, did):
+    """
+    :return: 从哪里开始扫描能找到did，(did, 段号, 偏移)
+    """
+    entries = [entry for entry in _read_index(log_dir) if entry[0] <= did]
+    # 崩溃时索引可能比段文件写得多，跳过指向文件结尾之后的位置
+    for entry in reversed(entries):
+        try:
+            if os.path.getsize(_get_segment_path(log_dir, entry[1])) >= entry[2]:
+                return entry
+        except FileNotFoundError:
+            pass
+    return 1, 1, 0
+
+
+def _iter_lines(log_dir, start_did):
+    """按顺序返回did不小于start_did的弹幕行，索引只是提示，扫描时以段文件为准"""
+    did, segment, offset = _find_start(log_dir, start_did)
+    while True:
+        try:
+            f = open(_get_segment_path(log_dir, segment), 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # 还没写完的行
+                    return
+                if did >= start_did:
+                    yield line[:-1].decode('utf-8')
+                did += 1
+        segment += 1
+        offset = 0
+
+
+def _recover(log_dir):
+    """
+    从索引和段文件找到写入的位置
+
+    :return: (下一个did, 最后一个段号, 最后一个段文件中完整的行的结尾位置)
+    """
+    did, segment, offset = _find_start(log_dir, float('inf'))
+    while True:
+        try:
+            f = open(_get_segment_path(log_dir, segment), 'rb')
+        except FileNotFoundError:
+            if segment == 1 or offset != 0:
+                return did, segment, offset
+            # 上一个段文件是最后一个
+            return did, segment - 1, os.path.getsize(_get_segment_path(log_dir, segment - 1))
+        with f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                did += 1
+        if not os.path.exists(_get_segment_path(log_dir, segment + 1)):
+            return did, segment, offset
+        segment += 1
+        offset = 0
+
+
+class _LogWriter:
+    def __init__(self, log_dir, lid):
+        self.lid = lid
+        self._log_dir = log_dir
+        os.makedirs(log_dir, exist_ok=True)
+        # 接着之前写的继续写，比如因为空闲被关闭之后，或者崩溃之后
+        self.next_did, self._segment, offset = _recover(log_dir)
+        self._file = open(_get_segment_path(log_dir, self._segment), 'ab')
+        if self._file.tell() != offset:
+            # 崩溃时没写完的行
+            self._file.truncate(offset)
+            self._file.seek(offset)
+        self._index_file = open(os.path.join(log_dir, _INDEX_FILE_NAME), 'a', encoding='utf-8')
+        self.last_write_time = time.monotonic()
+
+    def append(self, content: str, columns: dict, uid):
+        line = serializer.dumps({
+            'did': self.next_did,
+            'lid': self.lid,
+            'content': content,
+            'uid': uid,
+            **columns
+        }).encode('utf-8') + b'\n'
+
+        offset = self._file.tell()
+        if offset != 0 and offset + len(line) > MAX_SEGMENT_SIZE:
+            self._file.close()
+            self._segment += 1
+            self._file = open(_get_segment_path(self._log_dir, self._segment), 'ab')
+            offset = 0
+        if offset == 0 or (self.next_did - 1) % INDEX_INTERVAL == 0:
+            self._index_file.write(f'{self.next_did} {self._segment} {offset}\n')
+
+        self._file.write(line)
+        self.next_did += 1
+        self.last_write_time = time.monotonic()
+
+    def flush(self):
+        self._file.flush()
+        self._index_file.flush()
+
+    def sync(self):
+        os.fsync(self._file.fileno())
+        os.fsync(self._index_file.fileno())
+
+    def close(self):
+        self._file.close()
+        self._index_file.close()
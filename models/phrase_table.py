@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import mmap
+import os
+import struct
+from typing import *
+
+# 文件格式：
+# 文件头：魔数(8字节) 短语数量(uint32) 保留(uint32)
+# 索引：按key的UTF-8字节序排序，每项为 key偏移 key长度 value偏移 value长度(uint32 * 4)，偏移相对文件开头
+# 数据：key和value的UTF-8字节
+MAGIC = b'BLCPTBL1'
+HEADER_STRUCT = struct.Struct('<8sII')
+INDEX_ITEM_STRUCT = struct.Struct('<IIII')
+
+
+class PhraseTable:
+    """只读的短语表，用mmap打开，查询时二分查找，不需要把整个表读进内存"""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self._file.close()
+            raise
+
+        magic, self._size, _ = HEADER_STRUCT.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f'Invalid phrase table file: {path}')
+
+    def __len__(self):
+        return self._size
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def get(self, key: str) -> Optional[str]:
+        key_bytes = key.encode('utf-8')
+        low = 0
+        high = self._size
+        while low < high:
+            mid = (low + high) // 2
+            key_offset, key_len, value_offset, value_len = INDEX_ITEM_STRUCT.unpack_from(
+                self._mmap, HEADER_STRUCT.size + mid * INDEX_ITEM_STRUCT.size
+            )
+            mid_key = self._mmap[key_offset: key_offset + key_len]
+            if mid_key < key_bytes:
+                low = mid + 1
+            elif mid_key > key_bytes:
+                high = mid
+            else:
+                return self._mmap[value_offset: value_offset + value_len].decode('utf-8')
+        return None
+
+
+def build(path, phrases: Dict[str, str]):
+    """
+    生成短语表文件，先写临时文件再替换，防止运行中的服务读到写了一半的文件
+
+    :param path: 输出路径
+    :param phrases: 缓存key -> 翻译
+    """
+    items = sorted((key.encode('utf-8'), value.encode('utf-8')) for key, value in phrases.items())
+
+    index = []
+    offset = HEADER_STRUCT.size + len(items) * INDEX_ITEM_STRUCT.size
+    for key, value in items:
+        index.append(INDEX_ITEM_STRUCT.pack(offset, len(key), offset + len(key), len(value)))
+        offset += len(key) + len(value)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER_STRUCT.pack(MAGIC, len(items), 0))
+        f.writelines(index)
+        for key, value in items:
+            f.write(key)
+            f.write(value)
+    os.replace(tmp_path, path)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""
+B站房间信息的缓存，RoomInfoHandler和Room共用
+
+成功和失败的结果分别缓存不同的时间，同一个房间同时只会请求一次
+"""
+
+import asyncio
+import collections
+import logging
+import time
+from typing import *
+
+import aiohttp
+
+import blivedm.blivedm as blivedm
+import config
+import http_client
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 最多缓存的房间数
+MAX_CACHE_SIZE = 10000
+
+RoomInfo = collections.namedtuple('RoomInfo', ('room_id', 'short_id', 'owner_uid'))
+
+# 请求的房间ID（可能是短号） -> (过期时间, RoomInfo)，RoomInfo为None表示获取失败
+_room_info_cache: Dict[int, Tuple[float, Optional[RoomInfo]]] = {}
+# 正在获取房间信息的Future，请求的房间ID -> Future
+_room_id_fetch_future_map: Dict[int, asyncio.Future] = {}
+
+_request_counter = metrics.Counter(
+    'blivechat_room_info_requests_total', 'Number of room info lookups by where the result came from', ('source',)
+)
+_cache_hit_counter = _request_counter.labels('cache')
+_coalesced_counter = _request_counter.labels('coalesced')
+_web_counter = _request_counter.labels('web')
+metrics.Gauge('blivechat_room_info_cache_size', 'Number of room info entries cached in memory',
+              collect_func=lambda: [((), len(_room_info_cache))])
+
+
+async def get_room_info(room_id) -> Optional[RoomInfo]:
+    """
+    :param room_id: 房间ID或短号
+    :return: 获取失败时返回None
+    """
+    entry = _room_info_cache.get(room_id, None)
+    if entry is not None:
+        expire_time, room_info = entry
+        if time.monotonic() < expire_time:
+            _cache_hit_counter.inc()
+            return room_info
+        _room_info_cache.pop(room_id, None)
+
+    # 如果已有正在获取的future则等待它，防止重复请求同一个房间
+    future = _room_id_fetch_future_map.get(room_id, None)
+    if future is not None:
+        _coalesced_counter.inc()
+    else:
+        _web_counter.inc()
+        _room_id_fetch_future_map[room_id] = future = asyncio.ensure_future(_fetch_room_info(room_id))
+        future.add_done_callback(lambda _future: _room_id_fetch_future_map.pop(room_id, None))
+    # 一个调用者被取消时不要取消其他调用者共用的请求
+    return await asyncio.shield(future)
+
+
+async def _fetch_room_info(room_id) -> Optional[RoomInfo]:
+    room_info = await _get_room_info_from_web(room_id)
+    cfg = config.get_config()
+    if room_info is None:
+        _update_cache(room_id, None, cfg.room_info_failure_cache_ttl)
+    else:
+        # 长号和短号都缓存
+        for id_ in {room_id, room_info.room_id, room_info.short_id} - {0}:
+            _update_cache(id_, room_info, cfg.room_info_cache_ttl)
+    return room_info
+
+
+async def _get_room_info_from_web(room_id) -> Optional[RoomInfo]:
+    try:
+        async with http_client.get(blivedm.ROOM_INIT_URL, params={'room_id': room_id}) as res:
+            if res.status != 200:
+                logger.warning('room %d _get_room_info_from_web failed: %d %s', room_id,
+                               res.status, res.reason)
+                return None
+            data = await res.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        # ValueError是返回的不是JSON
+        logger.exception('room %d _get_room_info_from_web failed', room_id)
+        return None
+
+    try:
+        if data['code'] != 0:
+            logger.warning('room %d _get_room_info_from_web failed: %s', room_id, data['message'])
+            return None
+
+        room_info = data['data']['room_info']
+        return RoomInfo(room_info['room_id'], room_info['short_id'], room_info['uid'])
+    except (LookupError, TypeError):
+        # 接口返回的格式变了
+        logger.exception('room %d _get_room_info_from_web failed to parse response: %s', room_id, data)
+        return None
+
+
+def _update_cache(room_id, room_info: Optional[RoomInfo], ttl):
+    if ttl <= 0:
+        return
+    _room_info_cache.pop(room_id, None)
+    _room_info_cache[room_id] = (time.monotonic() + ttl, room_info)
+    while len(_room_info_cache) > MAX_CACHE_SIZE:
+        _room_info_cache.pop(next(iter(_room_info_cache)), None)
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+
+"""
+房间的实时统计
+
+Room处理每个事件时增量更新，所有结构都是固定大小的，内存占用和流量无关：
+按分钟的环形窗口统计弹幕数、礼物金瓜子、醒目留言金额；HyperLogLog估算发言人数；Space-Saving算法估算礼物前几名。
+一次转发对应一个日志，统计的快照按日志保存到数据库：转发时定期保存，房间关闭、进程退出时再保存一次。
+删除日志时快照也会被删除
+"""
+
+import logging
+import math
+import time
+from typing import *
+
+import sqlalchemy
+import sqlalchemy.exc
+
+import models.database
+import serializer
+
+logger = logging.getLogger(__name__)
+
+# 窗口的桶数，每个桶一分钟
+WINDOW_MINUTES = 60
+# 最近一小时发言人数的HyperLogLog桶的时长（分钟）
+CHATTER_BUCKET_MINUTES = 5
+# 整场发言人数的HyperLogLog精度，寄存器数是2 ** precision，标准误差约1.04 / sqrt(2 ** precision)
+TOTAL_CHATTERS_PRECISION = 12
+# 最近一小时发言人数的HyperLogLog精度
+WINDOW_CHATTERS_PRECISION = 10
+# Space-Saving跟踪的送礼人数，越大前几名越准
+TOP_GIFTERS_CAPACITY = 100
+# 返回的礼物前几名
+TOP_GIFTERS_COUNT = 10
+
+_MASK_64 = (1 << 64) - 1
+
+
+class RoomStatsSnapshot(models.database.OrmBase):
+    __tablename__ = 'room_stats_snapshots'
+    sid = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
+    room_id = sqlalchemy.Column(sqlalchemy.Integer, index=True)
+    lid = sqlalchemy.Column(sqlalchemy.Integer, index=True)
+    start_time = sqlalchemy.Column(sqlalchemy.Integer)
+    end_time = sqlalchemy.Column(sqlalchemy.Integer)
+    # RoomStats.to_dict()的JSON
+    data = sqlalchemy.Column(sqlalchemy.Text)
+
+
+def _hash_uid(uid: int):
+    """splitmix64，把UID打散成64位的哈希"""
+    x = (uid + 0x9e3779b97f4a7c15) & _MASK_64
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _MASK_64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _MASK_64
+    return x ^ (x >> 31)
+
+
+class HyperLogLog:
+    def __init__(self, precision):
+        self._precision = precision
+        self._registers = bytearray(1 << precision)
+
+    def add(self, uid: int):
+        x = _hash_uid(uid)
+        index = x >> (64 - self._precision)
+        rest = x & ((1 << (64 - self._precision)) - 1)
+        # 剩下的位中第一个1的位置
+        rank = (64 - self._precision) - rest.bit_length() + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def merge(self, other: 'HyperLogLog'):
+        """合并精度相同的另一个HyperLogLog"""
+        self._registers = bytearray(map(max, self._registers, other._registers))
+
+    def clear(self):
+        self._registers = bytearray(len(self._registers))
+
+    def copy(self):
+        res = HyperLogLog(self._precision)
+        res._registers = bytearray(self._registers)
+        return res
+
+    def count(self):
+        m = len(self._registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -register for register in self._registers)
+        zero_count = self._registers.count(0)
+        if estimate <= 2.5 * m and zero_count != 0:
+            # 基数小的时候用线性计数更准
+            estimate = m * math.log(m / zero_count)
+        return int(round(estimate))
+
+
+class SpaceSaving:
+    """
+    Space-Saving算法，最多跟踪capacity个key，估算加权计数最大的几个。
+    估计值最多偏大error，真实值大于最小的计数的key一定会被跟踪
+    """
+
+    def __init__(self, capacity):
+        self._capacity = capacity
+        # key -> [计数, 误差上限]
+        self._counters: Dict[Any, List[int]] = {}
+
+    def add(self, key, weight):
+        counter = self._counters.get(key, None)
+        if counter is not None:
+            counter[0] += weight
+            return
+        if len(self._counters) < self._capacity:
+            self._counters[key] = [weight, 0]
+            return
+        # 替换计数最小的key，继承它的计数作为误差
+        min_key = min(self._counters, key=lambda key_: self._counters[key_][0])
+        min_count = self._counters.pop(min_key)[0]
+        self._counters[key] = [min_count + weight, min_count]
+
+    def top(self, n):
+        """
+        :return: [(key, 计数, 误差上限)]，按计数从大到小
+        """
+        items = sorted(self._counters.items(), key=lambda item: item[1][0], reverse=True)[:n]
+        return [(key, count, error) for key, (count, error) in items]
+
+    def __contains__(self, key):
+        return key in self._counters
+
+
+class RollingWindow:
+    """按时间分桶的环形窗口，过期的桶在写入或读取时清零"""
+
+    def __init__(self, bucket_count, bucket_seconds, value_factory: Callable[[], Any], reset_func=None):
+        """
+        :param value_factory: 创建桶的值
+        :param reset_func: 清空桶的值，返回新的值，为None时用value_factory
+        """
+        self._bucket_seconds = bucket_seconds
+        self._value_factory = value_factory
+        self._reset_func = reset_func
+        self._buckets = [value_factory() for _ in range(bucket_count)]
+        # 每个桶对应的时间序号，-1表示空
+        self._bucket_indexes = [-1] * bucket_count
+
+    def _get_bucket_index(self, timestamp):
+        return int(timestamp // self._bucket_seconds)
+
+    def get_bucket(self, timestamp):
+        """
+        :return: 时间所在的桶的值，同一个桶的值用来累加
+        """
+        index = self._get_bucket_index(timestamp)
+        pos = index % len(self._buckets)
+        if self._bucket_indexes[pos] != index:
+            self._reset(pos)
+            self._bucket_indexes[pos] = index
+        return self._buckets[pos]
+
+    def set_bucket(self, timestamp, value):
+        self.get_bucket(timestamp)
+        self._buckets[self._get_bucket_index(timestamp) % len(self._buckets)] = value
+
+    def _reset(self, pos):
+        if self._reset_func is None:
+            self._buckets[pos] = self._value_factory()
+        else:
+            self._buckets[pos] = self._reset_func(self._buckets[pos])
+
+    def values(self, timestamp):
+        """
+        :return: 从旧到新的每个桶的值，最后一个是timestamp所在的桶，没有数据的桶为None
+        """
+        cur_index = self._get_bucket_index(timestamp)
+        res = []
+        for index in range(cur_index - len(self._buckets) + 1, cur_index + 1):
+            pos = index % len(self._buckets)
+            res.append(self._buckets[pos] if self._bucket_indexes[pos] == index else None)
+        return res
+
+
+class RoomStats:
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.start_time = time.time()
+        self.update_time = self.start_time
+
+        self.message_count = 0
+        self._message_window = RollingWindow(WINDOW_MINUTES, 60, int)
+        self._total_chatters = HyperLogLog(TOTAL_CHATTERS_PRECISION)
+        self._chatters_window = RollingWindow(
+            WINDOW_MINUTES // CHATTER_BUCKET_MINUTES, CHATTER_BUCKET_MINUTES * 60,
+            lambda: HyperLogLog(WINDOW_CHATTERS_PRECISION), self._reset_hyper_log_log
+        )
+
+        self.gift_count = 0
+        self.gift_coin_total = 0
+        self._gift_coin_window = RollingWindow(WINDOW_MINUTES, 60, int)
+        self._top_gifters = SpaceSaving(TOP_GIFTERS_CAPACITY)
+        # 被跟踪的送礼人的UID -> 用户名
+        self._gifter_names: Dict[int, str] = {}
+
+        self.super_chat_count = 0
+        # 人民币
+        self.super_chat_revenue = 0
+        self._super_chat_revenue_window = RollingWindow(WINDOW_MINUTES, 60, int)
+
+        # 舰队等级 -> 购买数，1总督，2提督，3舰长
+        self.guard_counts = {1: 0, 2: 0, 3: 0}
+        self.guard_coin_total = 0
+
+    @staticmethod
+    def _reset_hyper_log_log(hll: HyperLogLog):
+        hll.clear()
+        return hll
+
+    def _increase_window(self, window: RollingWindow, timestamp, value):
+        window.set_bucket(timestamp, window.get_bucket(timestamp) + value)
+
+    def on_danmaku(self, uid):
+        now = self.update_time = time.time()
+        self.message_count += 1
+        self._increase_window(self._message_window, now, 1)
+        self._total_chatters.add(uid)
+        self._chatters_window.get_bucket(now).add(uid)
+
+    def on_gift(self, uid, uname, total_coin):
+        now = self.update_time = time.time()
+        self.gift_count += 1
+        self.gift_coin_total += total_coin
+        self._increase_window(self._gift_coin_window, now, total_coin)
+        self._top_gifters.add(uid, total_coin)
+        self._gifter_names[uid] = uname
+        if len(self._gifter_names) > TOP_GIFTERS_CAPACITY * 2:
+            # 只保留被跟踪的送礼人的名字
+            self._gifter_names = {uid_: name for uid_, name in self._gifter_names.items() if uid_ in self._top_gifters}
+
+    def on_super_chat(self, price):
+        now = self.update_time = time.time()
+        self.super_chat_count += 1
+        self.super_chat_revenue += price
+        self._increase_window(self._super_chat_revenue_window, now, price)
+
+    def on_buy_guard(self, guard_level, num, price):
+        """
+        :param price: 单价，金瓜子
+        """
+        self.update_time = time.time()
+        if guard_level in self.guard_counts:
+            self.guard_counts[guard_level] += num
+        self.guard_coin_total += price * num
+
+    def is_empty(self):
+        """没有收到过任何消息"""
+        return (
+            self.message_count == 0 and self.gift_count == 0 and self.super_chat_count == 0
+            and sum(self.guard_counts.values()) == 0
+        )
+
+    def to_dict(self):
+        now = time.time()
+        message_series = [value or 0 for value in self._message_window.values(now)]
+        window_chatters = HyperLogLog(WINDOW_CHATTERS_PRECISION)
+        for hll in self._chatters_window.values(now):
+            if hll is not None:
+                window_chatters.merge(hll)
+        return {
+            'roomId': self.room_id,
+            'startTime': int(self.start_time),
+            'updateTime': int(self.update_time),
+            'messageCount': self.message_count,
+            # 最后一个是当前分钟，还没统计完
+            'messagesPerMinute': message_series[-2] if len(message_series) >= 2 else 0,
+            'messagesPerMinuteSeries': message_series,
+            'uniqueChatters': self._total_chatters.count(),
+            'uniqueChattersLastHour': window_chatters.count(),
+            'giftCount': self.gift_count,
+            'giftCoinTotal': self.gift_coin_total,
+            'giftCoinPerMinuteSeries': [value or 0 for value in self._gift_coin_window.values(now)],
+            'topGifters': [{
+                'uid': uid,
+                'name': self._gifter_names.get(uid, ''),
+                'totalCoin': count,
+                # 估计值最多偏大这么多
+                'maxError': error
+            } for uid, count, error in self._top_gifters.top(TOP_GIFTERS_COUNT)],
+            'superChatCount': self.super_chat_count,
+            'superChatRevenue': self.super_chat_revenue,
+            'superChatRevenuePerMinuteSeries': [
+                value or 0 for value in self._super_chat_revenue_window.values(now)
+            ],
+            'guardCounts': {str(level): count for level, count in self.guard_counts.items()},
+            'guardCoinTotal': self.guard_coin_total
+        }
+
+
+def save_snapshot(room_id, lid, stats_dict):
+    """保存一场直播的统计，覆盖同一个日志之前保存的，应该在线程池中执行"""
+    values = {
+        'room_id': room_id,
+        'start_time': stats_dict['startTime'],
+        'end_time': stats_dict['updateTime'],
+        'data': serializer.dumps(stats_dict)
+    }
+    try:
+        with models.database.get_session() as session:
+            updated_count = 0
+            if lid is not None:
+                updated_count = session.query(RoomStatsSnapshot).filter(RoomStatsSnapshot.lid == lid).update(
+                    values, synchronize_session=False
+                )
+            if updated_count == 0:
+                session.add(RoomStatsSnapshot(lid=lid, **values))
+            session.commit()
+    except sqlalchemy.exc.OperationalError:
+        return False
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'save_snapshot failed: {e}')
+        return False
+    return True
+
+
+def delete_snapshots(session, lids):
+    """在删除日志的事务中删除日志的快照，lid可能被新的日志复用"""
+    session.query(RoomStatsSnapshot).filter(RoomStatsSnapshot.lid.in_(lids)).delete(synchronize_session=False)
+
+
+def get_latest_snapshot(room_id):
+    """
+    :return: 房间最近一次保存的统计，没有或失败时返回None
+    """
+    try:
+        with models.database.get_session() as session:
+            snapshot = session.query(RoomStatsSnapshot.data).filter(
+                RoomStatsSnapshot.room_id == room_id
+            ).order_by(RoomStatsSnapshot.sid.desc()).first()
+    except sqlalchemy.exc.OperationalError:
+        return None
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.exception(f'get_latest_snapshot failed: {e}')
+        return None
+    if snapshot is None:
+        return None
+    return serializer.loads(snapshot.data)
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+"""
+前端静态文件的内存缓存
+
+启动时把frontend/dist里的文件读进内存，预先压缩成gzip和brotli（安装了brotli时），用内容哈希作为强ETag。
+文件名带哈希的文件内容不会变，不用再检查磁盘。其他文件（index.html、用户编辑的danmu_pic.json、
+用户添加的图片等）过一段时间会stat一次，文件变化时重新加载，先返回不压缩的版本，在线程池里压缩完再返回压缩的版本。
+启动后才添加的文件不压缩
+"""
+
+import asyncio
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+import time
+from typing import *
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# 超过这个大小的文件不缓存，直接从磁盘读
+MAX_CACHE_FILE_SIZE = 4 * 1024 * 1024
+# 小于这个大小的文件不压缩
+MIN_COMPRESS_SIZE = 256
+# 压缩后至少要小这么多才使用压缩的版本
+MIN_COMPRESS_RATIO = 0.9
+# 文件名不带哈希的文件，至少隔多久检查一次磁盘上的文件有没有变化（秒）
+REVALIDATE_INTERVAL = 1
+# 值得压缩的类型，图片、字体等已经压缩过了
+COMPRESSIBLE_CONTENT_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/manifest+json',
+    'application/xml',
+    'image/svg+xml',
+    'image/x-icon',
+    'image/vnd.microsoft.icon'
+}
+# vue-cli生成的文件名里的内容哈希，如app.1a2b3c4d.js
+_HASHED_FILE_NAME_PATTERN = re.compile(r'\.[0-9a-f]{8,}\.[^./]+$')
+
+
+class Asset:
+    def __init__(self, abs_path, data: bytes, mtime, immutable, compress=True):
+        """
+        :param compress: 是否要压缩，启动后才添加的文件不压缩。创建时不压缩，要调用build_encodings
+        """
+        self.abs_path = abs_path
+        self.mtime = mtime
+        self.size = len(data)
+        # 文件名带哈希，内容不会变
+        self.immutable = immutable
+        self.compress = compress
+        self.last_check_time = time.monotonic()
+
+        content_type, _ = mimetypes.guess_type(abs_path)
+        if content_type is None:
+            content_type = 'application/octet-stream'
+        elif content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+            content_type += '; charset=utf-8'
+        self.content_type = content_type
+
+        self.etag = '"' + hashlib.sha1(data).hexdigest() + '"'
+        # Content-Encoding -> 数据，''表示不压缩
+        self.encoded_data: Dict[str, bytes] = {'': data}
+
+    def build_encodings(self):
+        """压缩，比较慢，应该在线程池中执行。压缩完之前只返回不压缩的版本"""
+        data = self.encoded_data['']
+        if not self.compress or not _is_compressible(self.content_type, len(data)):
+            return
+        encoded_data = {'': data}
+        max_size = int(len(data) * MIN_COMPRESS_RATIO)
+        gzip_data = gzip.compress(data, 9)
+        if len(gzip_data) <= max_size:
+            encoded_data['gzip'] = gzip_data
+        if brotli is not None:
+            br_data = brotli.compress(data)
+            if len(br_data) <= max_size:
+                encoded_data['br'] = br_data
+        # 整个替换，事件循环线程不会看到压缩了一半的表
+        self.encoded_data = encoded_data
+
+    @property
+    def has_encodings(self):
+        return len(self.encoded_data) > 1
+
+    def select_encoding(self, accept_encoding):
+        """
+        根据Accept-Encoding选择最小的版本
+
+        :return: (Content-Encoding, 数据, ETag)，不同编码的ETag不同
+        """
+        if not self.has_encodings:
+            return '', self.encoded_data[''], self.etag
+        accepted = _parse_accept_encoding(accept_encoding)
+        for encoding in ('br', 'gzip'):
+            data = self.encoded_data.get(encoding, None)
+            if data is not None and encoding in accepted:
+                return encoding, data, f'{self.etag[:-1]}-{encoding}"'
+        return '', self.encoded_data[''], self.etag
+
+
+def _is_compressible(content_type: str, size):
+    if size < MIN_COMPRESS_SIZE:
+        return False
+    content_type = content_type.partition(';')[0]
+    return content_type.startswith('text/') or content_type in COMPRESSIBLE_CONTENT_TYPES
+
+
+def _parse_accept_encoding(accept_encoding: str):
+    accepted = set()
+    for item in accept_encoding.split(','):
+        encoding, _, params = item.partition(';')
+        params = params.replace(' ', '')
+        if params in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(encoding.strip().lower())
+    return accepted
+
+
+class AssetTable:
+    """
+    相对路径 -> Asset的表，查不到的无扩展名路径直接返回index.html，给Vue Router的history模式用
+    """
+
+    def __init__(self, root, default_filename='index.html'):
+        self._root = os.path.realpath(root)
+        self._default_filename = default_filename
+        # 相对路径（用/分隔） -> Asset
+        self._assets: Dict[str, Asset] = {}
+        self._is_loaded = False
+
+    @property
+    def is_loaded(self):
+        return self._is_loaded
+
+    def load(self):
+        """读取并压缩所有文件，比较慢，应该在线程池中执行"""
+        start_time = time.perf_counter()
+        assets = {}
+        total_size = 0
+        for dir_path, _dir_names, file_names in os.walk(self._root):
+            for file_name in file_names:
+                abs_path = os.path.join(dir_path, file_name)
+                asset = _load_asset(abs_path)
+                if asset is None:
+                    continue
+                asset.build_encodings()
+                rel_path = os.path.relpath(abs_path, self._root).replace(os.sep, '/')
+                assets[rel_path] = asset
+                total_size += asset.size
+        self._assets = assets
+        self._is_loaded = True
+        logger.info('Loaded %d static files, %d bytes in %.3fs', len(assets), total_size,
+                    time.perf_counter() - start_time)
+
+    def get(self, path: str) -> Optional[Asset]:
+        """
+        :param path: URL中的路径，不以/开头
+        :return: 请求的文件，不存在时返回index.html。如果返回None，调用者应该自己从磁盘读取
+        """
+        if path == '' or path.endswith('/'):
+            path += self._default_filename
+        asset = self._assets.get(path, None)
+        if asset is not None:
+            return self._revalidate(path, asset)
+
+        # 表的key只能是规范化的相对路径，否则js/../app.js、js//app.js这样的写法会让表无限增长
+        path = posixpath.normpath(path)
+        if path == '..' or path.startswith('../'):
+            return self.get_default()
+        asset = self._assets.get(path, None)
+        if asset is not None:
+            return self._revalidate(path, asset)
+
+        # 不在表里，没有扩展名的当作前端路由，有扩展名的可能是运行时添加的文件，检查一下磁盘
+        if '.' in path.rpartition('/')[2]:
+            abs_path = self._get_abs_path(path)
+            if abs_path is not None:
+                try:
+                    is_file = os.path.isfile(abs_path)
+                except OSError:
+                    is_file = False
+                if is_file:
+                    # 符号链接之类的可能指向表里已有的文件
+                    rel_path = os.path.relpath(abs_path, self._root).replace(os.sep, '/')
+                    asset = self._assets.get(rel_path, None)
+                    if asset is not None:
+                        return self._revalidate(rel_path, asset)
+                    # 运行时添加的文件不压缩
+                    asset = _load_asset(abs_path, compress=False)
+                    if asset is None:
+                        return None
+                    self._assets[rel_path] = asset
+                    return asset
+        return self.get_default()
+
+    def get_default(self) -> Optional[Asset]:
+        asset = self._assets.get(self._default_filename, None)
+        if asset is None:
+            return None
+        return self._revalidate(self._default_filename, asset)
+
+    def _revalidate(self, path, asset: Asset) -> Optional[Asset]:
+        if asset.immutable:
+            return asset
+        cur_time = time.monotonic()
+        if cur_time - asset.last_check_time < REVALIDATE_INTERVAL:
+            return asset
+        asset.last_check_time = cur_time
+
+        try:
+            stat = os.stat(asset.abs_path)
+        except OSError:
+            # 文件被删了
+            del self._assets[path]
+            return None if path == self._default_filename else self.get_default()
+        if stat.st_mtime == asset.mtime and stat.st_size == asset.size:
+            return asset
+
+        new_asset = _load_asset(asset.abs_path, asset.compress)
+        if new_asset is None:
+            del self._assets[path]
+            return None
+        self._assets[path] = new_asset
+        if new_asset.compress:
+            # 在事件循环里，放到线程池里压缩，压缩完之前返回不压缩的版本
+            asyncio.get_event_loop().run_in_executor(None, new_asset.build_encodings)
+        return new_asset
+
+    def _get_abs_path(self, path):
+        abs_path = os.path.realpath(os.path.join(self._root, path))
+        if not abs_path.startswith(self._root + os.sep):
+            return None
+        return abs_path
+
+
+def _load_asset(abs_path, compress=True) -> Optional[Asset]:
+    try:
+        stat = os.stat(abs_path)
+        if stat.st_size > MAX_CACHE_FILE_SIZE:
+            return None
+        with open(abs_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        logger.exception('Failed to load static file %s:', abs_path)
+        return None
+    immutable = _HASHED_FILE_NAME_PATTERN.search(os.path.basename(abs_path)) is not None
+    return Asset(abs_path, data, stat.st_mtime, immutable, compress)
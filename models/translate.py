@@ -8,15 +8,22 @@ import hashlib
 import hmac
 import json
 import logging
+import math
 import random
 import re
+import time
+import unicodedata
 from typing import *
 
-import Crypto.Cipher.AES as cry_aes
-import Crypto.Util.Padding as cry_pad
 import aiohttp
+import sqlalchemy
+import sqlalchemy.exc
 
 import config
+import http_client
+import metrics
+import models.database
+import models.phrase_table
 
 logger = logging.getLogger(__name__)
 
@@ -25,23 +32,52 @@ NO_TRANSLATE_TEXTS = {
     '强', '余裕', '余裕余裕', '大丈夫', '再放送', '放送事故', '清楚', '清楚清楚'
 }
 
-_main_event_loop = asyncio.get_event_loop()
-_http_session: Optional[aiohttp.ClientSession] = None
+# 缓存key规范化步骤，按顺序执行
+CACHE_KEY_NORMALIZERS = ('fold_width', 'strip_decoration', 'collapse_repeat')
+# collapse_repeat时连续重复字符最多保留的个数
+MAX_REPEAT_CHARS = 2
+_REPEAT_CHARS_PATTERN = re.compile(r'(.)\1{%d,}' % MAX_REPEAT_CHARS, re.DOTALL)
+_SPACES_PATTERN = re.compile(r'\s+')
+# 每批删除的翻译记录数
+DELETE_RECORD_BATCH_SIZE = 1000
+
+# pycryptodome只有TencentTranslateFree用到，用到时再导入
+cry_aes = None
+cry_pad = None
+
+_main_event_loop: Optional[asyncio.AbstractEventLoop] = None
 _translate_providers: List['TranslateProvider'] = []
-# text -> res
+# 本地的provider，不需要请求网络，翻译前先查
+_local_translate_providers: List['TranslateProvider'] = []
+# 缓存key -> res
 _translate_cache: Dict[str, str] = {}
-# 正在翻译的Future，text -> Future
+# 正在翻译的Future，缓存key -> Future
 _text_future_map: Dict[str, asyncio.Future] = {}
 
+_cache_request_counter = metrics.Counter(
+    'blivechat_translate_cache_requests_total', 'Number of translation cache lookups', ('result',)
+)
+_cache_hit_counter = _cache_request_counter.labels('hit')
+_cache_miss_counter = _cache_request_counter.labels('miss')
+_provider_duration_histogram = metrics.Histogram(
+    'blivechat_translate_duration_seconds', 'Time spent on each translation request', ('provider',)
+)
+_provider_failure_counter = metrics.Counter(
+    'blivechat_translate_failures_total', 'Number of failed translation requests', ('provider',)
+)
+metrics.Gauge('blivechat_translate_cache_size', 'Number of translations cached in memory',
+              collect_func=lambda: [((), len(_translate_cache))])
+metrics.Gauge('blivechat_translate_queue_size', 'Number of texts waiting in the queue of each provider', ('provider',),
+              collect_func=lambda: [((provider.name,), provider.queue_size) for provider in _translate_providers])
+
 
 def init():
+    global _main_event_loop
+    _main_event_loop = asyncio.get_event_loop()
     asyncio.ensure_future(_do_init())
 
 
 async def _do_init():
-    global _http_session
-    _http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
-
     cfg = config.get_config()
     if not cfg.enable_translate:
         return
@@ -49,32 +85,38 @@ async def _do_init():
     for trans_cfg in cfg.translator_configs:
         provider = create_translate_provider(trans_cfg)
         if provider is not None:
+            provider.name = trans_cfg['name']
             providers.append(provider)
     await asyncio.gather(*(provider.init() for provider in providers))
-    global _translate_providers
-    _translate_providers = providers
+    global _translate_providers, _local_translate_providers
+    _translate_providers = [provider for provider in providers if not provider.is_local]
+    _local_translate_providers = [provider for provider in providers if provider.is_local]
 
 
 def create_translate_provider(cfg):
     type_ = cfg['type']
     if type_ == 'TencentTranslateFree':
         return TencentTranslateFree(
-            cfg['query_interval'], cfg['max_queue_size'], cfg['source_language'],
-            cfg['target_language']
+            cfg['query_interval'], cfg['max_queue_size'], cfg['burst'], cfg['max_in_flight'],
+            cfg['source_language'], cfg['target_language']
         )
     elif type_ == 'BilibiliTranslateFree':
-        return BilibiliTranslateFree(cfg['query_interval'], cfg['max_queue_size'])
+        return BilibiliTranslateFree(
+            cfg['query_interval'], cfg['max_queue_size'], cfg['burst'], cfg['max_in_flight']
+        )
     elif type_ == 'TencentTranslate':
         return TencentTranslate(
-            cfg['query_interval'], cfg['max_queue_size'], cfg['source_language'],
-            cfg['target_language'], cfg['secret_id'], cfg['secret_key'],
+            cfg['query_interval'], cfg['max_queue_size'], cfg['burst'], cfg['max_in_flight'],
+            cfg['source_language'], cfg['target_language'], cfg['secret_id'], cfg['secret_key'],
             cfg['region']
         )
     elif type_ == 'BaiduTranslate':
         return BaiduTranslate(
-            cfg['query_interval'], cfg['max_queue_size'], cfg['source_language'],
-            cfg['target_language'], cfg['app_id'], cfg['secret']
+            cfg['query_interval'], cfg['max_queue_size'], cfg['burst'], cfg['max_in_flight'],
+            cfg['source_language'], cfg['target_language'], cfg['app_id'], cfg['secret']
         )
+    elif type_ == 'LocalPhraseTable':
+        return LocalPhraseTable(cfg['path'])
     return None
 
 
@@ -96,12 +138,25 @@ def need_translate(text):
 
 
 def get_translation_from_cache(text):
-    key = text.strip().lower()
-    return _translate_cache.get(key, None)
+    key, _, prefix, suffix = parse_text(text)
+    res = _get_translation_from_cache_by_key(key)
+    if res is None:
+        _cache_miss_counter.inc()
+        return None
+    _cache_hit_counter.inc()
+    return prefix + res + suffix
 
 
-def translate(text) -> Awaitable[Optional[str]]:
-    key = text.strip().lower()
+async def translate(text) -> Optional[str]:
+    key, text_to_translate, prefix, suffix = parse_text(text)
+    res = await _translate_by_key(key, text_to_translate)
+    if res is None:
+        return None
+    # 把原文首尾的标点、emoji等装饰加回去
+    return prefix + res + suffix
+
+
+def _translate_by_key(key, text) -> Awaitable[Optional[str]]:
     # 如果已有正在翻译的future则返回，防止重复翻译
     future = _text_future_map.get(key, None)
     if future is not None:
@@ -110,7 +165,7 @@ def translate(text) -> Awaitable[Optional[str]]:
     future = _main_event_loop.create_future()
 
     # 查缓存
-    res = _translate_cache.get(key, None)
+    res = _get_translation_from_cache_by_key(key)
     if res is not None:
         future.set_result(res)
         return future
@@ -137,6 +192,81 @@ def translate(text) -> Awaitable[Optional[str]]:
     return future
 
 
+def _get_translation_from_cache_by_key(key):
+    res = _translate_cache.get(key, None)
+    if res is not None:
+        return res
+    # 常用短语查本地短语表，不占用在线翻译的额度
+    for provider in _local_translate_providers:
+        res = provider.lookup(key)
+        if res is not None:
+            return res
+    return None
+
+
+def parse_text(text):
+    """
+    :return: (缓存key, 要翻译的文本, 首部装饰, 尾部装饰)
+    """
+    text = text.strip()
+    normalizers = config.get_config().translation_cache_key_normalizers
+    if 'strip_decoration' in normalizers:
+        # 只翻译去掉首尾装饰的部分，这样不同装饰的变体可以共用一个翻译结果
+        prefix, core, suffix = _split_decoration(text)
+        if core == '':
+            prefix = suffix = ''
+            core = text
+    else:
+        prefix = suffix = ''
+        core = text
+    return get_cache_key(core, normalizers), core, prefix, suffix
+
+
+def get_cache_key(text, normalizers=None):
+    """
+    把文本规范化成缓存key，使只有重复字符、首尾的标点和emoji、中间空白的长度、全角半角不同的文本命中同一个缓存
+
+    :param text: 原文
+    :param normalizers: 规范化步骤，默认使用配置中的
+    """
+    if normalizers is None:
+        normalizers = config.get_config().translation_cache_key_normalizers
+    key = text.strip().lower()
+    for normalizer in normalizers:
+        if normalizer == 'fold_width':
+            # NFKC会把全角字母、数字、标点转成半角，再转一次小写处理全角大写字母
+            key = unicodedata.normalize('NFKC', key).lower()
+        elif normalizer == 'strip_decoration':
+            # 中间的标点可能有意义，比如"1.5"和"15"，所以只去掉首尾的装饰，中间连续的空白合并成一个
+            key = _SPACES_PATTERN.sub(' ', _split_decoration(key)[1])
+        elif normalizer == 'collapse_repeat':
+            key = _REPEAT_CHARS_PATTERN.sub(r'\1' * MAX_REPEAT_CHARS, key)
+    if key == '':
+        # 全是装饰，退化成原来的key
+        key = text.strip().lower()
+    return key
+
+
+def _is_decoration_char(c):
+    if c.isspace():
+        return True
+    # 标点、符号（包括大部分emoji）、分隔符、控制字符（包括零宽连接符）
+    if unicodedata.category(c)[0] in ('P', 'S', 'Z', 'C'):
+        return True
+    # emoji变体选择符
+    return 0xFE00 <= ord(c) <= 0xFE0F
+
+
+def _split_decoration(text):
+    begin = 0
+    while begin < len(text) and _is_decoration_char(text[begin]):
+        begin += 1
+    end = len(text)
+    while end > begin and _is_decoration_char(text[end - 1]):
+        end -= 1
+    return text[:begin], text[begin:end], text[end:]
+
+
 def _on_translate_done(key, future):
     _text_future_map.pop(key, None)
     # 缓存
@@ -152,7 +282,80 @@ def _on_translate_done(key, future):
         _translate_cache.pop(next(iter(_translate_cache)), None)
 
 
+class TranslationRecord(models.database.OrmBase):
+    """自动翻译的原文和翻译结果，每次通知客户端翻译结果时记录一条，用来生成本地短语表"""
+    __tablename__ = 'translation_records'
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
+    text = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+    translation = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+
+
+def add_translation_record(text, translation):
+    """应该在线程池中执行"""
+    try:
+        with models.database.get_session() as session:
+            session.add(TranslationRecord(text=text, translation=translation))
+            session.commit()
+    except sqlalchemy.exc.OperationalError:
+        # SQLite会锁整个文件，忽略就行
+        pass
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception('add_translation_record failed:')
+
+
+def delete_old_translation_records(max_rows):
+    """
+    删除一批最旧的翻译记录，只保留最新的max_rows条，应该在线程池中执行
+
+    :return: 删除的条数，失败时返回None
+    """
+    try:
+        with models.database.get_session() as session:
+            min_id, max_id = session.query(
+                sqlalchemy.func.min(TranslationRecord.id), sqlalchemy.func.max(TranslationRecord.id)
+            ).one()
+            if max_id is None:
+                return 0
+            # ID是自增的，按ID范围删除，不用数行数
+            end_id = min(max_id - max_rows, min_id + DELETE_RECORD_BATCH_SIZE - 1)
+            if end_id < min_id:
+                return 0
+            count = session.query(TranslationRecord).filter(TranslationRecord.id <= end_id).delete(
+                synchronize_session=False
+            )
+            session.commit()
+            return count
+    except sqlalchemy.exc.OperationalError:
+        return None
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception('delete_old_translation_records failed:')
+        return None
+
+
+def get_translation_record_batch(after_id, limit):
+    """
+    按ID顺序取一批翻译记录，用上一批最后的ID作为after_id取下一批
+
+    :return: [(id, 原文, 翻译)]，失败时返回None
+    """
+    try:
+        with models.database.get_session() as session:
+            return session.query(TranslationRecord.id, TranslationRecord.text, TranslationRecord.translation).filter(
+                TranslationRecord.id > after_id
+            ).order_by(TranslationRecord.id).limit(limit).all()
+    except sqlalchemy.exc.OperationalError:
+        return None
+    except sqlalchemy.exc.SQLAlchemyError:
+        logger.exception('get_translation_record_batch failed:')
+        return None
+
+
 class TranslateProvider:
+    # 是否是本地的provider，本地的provider不参与负载均衡，翻译前先用lookup查询
+    is_local = False
+    # 配置节名，用作监控指标的标签
+    name = ''
+
     async def init(self):
         return True
 
@@ -164,17 +367,90 @@ class TranslateProvider:
     def wait_time(self):
         return 0
 
+    @property
+    def queue_size(self):
+        return 0
+
     def translate(self, text, future):
         raise NotImplementedError
 
+    def lookup(self, key) -> Optional[str]:
+        return None
+
+
+class LocalPhraseTable(TranslateProvider):
+    """从本地短语表查询翻译，短语表用tools/build_phrase_table.py从历史日志生成"""
+    is_local = True
+
+    def __init__(self, path):
+        self._path = path
+        self._table: Optional[models.phrase_table.PhraseTable] = None
+
+    async def init(self):
+        try:
+            self._table = models.phrase_table.PhraseTable(self._path)
+        except (OSError, ValueError):
+            logger.exception('LocalPhraseTable failed to load %s:', self._path)
+            return False
+        logger.info('LocalPhraseTable loaded %d phrases', len(self._table))
+        return True
+
+    @property
+    def is_available(self):
+        return self._table is not None
+
+    def translate(self, text, future):
+        future.set_result(self.lookup(get_cache_key(text)))
+
+    def lookup(self, key) -> Optional[str]:
+        if self._table is None:
+            return None
+        return self._table.get(key)
+
+
+class TokenBucket:
+    """令牌桶，平均每interval秒产生一个令牌，最多攒burst个，允许短时间内突发请求"""
+
+    def __init__(self, interval, burst):
+        self._rate = 1 / interval if interval > 0 else math.inf
+        self._burst = max(burst, 1)
+        self._tokens = self._burst
+        self._last_refill_time = time.monotonic()
+
+    @property
+    def tokens(self):
+        self._refill()
+        return self._tokens
+
+    def _refill(self):
+        cur_time = time.monotonic()
+        if self._rate == math.inf:
+            self._tokens = self._burst
+        else:
+            self._tokens = min(self._tokens + (cur_time - self._last_refill_time) * self._rate, self._burst)
+        self._last_refill_time = cur_time
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
 
 class FlowControlTranslateProvider(TranslateProvider):
-    def __init__(self, query_interval, max_queue_size):
+    def __init__(self, query_interval, max_queue_size, burst, max_in_flight):
         self._query_interval = query_interval
         # (text, future)
         self._text_queue = asyncio.Queue(max_queue_size)
+        self._token_bucket = TokenBucket(query_interval, burst)
+        # 限制同时进行的请求数，防止API变慢时请求越积越多。0表示不限制
+        self._in_flight_semaphore = asyncio.Semaphore(max_in_flight) if max_in_flight > 0 else None
 
     async def init(self):
+        self._duration_histogram = _provider_duration_histogram.labels(self.name)
+        self._failure_counter = _provider_failure_counter.labels(self.name)
         asyncio.ensure_future(self._translate_consumer())
         return True
 
@@ -184,7 +460,12 @@ class FlowControlTranslateProvider(TranslateProvider):
 
     @property
     def wait_time(self):
-        return self._text_queue.qsize() * self._query_interval
+        # 桶里剩下的令牌可以立即使用
+        return max(self._text_queue.qsize() - self._token_bucket.tokens, 0) * self._query_interval
+
+    @property
+    def queue_size(self):
+        return self._text_queue.qsize()
 
     def translate(self, text, future):
         try:
@@ -196,12 +477,27 @@ class FlowControlTranslateProvider(TranslateProvider):
         while True:
             try:
                 text, future = await self._text_queue.get()
-                asyncio.ensure_future(self._translate_coroutine(text, future))
+                # 并发限制
+                if self._in_flight_semaphore is not None:
+                    await self._in_flight_semaphore.acquire()
                 # 频率限制
-                await asyncio.sleep(self._query_interval)
+                await self._token_bucket.acquire()
+                asyncio.ensure_future(self._limited_translate_coroutine(text, future))
             except Exception:
                 logger.exception('FlowControlTranslateProvider error:')
 
+    async def _limited_translate_coroutine(self, text, future):
+        start_time = time.perf_counter()
+        try:
+            await self._translate_coroutine(text, future)
+        finally:
+            if self._in_flight_semaphore is not None:
+                self._in_flight_semaphore.release()
+
+        self._duration_histogram.observe(time.perf_counter() - start_time)
+        if future.cancelled() or future.exception() is not None or future.result() is None:
+            self._failure_counter.inc()
+
     async def _translate_coroutine(self, text, future):
         try:
             res = await self._do_translate(text)
@@ -214,9 +510,24 @@ class FlowControlTranslateProvider(TranslateProvider):
         raise NotImplementedError
 
 
+def _import_crypto():
+    global cry_aes, cry_pad
+    if cry_aes is not None:
+        return True
+    try:
+        import Crypto.Cipher.AES
+        import Crypto.Util.Padding
+    except ImportError:
+        logger.error('TencentTranslateFree requires pycryptodome')
+        return False
+    cry_aes = Crypto.Cipher.AES
+    cry_pad = Crypto.Util.Padding
+    return True
+
+
 class TencentTranslateFree(FlowControlTranslateProvider):
-    def __init__(self, query_interval, max_queue_size, source_language, target_language):
-        super().__init__(query_interval, max_queue_size)
+    def __init__(self, query_interval, max_queue_size, burst, max_in_flight, source_language, target_language):
+        super().__init__(query_interval, max_queue_size, burst, max_in_flight)
         self._source_language = source_language
         self._target_language = target_language
 
@@ -231,6 +542,8 @@ class TencentTranslateFree(FlowControlTranslateProvider):
     async def init(self):
         if not await super().init():
             return False
+        if not _import_crypto():
+            return False
         if not await self._do_init():
             return False
         self._reinit_future = asyncio.ensure_future(self._reinit_coroutine())
@@ -238,7 +551,7 @@ class TencentTranslateFree(FlowControlTranslateProvider):
 
     async def _do_init(self):
         try:
-            async with _http_session.get('https://fanyi.qq.com/') as r:
+            async with http_client.get('https://fanyi.qq.com/') as r:
                 if r.status != 200:
                     logger.warning('TencentTranslateFree init request failed: status=%d %s', r.status, r.reason)
                     return False
@@ -280,7 +593,7 @@ class TencentTranslateFree(FlowControlTranslateProvider):
 
         # 获取token
         try:
-            async with _http_session.post('https://fanyi.qq.com/api/' + reauthuri) as r:
+            async with http_client.post('https://fanyi.qq.com/api/' + reauthuri) as r:
                 if r.status != 200:
                     logger.warning('TencentTranslateFree init request failed: reauthuri=%s, status=%d %s',
                                    reauthuri, r.status, r.reason)
@@ -333,7 +646,7 @@ class TencentTranslateFree(FlowControlTranslateProvider):
 
     async def _do_translate(self, text):
         try:
-            async with _http_session.post(
+            async with http_client.post(
                 'https://fanyi.qq.com/api/translate',
                 headers={
                     'Referer': 'https://fanyi.qq.com/',
@@ -422,12 +735,12 @@ class TencentTranslateFree(FlowControlTranslateProvider):
 
 
 class BilibiliTranslateFree(FlowControlTranslateProvider):
-    def __init__(self, query_interval, max_queue_size):
-        super().__init__(query_interval, max_queue_size)
+    def __init__(self, query_interval, max_queue_size, burst, max_in_flight):
+        super().__init__(query_interval, max_queue_size, burst, max_in_flight)
 
     async def _do_translate(self, text):
         try:
-            async with _http_session.get(
+            async with http_client.get(
                 'https://api.live.bilibili.com/av/v1/SuperChat/messageTranslate',
                 params={
                     'room_id': '21396545',
@@ -450,9 +763,9 @@ class BilibiliTranslateFree(FlowControlTranslateProvider):
 
 
 class TencentTranslate(FlowControlTranslateProvider):
-    def __init__(self, query_interval, max_queue_size, source_language, target_language,
+    def __init__(self, query_interval, max_queue_size, burst, max_in_flight, source_language, target_language,
                  secret_id, secret_key, region):
-        super().__init__(query_interval, max_queue_size)
+        super().__init__(query_interval, max_queue_size, burst, max_in_flight)
         self._source_language = source_language
         self._target_language = target_language
         self._secret_id = secret_id
@@ -527,7 +840,7 @@ class TencentTranslate(FlowControlTranslateProvider):
             'X-TC-Region': self._region
         }
 
-        return _http_session.post('https://tmt.tencentcloudapi.com/', headers=headers, data=body_bytes)
+        return http_client.post('https://tmt.tencentcloudapi.com/', headers=headers, data=body_bytes)
 
     def _on_fail(self, code):
         if self._cool_down_timer_handle is not None:
@@ -559,9 +872,9 @@ class TencentTranslate(FlowControlTranslateProvider):
 
 
 class BaiduTranslate(FlowControlTranslateProvider):
-    def __init__(self, query_interval, max_queue_size, source_language, target_language,
+    def __init__(self, query_interval, max_queue_size, burst, max_in_flight, source_language, target_language,
                  app_id, secret):
-        super().__init__(query_interval, max_queue_size)
+        super().__init__(query_interval, max_queue_size, burst, max_in_flight)
         self._source_language = source_language
         self._target_language = target_language
         self._app_id = app_id
@@ -575,7 +888,7 @@ class BaiduTranslate(FlowControlTranslateProvider):
 
     async def _do_translate(self, text):
         try:
-            async with _http_session.post(
+            async with http_client.post(
                 'https://fanyi-api.baidu.com/api/trans/vip/translate',
                 data=self._add_sign({
                     'q': text,
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""
+事件循环卡顿监控和采样分析器
+"""
+
+import asyncio
+import collections
+import datetime
+import logging
+import sys
+import threading
+import time
+from typing import *
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 检查事件循环延迟的间隔（秒）
+LAG_CHECK_INTERVAL = 0.5
+# 保留的最近慢回调记录数
+MAX_SLOW_CALLBACK_RECORDS = 100
+# 采样分析最长时间（秒）
+MAX_PROFILE_SECONDS = 60
+
+SlowCallbackRecord = collections.namedtuple('SlowCallbackRecord', ('time', 'duration', 'callback'))
+
+_slow_callback_records: Deque[SlowCallbackRecord] = collections.deque(maxlen=MAX_SLOW_CALLBACK_RECORDS)
+_original_handle_run: Optional[Callable] = None
+_is_profiling = False
+
+_loop_lag_histogram = metrics.Histogram(
+    'blivechat_event_loop_lag_seconds', 'Delay of the event loop scheduling a timer callback'
+)
+_slow_callback_counter = metrics.Counter(
+    'blivechat_event_loop_slow_callbacks_total', 'Number of callbacks that blocked the event loop for too long'
+)
+
+
+def init():
+    cfg = config.get_config()
+    loop = asyncio.get_event_loop()
+    # 慢回调检测要替换asyncio内部的Handle._run，每个回调都多一点开销，默认关闭，排查卡顿时再打开。延迟检测总是开启
+    if cfg.slow_callback_duration > 0:
+        if isinstance(loop, asyncio.BaseEventLoop):
+            _patch_handle_run(cfg.slow_callback_duration)
+        else:
+            logger.info('%s does not support slow callback detection, only event loop lag is monitored',
+                        type(loop).__name__)
+    loop.call_later(LAG_CHECK_INTERVAL, _check_loop_lag, loop.time() + LAG_CHECK_INTERVAL)
+
+
+def _check_loop_lag(expected_time):
+    loop = asyncio.get_event_loop()
+    lag = max(loop.time() - expected_time, 0)
+    _loop_lag_histogram.observe(lag)
+    slow_callback_duration = config.get_config().slow_callback_duration
+    if 0 < slow_callback_duration <= lag:
+        logger.warning('Event loop lag %.3fs', lag)
+    loop.call_later(LAG_CHECK_INTERVAL, _check_loop_lag, loop.time() + LAG_CHECK_INTERVAL)
+
+
+def _patch_handle_run(slow_callback_duration):
+    """给asyncio的Handle._run计时，记录执行太久的回调，uvloop等自己实现Handle的事件循环不支持"""
+    global _original_handle_run
+    if _original_handle_run is not None:
+        return
+    _original_handle_run = original_handle_run = asyncio.Handle._run
+
+    def handle_run(self: asyncio.Handle):
+        start_time = time.perf_counter()
+        original_handle_run(self)
+        duration = time.perf_counter() - start_time
+        if duration >= slow_callback_duration:
+            _on_slow_callback(self, duration)
+
+    asyncio.Handle._run = handle_run
+
+
+def _on_slow_callback(handle: asyncio.Handle, duration):
+    callback = _describe_callback(handle)
+    _slow_callback_counter.inc()
+    _slow_callback_records.append(SlowCallbackRecord(datetime.datetime.now(), duration, callback))
+    logger.warning('Slow callback took %.3fs: %s', duration, callback)
+
+
+def _describe_callback(handle: asyncio.Handle):
+    callback = handle._callback  # noqa
+    if callback is None:
+        # 已经执行完并取消了
+        return repr(handle)
+    # Task每一步的回调绑定在Task上
+    task = getattr(callback, '__self__', None)
+    if isinstance(task, asyncio.Task):
+        coro = task.get_coro()
+        coro_name = getattr(coro, '__qualname__', None) or repr(coro)
+        return f'Task {task.get_name()} {coro_name}'
+    return getattr(callback, '__qualname__', None) or repr(callback)
+
+
+def get_slow_callback_records() -> List[SlowCallbackRecord]:
+    return list(_slow_callback_records)
+
+
+async def profile(seconds, interval=0.005):
+    """
+    采样分析事件循环所在线程，在另一个线程定时采样调用栈，对被分析的线程几乎没有影响
+
+    :return: collapsed stack格式的文本，可以用flamegraph.pl、speedscope等工具生成火焰图
+    """
+    global _is_profiling
+    if _is_profiling:
+        raise RuntimeError('Another profile is running')
+    _is_profiling = True
+    try:
+        thread_id = threading.get_ident()
+        stack_counts = await asyncio.get_event_loop().run_in_executor(
+            None, _sample_stacks, thread_id, min(seconds, MAX_PROFILE_SECONDS), interval
+        )
+    finally:
+        _is_profiling = False
+    return ''.join(f'{stack} {count}\n' for stack, count in stack_counts.most_common())
+
+
+def _sample_stacks(thread_id, seconds, interval) -> collections.Counter:
+    stack_counts = collections.Counter()
+    end_time = time.monotonic() + seconds
+    while time.monotonic() < end_time:
+        frame = sys._current_frames().get(thread_id, None)  # noqa
+        if frame is None:
+            break
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')
+            frame = frame.f_back
+        stack.reverse()
+        stack_counts[';'.join(stack)] += 1
+        time.sleep(interval)
+    return stack_counts
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""
+JSON序列化，安装了orjson或ujson时使用更快的实现，否则使用标准库json
+
+模块导入时会自动选择最快的可用实现，调用init()后使用配置中指定的实现
+"""
+
+import json
+import logging
+from typing import *
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+import config
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('orjson', 'ujson', 'json')
+
+# 解码失败时抛出的异常，各实现的异常都是ValueError的子类
+DecodeError = ValueError
+
+backend = ''
+# 序列化成str
+dumps: Callable[[Any], str] = json.dumps
+# 序列化成UTF-8的bytes，可以直接用于websocket发送
+dumps_bytes: Callable[[Any], bytes] = lambda obj: json.dumps(obj).encode('utf-8')
+# 反序列化，参数可以是str或bytes
+loads: Callable[[Union[str, bytes]], Any] = json.loads
+
+
+def init():
+    name = config.get_config().json_backend
+    if not select_backend(name):
+        logger.warning('JSON backend %s is not available, using %s', name, backend)
+
+
+def get_available_backends():
+    return [name for name in BACKENDS if name == 'json' or globals()[name] is not None]
+
+
+def select_backend(name='auto'):
+    """
+    :param name: orjson、ujson、json，auto表示自动选择最快的
+    :return: 是否使用了指定的实现，指定的实现不可用时会自动选择
+    """
+    global backend, dumps, dumps_bytes, loads
+    available_backends = get_available_backends()
+    res = name == 'auto' or name in available_backends
+    if name not in available_backends:
+        name = available_backends[0]
+
+    if name == 'orjson':
+        dumps_bytes = orjson.dumps
+        dumps = _orjson_dumps
+        loads = orjson.loads
+    elif name == 'ujson':
+        dumps = _ujson_dumps
+        dumps_bytes = _ujson_dumps_bytes
+        loads = ujson.loads
+    else:
+        dumps = json.dumps
+        dumps_bytes = _json_dumps_bytes
+        loads = json.loads
+    backend = name
+    return res
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj).decode('utf-8')
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+
+
+def _ujson_dumps_bytes(obj):
+    return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+
+def _json_dumps_bytes(obj):
+    return json.dumps(obj).encode('utf-8')
+
+
+select_backend()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""
+统计还没统计过的历史日志，保存到统计表里。服务器也会按log_analytics_interval定期统计，日志很多时可以先用这个工具离线统计
+
+在项目根目录运行：
+python -m tools.analyze_logs                        # 统计新的日志，中断后再次运行会继续
+python -m tools.analyze_logs --top-chatters 20      # 再显示最近30天的用户排行
+python -m tools.analyze_logs --top-words 50 --room-id 123 --days 7
+"""
+
+import argparse
+import logging
+import time
+
+import config
+import models.database
+import models.log_analytics
+
+
+def run():
+    parser = argparse.ArgumentParser(description='统计历史日志')
+    parser.add_argument('--max-logs', help='最多统计的日志数，默认统计所有', type=int, default=None)
+    parser.add_argument('--top-chatters', help='显示弹幕数最多的用户数', type=int, default=0)
+    parser.add_argument('--top-words', help='显示出现次数最多的词数', type=int, default=0)
+    parser.add_argument('--room-id', help='排行只统计这个房间', type=int, default=None)
+    parser.add_argument('--days', help='排行只统计最近多少天开始的日志', type=float, default=30)
+    args = parser.parse_args()
+    logging.basicConfig(format='{asctime} {levelname} [{name}]: {message}', style='{', level=logging.INFO)
+
+    config.init()
+    models.database.init(False)
+
+    start_time = time.perf_counter()
+    count = models.log_analytics.analyze_new_logs(args.max_logs)
+    if count is None:
+        print('Analysis failed')
+        return
+    print(f'Analyzed {count} logs in {time.perf_counter() - start_time:.3f}s')
+
+    since = int(time.time() - args.days * 24 * 3600)
+    if args.top_chatters > 0:
+        chatters = models.log_analytics.get_top_chatters(args.room_id, since, limit=args.top_chatters) or []
+        print(f'Top chatters in {args.days:g} days:')
+        for chatter in chatters:
+            print(f"{chatter['text_count']:>8} {chatter['uid']:>12} {chatter['author_name']}")
+    if args.top_words > 0:
+        words = models.log_analytics.get_top_words(None, args.room_id, since, limit=args.top_words) or []
+        print(f'Top words in {args.days:g} days:')
+        for word, count in words:
+            print(f'{count:>8} {word}')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""
+从历史日志中的翻译结果生成本地短语表，给LocalPhraseTable翻译器使用
+
+在项目根目录运行：python -m tools.build_phrase_table [-o data/phrase_table.bin] [--min-count 2]
+"""
+
+import argparse
+import collections
+import json
+from typing import *
+
+import api.chat
+import config
+import models.database
+import models.log
+import models.phrase_table
+import models.translate
+
+BATCH_SIZE = 1000
+# 每个日志最多保留的等待翻译通知的消息数
+MAX_PENDING_MESSAGES = 10000
+
+
+def main():
+    args = parse_args()
+    config.init()
+    models.database.init(False)
+
+    # 缓存key -> 翻译 -> 次数
+    key_translation_counts: Dict[str, collections.Counter] = collections.defaultdict(collections.Counter)
+    for text, translation in iter_logged_translations():
+        key, _, prefix, suffix = models.translate.parse_text(text)
+        # 去掉翻译时加回去的首尾装饰
+        if prefix != '' and translation.startswith(prefix):
+            translation = translation[len(prefix):]
+        if suffix != '' and translation.endswith(suffix):
+            translation = translation[:-len(suffix)]
+        if translation != '':
+            key_translation_counts[key][translation] += 1
+
+    phrases = []
+    for key, translation_counts in key_translation_counts.items():
+        translation, count = translation_counts.most_common(1)[0]
+        total_count = sum(translation_counts.values())
+        if total_count >= args.min_count:
+            phrases.append((total_count, key, translation))
+    phrases.sort(reverse=True)
+    del phrases[args.max_phrases:]
+
+    models.phrase_table.build(args.output, {key: translation for _, key, translation in phrases})
+    print(f'{len(key_translation_counts)} phrases found, {len(phrases)} written to {args.output}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='从历史日志中的翻译结果生成本地短语表')
+    parser.add_argument('-o', '--output', help='输出路径，默认为data/phrase_table.bin',
+                        default='data/phrase_table.bin')
+    parser.add_argument('--min-count', help='最少出现次数，默认为2', type=int, default=2)
+    parser.add_argument('--max-phrases', help='最大短语数，默认为100000', type=int, default=100000)
+    return parser.parse_args()
+
+
+def iter_logged_translations():
+    """
+    :return: (原文, 翻译)的迭代器
+    """
+    yield from _iter_translations_in_logs()
+    yield from _iter_translation_records()
+
+
+def _iter_translations_in_logs():
+    """日志里带翻译的弹幕，以及旧版本写到日志里的翻译通知"""
+    with models.database.get_session() as session:
+        lids = [row.lid for row in session.query(models.log.LogFile.lid).order_by(models.log.LogFile.lid)]
+
+    for lid in lids:
+        # 消息ID -> 原文，翻译结果是异步通知的，要通过消息ID找到原文。一般很快就会收到通知，
+        # 只保留最近的MAX_PENDING_MESSAGES条，内存占用和日志大小无关
+        msg_id_text_map: 'collections.OrderedDict[str, str]' = collections.OrderedDict()
+        after_did = 0
+        while True:
+            danmakus = models.log.get_danmaku_batch(lid, after_did, BATCH_SIZE)
+            if not danmakus:
+                break
+            after_did = danmakus[-1][0]
+
+            for _did, _lid, content, _uid in danmakus:
+                try:
+                    body = json.loads(content)
+                    cmd = body['cmd']
+                    data = body['data']
+                    if cmd == api.chat.Command.ADD_TEXT:
+                        text, msg_id, translation = data[4], data[11], data[12]
+                    elif cmd == api.chat.Command.ADD_SUPER_CHAT:
+                        text, msg_id, translation = data['content'], data['id'], data['translation']
+                    elif cmd == api.chat.Command.UPDATE_TRANSLATION:
+                        msg_id, translation = data[0], data[1]
+                        text = msg_id_text_map.pop(msg_id, None)
+                        if text is not None and translation:
+                            yield text, translation
+                        continue
+                    else:
+                        continue
+                except (ValueError, LookupError, TypeError):
+                    continue
+
+                if translation:
+                    yield text, translation
+                elif models.translate.need_translate(text):
+                    msg_id_text_map[msg_id] = text
+                    if len(msg_id_text_map) > MAX_PENDING_MESSAGES:
+                        msg_id_text_map.popitem(last=False)
+
+
+def _iter_translation_records():
+    after_id = 0
+    while True:
+        records = models.translate.get_translation_record_batch(after_id, BATCH_SIZE)
+        if not records:
+            break
+        after_id = records[-1][0]
+        for _id, text, translation in records:
+            yield text, translation
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+"""
+把外部的弹幕日志导入数据库，格式和日志API下载的一样：每行一条弹幕的JSON，{"did", "lid", "content"}，可以是gzip压缩的
+
+流式读取，每个文件中的每个lid新建一个日志，弹幕分批写入，每个事务写入很多批。导入时调整SQLite的参数，
+写入的did是连续分配的，导入时要先停止服务器，发现有其他进程写入弹幕时停止导入。
+导入失败时删除这次导入的所有日志，修复问题后重新导入不会重复
+
+在项目根目录运行：
+python -m tools.import_logs --room-id 123 data/logs/*.log
+"""
+
+import argparse
+import datetime
+import gzip
+import logging
+import os
+import time
+from typing import *
+
+import sqlalchemy
+from sqlalchemy.sql import func
+
+import config
+import models.database
+import models.log
+import serializer
+
+logger = logging.getLogger(__name__)
+
+# 每条INSERT语句写入的弹幕数
+DEFAULT_BATCH_SIZE = 1000
+# 每个事务写入的弹幕数
+DEFAULT_TRANSACTION_SIZE = 100000
+# 显示进度的间隔（秒）
+PROGRESS_INTERVAL = 5
+
+# 导入时使用的SQLite参数，都是只对当前连接有效的，导入完会恢复
+_SQLITE_IMPORT_PRAGMAS = {
+    # 不等数据写到磁盘，导入中途断电可能损坏数据库，所以导入前最好备份
+    'synchronous': 'OFF',
+    # 页缓存，负数的单位是KiB
+    'cache_size': '-65536',
+    'temp_store': 'MEMORY'
+}
+
+
+def run():
+    parser = argparse.ArgumentParser(description='导入弹幕日志')
+    parser.add_argument('files', help='要导入的日志文件', nargs='+')
+    parser.add_argument('--room-id', help='日志所属的房间ID，日志文件里没有房间ID', type=int, default=0)
+    parser.add_argument('--batch-size', help='每条INSERT语句写入的弹幕数', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--transaction-size', help='每个事务写入的弹幕数', type=int,
+                        default=DEFAULT_TRANSACTION_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(format='{asctime} {levelname} [{name}]: {message}', style='{', level=logging.INFO)
+
+    config.init()
+    models.database.init(False)
+    serializer.init()
+
+    importer = Importer(args.room_id, args.batch_size, args.transaction_size)
+    with models.database.engine.connect() as connection:
+        old_pragmas = _set_import_pragmas(connection)
+        try:
+            importer.run(connection, args.files)
+        finally:
+            _restore_pragmas(connection, old_pragmas)
+
+    elapsed = time.perf_counter() - importer.start_time
+    print(f'Imported {importer.row_count} danmakus into {importer.log_count} logs in {elapsed:.3f}s, '
+          f'{importer.row_count / max(elapsed, 1e-9):.0f} rows/s, skipped {importer.skipped_count} invalid lines')
+
+
+def _set_import_pragmas(connection):
+    """
+    :return: 原来的参数
+    """
+    if connection.dialect.name != 'sqlite':
+        return {}
+    old_pragmas = {}
+    for name, value in _SQLITE_IMPORT_PRAGMAS.items():
+        old_pragmas[name] = connection.execute(f'PRAGMA {name}').scalar()
+        connection.execute(f'PRAGMA {name} = {value}')
+    return old_pragmas
+
+
+def _restore_pragmas(connection, old_pragmas):
+    for name, value in old_pragmas.items():
+        connection.execute(f'PRAGMA {name} = {value}')
+
+
+def _open_log_file(path) -> IO[bytes]:
+    f = open(path, 'rb')
+    # 下载时可能没有解压
+    if f.peek(2)[:2] != b'\x1f\x8b':
+        return f
+    # GzipFile(fileobj=f)关闭时不会关闭f，用gzip.open让它自己管理文件
+    f.close()
+    return gzip.open(path, 'rb')
+
+
+class Importer:
+    def __init__(self, room_id, batch_size, transaction_size):
+        self._room_id = room_id
+        self._batch_size = batch_size
+        self._transaction_size = transaction_size
+
+        self._connection = None
+        self._transaction = None
+        # 当前事务写入的弹幕数
+        self._transaction_row_count = 0
+        self._next_did = 1
+        # 已经提交的事务中新建的日志，导入失败时要删除
+        self._committed_lids: List[int] = []
+        # 当前事务中新建的日志
+        self._transaction_lids: List[int] = []
+        # 还没写入的弹幕，(lid, 内容)
+        self._pending: List[Tuple[int, str]] = []
+
+        self.start_time = time.perf_counter()
+        self._last_progress_time = self.start_time
+        self.row_count = 0
+        self.log_count = 0
+        self.skipped_count = 0
+
+    def run(self, connection, paths):
+        self._connection = connection
+        self.start_time = self._last_progress_time = time.perf_counter()
+        self._begin(True)
+        try:
+            for path in paths:
+                self._import_file(path)
+            self._flush()
+            self._commit()
+        except BaseException:
+            self._transaction.rollback()
+            self._delete_imported_logs()
+            raise
+
+    def _begin(self, is_first=False):
+        self._transaction = self._connection.begin()
+        self._transaction_row_count = 0
+        self._transaction_lids = []
+        # 在事务中取，写入的did接在现有的弹幕后面
+        max_did = self._connection.execute(sqlalchemy.select([func.max(models.log.LogItem.did)])).scalar() or 0
+        if not is_first and max_did != self._next_did - 1:
+            raise RuntimeError('Danmakus were written by another process during import, stop the server and '
+                               'import again')
+        self._next_did = max_did + 1
+
+    def _commit(self):
+        self._transaction.commit()
+        self._committed_lids += self._transaction_lids
+        self._transaction_lids = []
+
+    def _delete_imported_logs(self):
+        """删除已经提交的日志，当前事务已经回滚了"""
+        if not self._committed_lids:
+            return
+        logger.info('Import failed, deleting %d imported logs', len(self._committed_lids))
+        for lid in self._committed_lids:
+            if not models.log.delete_danmaku_by_file(lid):
+                logger.error('Failed to delete imported log %d, delete it manually', lid)
+        self._committed_lids = []
+
+    def _import_file(self, path):
+        logger.info('Importing %s', path)
+        file_name = os.path.basename(path)
+        # 文件中的lid -> 新建的lid
+        lid_map: Dict[int, int] = {}
+        with _open_log_file(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    danmaku = serializer.loads(line)
+                    src_lid = danmaku.get('lid', None)
+                    content = danmaku['content']
+                    if not isinstance(content, str):
+                        content = serializer.dumps(content)
+                except (serializer.DecodeError, LookupError, TypeError, AttributeError):
+                    self.skipped_count += 1
+                    continue
+
+                lid = lid_map.get(src_lid, None)
+                if lid is None:
+                    # 一个文件有多个日志时用lid区分文件名
+                    log_file_name = file_name if not lid_map else f'{file_name}-{src_lid}'
+                    lid_map[src_lid] = lid = self._create_log_file(log_file_name, content)
+
+                self._pending.append((lid, content))
+                if len(self._pending) >= self._batch_size:
+                    self._flush()
+
+    def _create_log_file(self, file_name, first_content):
+        values = {
+            'filename': file_name[:64], 'room_id': self._room_id, 'storage': models.log.SqlLogStorage.name,
+            'danmaku_count': 0, 'danmaku_bytes': 0
+        }
+        # 用第一条弹幕的时间作为创建时间，保留策略和归档按这个时间
+        timestamp = models.log.extract_columns_safe(*models.log.parse_content(first_content))['timestamp']
+        if isinstance(timestamp, (int, float)) and timestamp > 0:
+            values['create_time'] = datetime.datetime.utcfromtimestamp(timestamp)
+        res = self._connection.execute(models.log.LogFile.__table__.insert().values(**values))
+        lid = res.inserted_primary_key[0]
+        self._transaction_lids.append(lid)
+        self.log_count += 1
+        return lid
+
+    def _flush(self):
+        if not self._pending:
+            return
+        # 按lid分组，连续的同一个lid的弹幕一次写入
+        start = 0
+        for end in range(1, len(self._pending) + 1):
+            if end == len(self._pending) or self._pending[end][0] != self._pending[start][0]:
+                contents = [content for _lid, content in self._pending[start:end]]
+                models.log.insert_danmakus(self._connection, self._pending[start][0], self._next_did, contents)
+                self._next_did += len(contents)
+                start = end
+        self.row_count += len(self._pending)
+        self._transaction_row_count += len(self._pending)
+        self._pending = []
+
+        if self._transaction_row_count >= self._transaction_size:
+            self._commit()
+            self._begin()
+
+        cur_time = time.perf_counter()
+        if cur_time - self._last_progress_time >= PROGRESS_INTERVAL:
+            self._last_progress_time = cur_time
+            elapsed = cur_time - self.start_time
+            logger.info('Imported %d danmakus, %.0f rows/s', self.row_count, self.row_count / elapsed)
+
+
+if __name__ == '__main__':
+    run()
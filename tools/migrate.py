@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""
+升级数据库结构，并给旧的弹幕填充类型化的列、建立全文索引。服务器启动时也会自动做这些，数据很多时可以先用这个工具离线升级
+
+在项目根目录运行：
+python -m tools.migrate             # 执行迁移和回填，中断后再次运行会继续
+python -m tools.migrate --status    # 只显示当前版本和回填进度
+"""
+
+import argparse
+import logging
+
+import config
+import models.database
+import models.log
+
+
+def run():
+    parser = argparse.ArgumentParser(description='升级数据库结构')
+    parser.add_argument('--status', help='只显示当前版本和回填进度', action='store_true')
+    parser.add_argument('--batch-size', help='回填时每批处理的弹幕数', type=int,
+                        default=models.log.BACKFILL_BATCH_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(format='{asctime} {levelname} [{name}]: {message}', style='{', level=logging.INFO)
+
+    config.init()
+    if args.status:
+        models.database.init(False, defer_create_tables=True)
+        print_status()
+        return
+
+    models.database.init(False)
+    print(f'Schema version: {models.database.get_schema_version()}')
+    for backfill in (models.log.backfill_typed_columns, models.log.backfill_search_index):
+        if backfill(args.batch_size) is None:
+            print('Backfill failed')
+            break
+    print_status()
+
+
+def print_status():
+    print(f'Schema version: {models.database.get_schema_version()} / {models.database.get_latest_version()}')
+    remaining_counts = models.log.get_backfill_remaining_counts()
+    if remaining_counts is not None:
+        for name, remaining in remaining_counts.items():
+            print(f'Danmakus waiting for {name} backfill: {remaining}')
+
+
+if __name__ == '__main__':
+    run()
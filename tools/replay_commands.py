@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+回放记录的B站原始命令，不需要网络
+
+在项目根目录运行：
+python -m tools.replay_commands FILE [--speed 1|N|max]          # 直接喂给一个Room，统计处理速度
+python -m tools.replay_commands FILE --serve [main.py的参数]     # 启动服务器，客户端加入记录的房间后开始回放
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+import webbrowser
+
+import api.chat
+import config
+import http_client
+import main
+import models.avatar
+import models.command_record
+import models.database
+import update
+
+
+def run():
+    parser = argparse.ArgumentParser(description='回放记录的B站原始命令')
+    parser.add_argument('file', help='记录文件路径')
+    parser.add_argument('--speed', help='回放倍速，max表示尽快回放，默认为1', default='1')
+    parser.add_argument('--serve', help='启动服务器，客户端加入房间后开始回放', action='store_true')
+    args, main_args = parser.parse_known_args()
+    speed = None if args.speed == 'max' else float(args.speed)
+    header = models.command_record.read_header(args.file)
+    patch(header)
+
+    if args.serve:
+        patch_room_network(header, args.file, speed)
+        print(f"Join room {header['roomId']} to start replaying")
+        sys.argv = [sys.argv[0], *main_args]
+        main.main()
+        return
+
+    config.init()
+    http_client.init()
+    models.database.init(False)
+    models.avatar.init()
+    api.chat.init()
+    asyncio.get_event_loop().run_until_complete(replay_to_room(header, args.file, speed))
+
+
+def patch(header):
+    """不访问网络"""
+    original_config_init = config.init
+
+    def config_init():
+        original_config_init()
+        config.get_config().enable_translate = False
+
+    config.init = config_init
+
+    def get_avatar_url_from_web(_user_id):
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(None)
+        return future
+
+    models.avatar.get_avatar_url_from_web = get_avatar_url_from_web
+    update.check_update = lambda: None
+    webbrowser.open = lambda *_args, **_kwargs: True
+
+    async def init_room(self: api.chat.Room):
+        # 用记录的房间信息，不请求B站
+        self._room_id = header['roomId']
+        self._room_owner_uid = header['roomOwnerUid']
+        return True
+
+    api.chat.Room.init_room = init_room
+
+
+def patch_room_network(header, path, speed):
+    async def network_coroutine(self: api.chat.Room):
+        count = await models.command_record.replay(self._handle_command, path, speed)
+        print(f"Replayed {count} commands to room {header['roomId']}")
+
+    api.chat.Room._network_coroutine = network_coroutine
+
+
+async def replay_to_room(header, path, speed):
+    room = api.chat.Room(header['roomId'])
+    await room.init_room()
+
+    background_tasks = asyncio.all_tasks()
+    start_time = time.perf_counter()
+    count = await models.command_record.replay(room._handle_command, path, speed)
+    handle_time = time.perf_counter() - start_time
+    # 等待弹幕处理完
+    pending_tasks = asyncio.all_tasks() - background_tasks - {asyncio.current_task()}
+    if pending_tasks:
+        await asyncio.wait(pending_tasks)
+    total_time = time.perf_counter() - start_time
+
+    print(f'Replayed {count} commands in {total_time:.3f}s ({count / total_time:.1f} commands/s), '
+          f'handling commands took {handle_time:.3f}s')
+
+
+if __name__ == '__main__':
+    run()
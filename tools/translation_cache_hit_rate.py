@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""
+用记录的弹幕日志重放翻译缓存，比较不同缓存key规范化步骤的命中率
+
+在项目根目录运行：python -m tools.translation_cache_hit_rate [--lid LID] [--cache-size N]
+"""
+
+import argparse
+import json
+
+import api.chat
+import config
+import models.database
+import models.log
+import models.translate
+
+BATCH_SIZE = 1000
+
+
+def main():
+    args = parse_args()
+    config.init()
+    models.database.init(False)
+    cache_size = args.cache_size or config.get_config().translation_cache_size
+
+    texts = list(iter_logged_texts(args.lid))
+    print(f'{len(texts)} translatable texts, cache size {cache_size}')
+    print_hit_rate('legacy (strip + lower)', texts, cache_size, [])
+    normalizers = []
+    for normalizer in models.translate.CACHE_KEY_NORMALIZERS:
+        normalizers.append(normalizer)
+        print_hit_rate(' + '.join(normalizers), texts, cache_size, normalizers)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='用记录的弹幕日志重放翻译缓存，比较缓存命中率')
+    parser.add_argument('--lid', help='只重放指定日志ID', type=int, default=None)
+    parser.add_argument('--cache-size', help='缓存数量，默认使用配置中的translation_cache_size', type=int,
+                        default=None)
+    return parser.parse_args()
+
+
+def iter_logged_texts(lid):
+    last_did = 0
+    while True:
+        with models.database.get_session() as session:
+            query = session.query(models.log.LogItem.did, models.log.LogItem.content).filter(
+                models.log.LogItem.did > last_did
+            )
+            if lid is not None:
+                query = query.filter(models.log.LogItem.lid == lid)
+            rows = query.order_by(models.log.LogItem.did).limit(BATCH_SIZE).all()
+        if not rows:
+            break
+        last_did = rows[-1][0]
+
+        for _, content in rows:
+            try:
+                body = json.loads(content)
+                if body['cmd'] == api.chat.Command.ADD_TEXT:
+                    text = body['data'][4]
+                elif body['cmd'] == api.chat.Command.ADD_SUPER_CHAT:
+                    text = body['data']['content']
+                else:
+                    continue
+            except (ValueError, LookupError, TypeError):
+                continue
+            if models.translate.need_translate(text):
+                yield text
+
+
+def print_hit_rate(name, texts, cache_size, normalizers):
+    # 和models.translate一样，超出容量时淘汰最早的
+    cache = {}
+    hit_count = 0
+    for text in texts:
+        key = models.translate.get_cache_key(text, normalizers)
+        if key in cache:
+            hit_count += 1
+            continue
+        cache[key] = None
+        while len(cache) > cache_size:
+            cache.pop(next(iter(cache)), None)
+    hit_rate = hit_count / len(texts) if texts else 0
+    print(f'{name}: {hit_count} hits, {len(texts) - hit_count} provider calls, hit rate {hit_rate:.2%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+"""
+按采样率追踪单条消息从收到到发给所有客户端的各阶段耗时
+"""
+
+import collections
+import itertools
+import random
+import time
+from typing import *
+
+import config
+import metrics
+
+# 保留的最近完成的trace数
+MAX_TRACES = 1000
+# 每个阶段保留最近多少个耗时用来计算分位数
+MAX_STAGE_SAMPLES = 10000
+
+_trace_id_counter = itertools.count(1)
+_traces: Deque['MessageTrace'] = collections.deque(maxlen=MAX_TRACES)
+# stage -> 最近的耗时
+_stage_durations: Dict[str, Deque[float]] = collections.defaultdict(
+    lambda: collections.deque(maxlen=MAX_STAGE_SAMPLES)
+)
+
+_stage_duration_histogram = metrics.Histogram(
+    'blivechat_message_stage_duration_seconds', 'Time spent in each stage of sampled messages', ('stage',)
+)
+
+
+def start_trace(name) -> Optional['MessageTrace']:
+    """
+    按配置的采样率开始追踪一条消息，没有采样到时返回None
+    """
+    sample_rate = config.get_config().trace_sample_rate
+    if sample_rate <= 0 or random.random() >= sample_rate:
+        return None
+    return MessageTrace(name)
+
+
+class MessageTrace:
+    __slots__ = ('id', 'name', 'start_time', 'spans', '_last_mark_time')
+
+    def __init__(self, name):
+        self.id = next(_trace_id_counter)
+        self.name = name
+        # 都是time.perf_counter()的时间
+        self.start_time = self._last_mark_time = time.perf_counter()
+        # (stage, start_time, end_time)
+        self.spans: List[Tuple[str, float, float]] = []
+
+    def mark(self, stage):
+        """结束一个阶段，这个阶段从上次mark开始"""
+        cur_time = time.perf_counter()
+        self.spans.append((stage, self._last_mark_time, cur_time))
+        self._last_mark_time = cur_time
+
+    def finish(self):
+        self.spans.append(('total', self.start_time, self._last_mark_time))
+        for stage, start_time, end_time in self.spans:
+            duration = end_time - start_time
+            _stage_durations[stage].append(duration)
+            _stage_duration_histogram.labels(stage).observe(duration)
+        _traces.append(self)
+
+
+def get_stage_stats():
+    """
+    :return: stage -> 耗时统计（秒）
+    """
+    res = {}
+    for stage, durations in _stage_durations.items():
+        durations = sorted(durations)
+        if not durations:
+            continue
+        res[stage] = {
+            'count': len(durations),
+            'p50': _percentile(durations, 0.5),
+            'p90': _percentile(durations, 0.9),
+            'p99': _percentile(durations, 0.99),
+            'max': durations[-1]
+        }
+    return res
+
+
+def _percentile(sorted_values, ratio):
+    return sorted_values[min(int(len(sorted_values) * ratio), len(sorted_values) - 1)]
+
+
+def make_chrome_trace():
+    """
+    :return: Chrome trace格式的dict，可以用chrome://tracing、Perfetto打开
+    """
+    events = []
+    for trace in _traces:
+        for stage, start_time, end_time in trace.spans:
+            events.append({
+                'name': stage,
+                'cat': trace.name,
+                'ph': 'X',
+                'ts': start_time * 1000000,
+                'dur': (end_time - start_time) * 1000000,
+                'pid': 1,
+                # 每条消息一行
+                'tid': trace.id
+            })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}